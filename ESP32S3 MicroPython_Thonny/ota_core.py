@@ -1,10 +1,21 @@
 from machine import Pin, I2C, ADC, SoftI2C, reset
-import dht, ds18x20, onewire, network, time, ssl, json, os
+import dht, ds18x20, onewire, network, time, ssl, json, os, struct, hashlib, binascii, io, sys, select
+import builtins
 from umqtt.simple import MQTTClient
-from ssd1306 import SSD1306_I2C
+from ssd1306 import SSD1306_I2C, TextField
 from machine import reset
 import machine
 
+try:
+    import asyncio
+except ImportError:  # MicroPython < 1.21
+    import uasyncio as asyncio
+
+try:
+    import _thread
+except ImportError:  # Ports without threads run blocking user scripts inline
+    _thread = None
+
 # === Configuration ===
 WIFI_SSID = "aa"
 WIFI_PASSWORD = "12345678"
@@ -13,9 +24,35 @@ MQTT_PORT = 8883
 MQTT_USER = 'b'  # replace with actual username 
 MQTT_PASSWORD = 'c'  #replace with the password paried with the username
 CLIENT_ID = "d"  # set your own id
-SENSOR_TOPIC = 'fyp/RemoteIoT'
+SENSOR_TOPIC = 'fyp/' + CLIENT_ID + '/RemoteIoT'  # per-board topic; the dashboard subscribes to fyp/+/RemoteIoT
+FILES_TOPIC = 'fyp/' + CLIENT_ID + '/files'  # Retained: SHA-256 of the scripts stored on this board
 CODE_TOPIC = "fyp/code_update"
+CODE_ACK_TOPIC = "fyp/code_ack"
 DEBUG_TOPIC = "fyp/debug_output"
+SCRIPT_TOPIC = "fyp/script_control"  # {"action": "stop"}, optionally with "device", from the dashboard
+SCRIPT_STATUS_TOPIC = "fyp/script_status"  # {"device", "filename", "status", ...} back to the dashboard
+MQTT_BUFFER_SIZE = 4096  # Preallocated send/receive buffers (fits an OTA chunk); 0 = allocate per packet
+CAPS_TOPIC = "fyp/capabilities"  # Retained by the server: the payload formats it understands
+PAYLOAD_FORMAT = "auto"  # "auto" sends binary readings once the server lists them, "json" always sends JSON
+SAMPLE_INTERVAL = 10  # Seconds between recorded readings, each holding the newest value of every sensor
+# Seconds between reads of each sensor; they run independently (DHT11 needs at least 2)
+SENSOR_PERIODS = {"dht11": 10, "ds18b20": 10, "light": 10}
+MQTT_POLL_MS = 20  # How often receive_messages checks the socket for incoming data
+DS18B20_CONVERSION_MS = 750  # 12-bit conversion time; other tasks run while it converts
+BATCH_SIZE = 1  # Readings per MQTT message (max 255); 1 publishes every reading straight away
+BATCH_SECONDS = 60  # Publish a partly filled batch once its oldest reading is this old
+BACKLOG_FILE = "backlog.bin"  # Readings taken while offline, sent once the board reconnects
+BACKLOG_MAX_BYTES = 256 * 1024  # Flash used by the backlog; the oldest readings are overwritten beyond it
+BACKLOG_BATCH = 50  # Backlog readings per catch-up message (max 255)
+BACKLOG_RATE_MS = 1000  # Min time between catch-up messages, so live traffic and OTA keep flowing
+WIFI_TIMEOUT = 20  # Seconds to wait for Wi-Fi before carrying on offline
+MQTT_RETRIES = 3  # Connect attempts per reconnect
+RECONNECT_INTERVAL = 60  # Seconds between reconnect attempts while offline
+SCRIPT_BUDGET = 120  # Seconds a user script may run before it is cancelled
+SCRIPT_STACK_SIZE = 16 * 1024  # Stack of the thread running a blocking user script
+SCRIPT_SLEEP_SLICE_MS = 50  # How quickly a sleeping threaded script notices it was cancelled
+SCRIPT_BUSY_GRACE = 5  # Seconds a threaded script may go without sleeping before it counts as not cancellable
+SCRIPT_STUCK_FILE = "script_stuck.txt"  # Script the board was reset to stop, skipped at the next boot
 
 
 # SSL context
@@ -25,6 +62,70 @@ context.verify_mode = ssl.CERT_NONE
 # Global MQTT client
 client = None
 
+# Chunked OTA (protocol described in app/ota_jobs.py on the server)
+OTA_CHUNK_MAGIC = b"OC"
+OTA_CHUNK_HEADER = "!HHB"  # transfer, seq, flags
+OTA_HEADER_SIZE = 7  # magic + header
+OTA_FLAG_ZLIB = 0x01
+OTA_STALL_MS = 30000  # Give up on a transfer after this long without a frame (the .part file is kept)
+ota = None  # Active transfer: manifest fields plus the open .part file, running hash and next seq
+ota_done = None  # Last transfer written here; its chunks are answered "done" if the server missed that ack
+MPY_ABI = getattr(sys.implementation, "_mpy", None)  # .mpy format this firmware imports, sent to the server
+# Delta transfers (format described in app/ota_jobs.py): the chunks carry COPY/INSERT ops that
+# rebuild the file from the version already on flash
+DELTA_COPY = 1  # "!BII": op, offset in the old file, length
+DELTA_INSERT = 2  # "!BI" + bytes: op, length
+FILES_MANIFEST = "ota_files.json"  # filename -> [sha256, size] of every stored script
+file_hashes = {}
+
+# Binary readings (format described in app/sensor_codec.py on the server)
+SENSOR_FORMAT = "sr1"
+SENSOR_HEADER = "!2sBB"  # magic, version, record count
+SENSOR_RECORD = "!Ihhhh"  # seconds since 2000, DHT11 temp, DHT11 humidity, DS18B20 temp x100, light
+SENSOR_HEADER_SIZE = 4
+SENSOR_RECORD_SIZE = 12
+SENSOR_MISSING = -32768
+EPOCH_2000 = time.mktime((2000, 1, 1, 0, 0, 0, 0, 0))  # 0 on ports whose epoch is already 2000
+sensor_buf = bytearray(SENSOR_HEADER_SIZE + SENSOR_RECORD_SIZE * BATCH_SIZE)  # Reused for every batch
+struct.pack_into(SENSOR_HEADER, sensor_buf, 0, b"SR", 1, 0)
+use_binary = False  # Set once the server advertises SENSOR_FORMAT on CAPS_TOPIC
+
+# Readings waiting to be published, packed into sensor_buf (rendered as JSON at send time if needed)
+batch_count = 0
+batch_started = 0
+
+# Backlog: a ring of SENSOR_RECORDs in BACKLOG_FILE after a header holding the slot of the
+# oldest reading and the number of readings
+BACKLOG_HEADER = "!II"
+BACKLOG_HEADER_SIZE = 8
+BACKLOG_RECORDS = (BACKLOG_MAX_BYTES - BACKLOG_HEADER_SIZE) // SENSOR_RECORD_SIZE
+backlog_buf = bytearray(SENSOR_HEADER_SIZE + SENSOR_RECORD_SIZE * BACKLOG_BATCH)  # Reused for every catch-up message
+struct.pack_into(SENSOR_HEADER, backlog_buf, 0, b"SR", 1, 0)
+backlog_start = 0
+backlog_count = 0
+backlog_sent = 0  # ticks_ms of the last catch-up message
+online = False  # Wi-Fi and MQTT are up; readings go to the backlog while this is False
+scripts_started = False  # run_saved_script() runs once, on the first successful connect
+connected = asyncio.Event()  # Set while online; the MQTT receive task waits on it
+latest = {}  # sensor name -> (dict of its newest values, ticks_ms when read)
+script = None  # Running user script: filename, mode, start time, cancel reason, outcome
+script_queue = []  # User scripts waiting for the running one to stop
+
+# zlib decompression: "deflate" on MicroPython >= 1.21, "zlib" on older firmware
+try:
+    import deflate
+
+    def inflate(data):
+        return deflate.DeflateIO(io.BytesIO(data), deflate.ZLIB).read()
+except ImportError:
+    try:
+        import zlib
+
+        def inflate(data):
+            return zlib.decompress(data)
+    except ImportError:
+        inflate = None
+
 # === Hardware Setup ===
 dht_sensor = dht.DHT11(Pin(21))
 ow = onewire.OneWire(Pin(13))
@@ -38,36 +139,92 @@ oled = SSD1306_I2C(128, 64, i2c)
 
 
 # === Wi-Fi ===
-def connect_wifi():
+async def connect_wifi():
     wlan = network.WLAN(network.STA_IF)
     wlan.active(True)
+    if wlan.isconnected():
+        return True
     wlan.connect(WIFI_SSID, WIFI_PASSWORD)
-    while not wlan.isconnected():
-        time.sleep(1)
-    print("Wi-Fi connected:", wlan.ifconfig())
+    for _ in range(WIFI_TIMEOUT):
+        if wlan.isconnected():
+            print("Wi-Fi connected:", wlan.ifconfig())
+            return True
+        await asyncio.sleep(1)
+    print("⚠️ Wi-Fi not available, staying offline")
+    return False
 
 
 # === MQTT Connect ===
-def connect_mqtt():
+async def connect_mqtt():
     global client
     retries = 0
-    while retries < 5:
+    while retries < MQTT_RETRIES:
         try:
             client = MQTTClient(client_id=CLIENT_ID, server=MQTT_BROKER, port=MQTT_PORT,
-                                user=MQTT_USER, password=MQTT_PASSWORD, ssl=context)
+                                user=MQTT_USER, password=MQTT_PASSWORD, ssl=context,
+                                buffer_size=MQTT_BUFFER_SIZE)
 
-            client.set_callback(receive_code_update)  # ✅ Set callback BEFORE connect
+            client.set_callback(on_message)  # ✅ Set callback BEFORE connect
             client.connect(clean_session=True)
             client.subscribe(CODE_TOPIC)  # ✅ Subscribe to code topic
-            print(f"✅ Connected to MQTT: {MQTT_BROKER}, subscribed to {CODE_TOPIC}")
+            client.subscribe(CAPS_TOPIC)  # Retained, so it arrives straight away
+            client.subscribe(SCRIPT_TOPIC)
+            print(f"✅ Connected to MQTT: {MQTT_BROKER}, subscribed to {CODE_TOPIC}, {CAPS_TOPIC} and {SCRIPT_TOPIC}")
+            report_files()
             return True
         except Exception as e:
-            print(f"⚠️ MQTT connect error ({retries + 1}/5): {e}")
+            print(f"⚠️ MQTT connect error ({retries + 1}/{MQTT_RETRIES}): {e}")
             retries += 1
-            time.sleep(5)
-            machine.deepsleep(5000)
-    print("❌ MQTT failed after retries. Rebooting...")
-    machine.deepsleep(5000)
+            await asyncio.sleep(5)
+    # Keep sampling into the backlog rather than sleeping through the outage
+    print("❌ MQTT failed after retries, staying offline")
+    return False
+
+
+async def connect():
+    """ Brings Wi-Fi and MQTT up; returns False (offline) if either is unavailable. """
+    global online, scripts_started
+    online = await connect_wifi() and await connect_mqtt()
+    if online:
+        connected.set()
+    if online and not scripts_started:
+        scripts_started = True
+        run_saved_script()
+    return online
+
+
+def go_offline(error):
+    """ Drops the broken connection; readings go to the backlog until maintain_connection() reconnects. """
+    global online
+    print(f"⚠️ MQTT error: {error}, reconnecting...")
+    online = False
+    connected.clear()
+    try:
+        client.sock.close()  # Also wakes receive_messages() if it waits on this socket
+    except (AttributeError, OSError):
+        pass
+
+
+# === MQTT Callbacks ===
+# With MQTT_BUFFER_SIZE set, msg is a memoryview into the client's receive buffer: copy what
+# must outlive the callback.
+def on_message(topic, msg):
+    if topic == CAPS_TOPIC.encode():
+        receive_capabilities(msg)
+    elif topic == SCRIPT_TOPIC.encode():
+        receive_script_control(msg)
+    else:
+        receive_code_update(topic, msg)
+
+
+def receive_capabilities(msg):
+    global use_binary
+    try:
+        formats = json.loads(bytes(msg).decode())["sensor_formats"]
+    except (ValueError, KeyError, TypeError):
+        formats = []
+    use_binary = PAYLOAD_FORMAT == "auto" and SENSOR_FORMAT in formats
+    print("📡 Sensor payload format:", "binary" if use_binary else "JSON")
 
 
 # === OTA Callback ==
@@ -75,21 +232,24 @@ def receive_code_update(topic, msg):
     global client
     print("✅ OTA message received on topic:", topic)
     try:
-        payload = json.loads(msg.decode())  # parse Json payload
+        if bytes(msg[:2]) == OTA_CHUNK_MAGIC:
+            ota_chunk(msg)
+            return
+        payload = json.loads(bytes(msg).decode())  # parse Json payload
+        if "transfer" in payload:
+            ota_begin(payload)
+            return
+
+        # Single-message upload: {"filename", "code"}
         filename = payload.get("filename", "user_script.py")
         code = payload.get("code", "")
         with open(filename, "w") as f:
             f.write(code)
             f.flush()
         print(f"✅ OTA: Saved {filename}")
-
-        client.publish(DEBUG_TOPIC, f"✅ OTA: Saved {filename}. Running...".encode())
-        print(f"🚀 Executing {filename}...")
-
-        # Run the new code immediately without reboot
-        exec(code, {"__name__": "__main__"})
-
-        client.publish(DEBUG_TOPIC, f"✅ Execution of {filename} complete.".encode())
+        remove_other_build(filename)
+        update_file_hash(filename)
+        run_uploaded_script(filename)
 
     except Exception as e:
         error_msg = f"❌ OTA exec error: {str(e)}"
@@ -97,82 +257,804 @@ def receive_code_update(topic, msg):
         client.publish(DEBUG_TOPIC, error_msg.encode())
 
 
+def run_uploaded_script(filename):
+    client.publish(DEBUG_TOPIC, f"✅ OTA: Saved {filename}. Running...".encode())
+    start_script(filename)
+
+
+def remove_other_build(filename):
+    """ Deletes name.py after name.mpy was saved and vice versa: import prefers the .py. """
+    stem, dot, ext = filename.rpartition(".")
+    other = {"py": "mpy", "mpy": "py"}.get(ext)
+    if dot and other:
+        try:
+            os.remove(stem + "." + other)
+        except OSError:
+            pass
+        file_hashes.pop(stem + "." + other, None)
+
+
+def ota_ack(transfer, status, **fields):
+    fields["device"] = CLIENT_ID
+    fields["mpy"] = MPY_ABI
+    fields["transfer"] = transfer
+    fields["status"] = status
+    client.publish(CODE_ACK_TOPIC, json.dumps(fields))
+
+
+def ota_ack_done(transfer):
+    global ota_done
+    ota_done = transfer
+    ota_ack(transfer, "done")
+
+
+def ota_close():
+    global ota
+    if ota is not None:
+        ota["file"].close()
+        ota = None
+
+
+def ota_begin(manifest):
+    """ Opens <filename>.part for a new transfer, or reopens it if an earlier transfer of the
+    same file stopped part-way (the <filename>.ota state file remembers which one). """
+    global ota
+    devices = manifest.get("devices")
+    if devices is not None and CLIENT_ID not in devices:
+        return  # A follow-up transfer for other boards
+    ota_close()
+    filename = manifest["filename"]
+    if manifest.get("unchanged"):
+        ota_unchanged(manifest)
+        return
+    patch = manifest.get("patch")
+    if patch is not None and file_sha256(filename) != patch["base"]:
+        ota_ack(manifest["transfer"], "error", error="Delta base differs from the stored file")
+        return
+    part, state = filename + ".part", filename + ".ota"
+    chunk_size = manifest["chunk_size"]
+    digest = hashlib.sha256()
+    done = 0
+    try:
+        with open(state) as f:
+            saved = json.loads(f.read())
+        size = os.stat(part)[6]
+        if saved["sha256"] == manifest["sha256"] and saved["chunk_size"] == chunk_size and size % chunk_size == 0:
+            buf = bytearray(512)
+            with open(part, "rb") as f:  # Re-hash what already reached flash, one block at a time
+                while True:
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    digest.update(buf[:n])
+            done = size // chunk_size
+    except (OSError, ValueError, KeyError):
+        pass
+
+    if done == 0:
+        with open(state, "w") as f:
+            f.write(json.dumps({"sha256": manifest["sha256"], "chunk_size": chunk_size}))
+    ota = {
+        "transfer": manifest["transfer"],
+        "filename": filename,
+        "sha256": manifest["sha256"],
+        "chunks": manifest["chunks"],
+        "patch": patch,
+        "file": open(part, "ab" if done else "wb"),
+        "hash": digest,
+        "next": done,
+        "last": time.ticks_ms(),
+    }
+    print(f"📦 OTA: {filename}, {manifest['chunks']} chunks, resuming at {done}")
+    if done >= ota["chunks"]:
+        ota_finish()
+    else:
+        ota_ack(ota["transfer"], "ok", next=done, zlib=inflate is not None)
+
+
+def ota_unchanged(manifest):
+    """ The server only sends the hash when the file should already be here: just rerun it. """
+    filename = manifest["filename"]
+    if file_sha256(filename) != manifest["sha256"]:
+        ota_ack(manifest["transfer"], "error", error="Stored file differs from the reported hash")
+        return
+    print(f"✅ OTA: {filename} unchanged")
+    ota_ack_done(manifest["transfer"])
+    run_uploaded_script(filename)
+
+
+def ota_chunk(msg):
+    """ Writes one chunk straight to flash if it is the next one expected, then acks the next seq. """
+    transfer, seq, flags = struct.unpack_from(OTA_CHUNK_HEADER, msg, 2)
+    if ota is None or transfer != ota["transfer"]:
+        if transfer == ota_done:
+            ota_ack(transfer, "done")  # Our "done" was lost and the server resent the last chunk
+        return  # Not ours (or the manifest was missed); the server times out and resends
+    ota["last"] = time.ticks_ms()
+    if seq == ota["next"]:
+        data = msg[OTA_HEADER_SIZE:]  # Written to flash straight from the receive buffer
+        if flags & OTA_FLAG_ZLIB:
+            data = inflate(bytes(data))
+        ota["file"].write(data)
+        ota["hash"].update(data)
+        ota["next"] += 1
+    if ota["next"] >= ota["chunks"]:
+        ota_finish()
+    else:
+        ota_ack(transfer, "ok", next=ota["next"])
+
+
+def ota_finish():
+    transfer, filename, expected, patch = ota["transfer"], ota["filename"], ota["sha256"], ota["patch"]
+    digest = binascii.hexlify(ota["hash"].digest()).decode()
+    ota_close()
+    part = filename + ".part"
+    try:
+        os.remove(filename + ".ota")
+    except OSError:
+        pass
+    if digest != expected:
+        os.remove(part)
+        ota_ack(transfer, "error", error="SHA-256 mismatch")
+        client.publish(DEBUG_TOPIC, f"❌ OTA: {filename} failed the SHA-256 check".encode())
+        return
+    if patch is not None:
+        # part holds the delta: rebuild the new version next to the old one, then swap them
+        delta = part
+        part = filename + ".new"
+        try:
+            digest = apply_delta(delta, filename, part)
+        except (OSError, ValueError) as e:
+            digest = str(e)
+        os.remove(delta)
+        if digest != patch["sha256"]:
+            os.remove(part)
+            ota_ack(transfer, "error", error="Patched file failed the SHA-256 check")
+            return
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+    os.rename(part, filename)
+    print(f"✅ OTA: Saved {filename}")
+    remove_other_build(filename)
+    update_file_hash(filename)
+    ota_ack_done(transfer)
+    run_uploaded_script(filename)
+
+
+def copy_bytes(src, dst, length, digest, buf):
+    """ Copies length bytes between open files through buf, hashing them. """
+    view = memoryview(buf)
+    while length > 0:
+        n = src.readinto(view[:min(length, len(buf))])
+        if not n:
+            raise ValueError("Delta reads past the end of a file")
+        dst.write(view[:n])
+        digest.update(view[:n])
+        length -= n
+
+
+def apply_delta(delta_name, base_name, out_name):
+    """ Writes out_name from base_name and the delta ops in delta_name; returns its SHA-256. """
+    digest = hashlib.sha256()
+    buf = bytearray(512)
+    with open(delta_name, "rb") as delta, open(base_name, "rb") as base, open(out_name, "wb") as out:
+        while True:
+            op = delta.read(1)
+            if not op:
+                break
+            if op[0] == DELTA_COPY:
+                offset, length = struct.unpack("!II", delta.read(8))
+                base.seek(offset)
+                copy_bytes(base, out, length, digest, buf)
+            elif op[0] == DELTA_INSERT:
+                length = struct.unpack("!I", delta.read(4))[0]
+                copy_bytes(delta, out, length, digest, buf)
+            else:
+                raise ValueError("Unknown delta op")
+    return binascii.hexlify(digest.digest()).decode()
+
+
+# === Stored File Hashes ===
+def file_sha256(filename):
+    """ SHA-256 (hex) of a file on flash, or None if it does not exist. """
+    digest = hashlib.sha256()
+    buf = bytearray(512)
+    try:
+        with open(filename, "rb") as f:
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                digest.update(memoryview(buf)[:n])
+    except OSError:
+        return None
+    return binascii.hexlify(digest.digest()).decode()
+
+
+def load_file_hashes():
+    """ Loads FILES_MANIFEST and re-hashes scripts that are new or changed size since (e.g.
+    edited over USB). """
+    global file_hashes
+    try:
+        with open(FILES_MANIFEST) as f:
+            file_hashes = json.loads(f.read())
+    except (OSError, ValueError):
+        file_hashes = {}
+    names = [name for name in os.listdir() if name.endswith(".py") or name.endswith(".mpy")]
+    for name in list(file_hashes):
+        if name not in names:
+            del file_hashes[name]
+    for name in names:
+        size = os.stat(name)[6]
+        if name not in file_hashes or file_hashes[name][1] != size:
+            file_hashes[name] = [file_sha256(name), size]
+    save_file_hashes()
+
+
+def save_file_hashes():
+    try:
+        with open(FILES_MANIFEST, "w") as f:
+            f.write(json.dumps(file_hashes))
+    except OSError as e:
+        print(f"⚠️ Could not save {FILES_MANIFEST}: {e}")
+
+
+def update_file_hash(filename):
+    """ Records a file just written by OTA and tells the server. """
+    file_hashes[filename] = [file_sha256(filename), os.stat(filename)[6]]
+    save_file_hashes()
+    report_files()
+
+
+def report_files():
+    """ Publishes (retained) the hash of every stored script, so the server can send deltas. """
+    files = {name: entry[0] for name, entry in file_hashes.items()}
+    client.publish(FILES_TOPIC, json.dumps({"device": CLIENT_ID, "files": files}), retain=True)
+
+
 # === Read Sensors ===
-def read_sensors():
+async def read_dht11():
     dht_sensor.measure()
+    return {"temp_dht11": dht_sensor.temperature(), "hum_dht11": dht_sensor.humidity()}
+
+
+async def read_ds18b20():
     ds_sensor.convert_temp()
-    time.sleep(1)
-    return {
-        "temp_dht11": dht_sensor.temperature(),
-        "hum_dht11": dht_sensor.humidity(),
-        "temp_ds18b20": ds_sensor.read_temp(roms[0]),
-        "light": light_sensor.read()
-    }
+    await asyncio.sleep_ms(DS18B20_CONVERSION_MS)
+    return {"temp_ds18b20": ds_sensor.read_temp(roms[0])}
+
+
+async def read_light():
+    return {"light": light_sensor.read()}
+
+
+SENSORS = (("dht11", read_dht11), ("ds18b20", read_ds18b20), ("light", read_light))
+
+
+def current_readings():
+    """ The newest value of every sensor; None for a sensor with no read in twice its period. """
+    data = {"temp_dht11": None, "hum_dht11": None, "temp_ds18b20": None, "light": None}
+    now = time.ticks_ms()
+    for name, (values, taken) in latest.items():
+        if time.ticks_diff(now, taken) <= 2000 * SENSOR_PERIODS[name]:
+            data.update(values)
+    return data
 
 
 # === OLED Display ===
-def show_oled(data):
+# Labels are drawn once; each value is a TextField, redrawn and sent over I2C only when it changes
+OLED_CHARS = 16  # 8-pixel characters per 128-pixel line
+OLED_FIELDS = (  # label, key in the readings, format, y
+    ("DHT11: ", "temp_dht11", "{}C", 0),
+    ("Hum: ", "hum_dht11", "{}%", 10),
+    ("DS18B20: ", "temp_ds18b20", "{}C", 20),
+    ("Light: ", "light", "{}", 30),
+)
+oled_fields = []  # (key, TextField)
+
+
+def init_oled():
     oled.fill(0)
-    oled.text(f"DHT11: {data['temp_dht11']}C", 0, 0)
-    oled.text(f"Hum: {data['hum_dht11']}%", 0, 10)
-    oled.text(f"DS18B20: {data['temp_ds18b20']}C", 0, 20)
-    oled.text(f"Light: {data['light']}", 0, 30)
+    for label, key, fmt, y in OLED_FIELDS:
+        oled.text(label, 0, y)
+        oled_fields.append((key, TextField(oled, 8 * len(label), y, OLED_CHARS - len(label), fmt)))
     oled.text("OTA Active", 0, 50)
     oled.show()
 
 
+def show_oled(data):
+    if not oled_fields:
+        init_oled()
+    changed = False
+    for key, field in oled_fields:
+        if field.update(data[key]):
+            changed = True
+    if changed:
+        oled.show()  # Only the pages/columns of the changed values
+
+
 # === MQTT Sensor Publish ===
+def sensor_field(value, scale=1):
+    return SENSOR_MISSING if value is None else int(round(value * scale))
+
+
+def json_field(value, scale=1):
+    if value == SENSOR_MISSING:
+        return None
+    return value / scale if scale != 1 else value
+
+
 def publish_data(data):
-    timestamp = time.localtime()
-    formatted = f"{timestamp[0]:04d}-{timestamp[1]:02d}-{timestamp[2]:02d} {timestamp[3]:02d}:{timestamp[4]:02d}:{timestamp[5]:02d}"
-    payload = json.dumps({
-        "time": formatted,
-        "DHT11_Temperature": data['temp_dht11'],
-        "DHT11_Humidity": data['hum_dht11'],
-        "DS18B20_Temperature": data['temp_ds18b20'],
-        "Light_Intensity": data['light']
-    })
+    """ Adds a reading to the current batch and publishes the batch once it is full or old enough. """
+    global batch_count, batch_started
+    if batch_count == 0:
+        batch_started = time.ticks_ms()
+    struct.pack_into(SENSOR_RECORD, sensor_buf, SENSOR_HEADER_SIZE + batch_count * SENSOR_RECORD_SIZE,
+                     int(time.time() - EPOCH_2000),
+                     sensor_field(data['temp_dht11']), sensor_field(data['hum_dht11']),
+                     sensor_field(data['temp_ds18b20'], 100), sensor_field(data['light']))
+    batch_count += 1
+    if batch_count >= BATCH_SIZE or time.ticks_diff(time.ticks_ms(), batch_started) >= BATCH_SECONDS * 1000:
+        publish_batch()
+
+
+def publish_batch():
+    """ Sends the batched readings, or logs them to the backlog while offline or still catching up
+    (so the server receives every board's readings oldest first). """
+    global batch_count
+    if batch_count == 0:
+        return
+    sent = False
+    try:
+        if online and backlog_count == 0:
+            send_readings(sensor_buf, batch_count)
+            sent = True
+    finally:
+        if not sent:
+            backlog_append(sensor_buf, batch_count)
+        batch_count = 0
+
+
+def send_readings(buf, count):
+    """ Publishes count records packed in buf as one message: a binary payload, one JSON object
+    or a JSON array. """
+    if use_binary:
+        buf[3] = count
+        size = SENSOR_HEADER_SIZE + count * SENSOR_RECORD_SIZE
+        client.publish(SENSOR_TOPIC, memoryview(buf)[:size])
+        print("Published sensor data:", count, "readings,", size, "bytes")
+        return
+    readings = []
+    for i in range(count):
+        seconds, temp, hum, temp_ds, light = struct.unpack_from(
+            SENSOR_RECORD, buf, SENSOR_HEADER_SIZE + i * SENSOR_RECORD_SIZE)
+        timestamp = time.localtime(seconds + EPOCH_2000)
+        readings.append({
+            "time": f"{timestamp[0]:04d}-{timestamp[1]:02d}-{timestamp[2]:02d} {timestamp[3]:02d}:{timestamp[4]:02d}:{timestamp[5]:02d}",
+            "DHT11_Temperature": json_field(temp),
+            "DHT11_Humidity": json_field(hum),
+            "DS18B20_Temperature": json_field(temp_ds, 100),
+            "Light_Intensity": json_field(light)
+        })
+    payload = json.dumps(readings[0] if count == 1 else readings)
     client.publish(SENSOR_TOPIC, payload)
     print("Published sensor data:", payload)
 
 
-# === Run user script on boot ===
+# === Offline Backlog ===
+def backlog_open():
+    """ Loads the backlog position from flash, starting an empty backlog if there is none. """
+    global backlog_start, backlog_count
+    try:
+        with open(BACKLOG_FILE, "rb") as f:
+            header = f.read(BACKLOG_HEADER_SIZE)
+        if len(header) != BACKLOG_HEADER_SIZE:
+            raise ValueError("short header")
+        backlog_start, backlog_count = struct.unpack(BACKLOG_HEADER, header)
+        if backlog_start >= BACKLOG_RECORDS or backlog_count > BACKLOG_RECORDS:
+            raise ValueError("written with a different BACKLOG_MAX_BYTES")
+        print("📼 Backlog:", backlog_count, "readings to send")
+    except (OSError, ValueError):
+        backlog_start = backlog_count = 0
+        with open(BACKLOG_FILE, "wb") as f:
+            f.write(struct.pack(BACKLOG_HEADER, 0, 0))
+
+
+def backlog_append(buf, count):
+    """ Appends count records packed in buf to the backlog, overwriting the oldest once it is full. """
+    global backlog_start, backlog_count
+    try:
+        with open(BACKLOG_FILE, "r+b") as f:
+            for i in range(count):
+                slot = (backlog_start + backlog_count) % BACKLOG_RECORDS
+                offset = SENSOR_HEADER_SIZE + i * SENSOR_RECORD_SIZE
+                f.seek(BACKLOG_HEADER_SIZE + slot * SENSOR_RECORD_SIZE)
+                f.write(memoryview(buf)[offset:offset + SENSOR_RECORD_SIZE])
+                if backlog_count < BACKLOG_RECORDS:
+                    backlog_count += 1
+                else:
+                    backlog_start = (backlog_start + 1) % BACKLOG_RECORDS  # Oldest reading lost
+            f.seek(0)
+            f.write(struct.pack(BACKLOG_HEADER, backlog_start, backlog_count))
+        print("📼 Logged", count, "readings offline,", backlog_count, "in backlog")
+    except OSError as e:
+        print(f"⚠️ Backlog write error, readings dropped: {e}")
+
+
+def drain_backlog():
+    """ Sends the oldest BACKLOG_BATCH backlog readings as one message, at most once every
+    BACKLOG_RATE_MS; they leave the backlog only once the publish succeeded. """
+    global backlog_start, backlog_count, backlog_sent
+    if backlog_count == 0 or time.ticks_diff(time.ticks_ms(), backlog_sent) < BACKLOG_RATE_MS:
+        return
+    count = min(backlog_count, BACKLOG_BATCH)
+    view = memoryview(backlog_buf)
+    with open(BACKLOG_FILE, "r+b") as f:
+        # Read up to the end of the ring, then wrap around to its first slot
+        first = min(count, BACKLOG_RECORDS - backlog_start)
+        f.seek(BACKLOG_HEADER_SIZE + backlog_start * SENSOR_RECORD_SIZE)
+        f.readinto(view[SENSOR_HEADER_SIZE:SENSOR_HEADER_SIZE + first * SENSOR_RECORD_SIZE])
+        if first < count:
+            f.seek(BACKLOG_HEADER_SIZE)
+            f.readinto(view[SENSOR_HEADER_SIZE + first * SENSOR_RECORD_SIZE:
+                            SENSOR_HEADER_SIZE + count * SENSOR_RECORD_SIZE])
+        send_readings(backlog_buf, count)
+        backlog_sent = time.ticks_ms()
+        backlog_count -= count
+        backlog_start = (backlog_start + count) % BACKLOG_RECORDS if backlog_count else 0
+        f.seek(0)
+        f.write(struct.pack(BACKLOG_HEADER, backlog_start, backlog_count))
+
+
+# === User Scripts ===
+# Uploaded scripts run beside the sensor, MQTT and OLED tasks. A script defining
+# "async def main()" runs as an asyncio task; any other script runs on its own thread (inline
+# on ports without _thread), where "import time" on that thread gives ScriptTime so that its
+# sleeps can be cancelled. Scripts precompiled by the server (.mpy) are imported on that thread,
+# and an async main() they define is then handed to asyncio. A threaded script that stops
+# sleeping is reported as not cancellable, and cancelling it resets the board. check_script()
+# reports every outcome on SCRIPT_STATUS_TOPIC.
+class ScriptCancelled(BaseException):
+    """ Not an Exception, like KeyboardInterrupt, so a script's "except Exception:" lets it through. """
+
+
+class ScriptTime:
+    """ The time module as seen by a threaded user script: sleeps wake every
+    SCRIPT_SLEEP_SLICE_MS and raise ScriptCancelled once the script is cancelled. """
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def sleep(self, seconds):
+        self.sleep_ms(int(seconds * 1000))
+
+    def sleep_ms(self, ms):
+        deadline = time.ticks_add(time.ticks_ms(), ms)
+        while True:
+            script_checkpoint()
+            remaining = time.ticks_diff(deadline, time.ticks_ms())
+            if remaining <= 0:
+                return
+            time.sleep_ms(min(remaining, SCRIPT_SLEEP_SLICE_MS))
+
+    def sleep_us(self, us):
+        script_checkpoint()
+        time.sleep_us(us)
+
+
+script_time = ScriptTime()
+real_import = builtins.__import__
+
+
+def script_import(name, *args):
+    """ __import__ while a threaded script runs: only imports made on the script's thread get
+    ScriptTime, the sensor, MQTT and OLED tasks keep the real time module. """
+    current = script
+    if name in ("time", "utime") and current is not None and current.get("thread") == _thread.get_ident():
+        return script_time
+    return real_import(name, *args)
+
+
+def script_checkpoint():
+    current = script
+    if current is not None and current.get("thread") == _thread.get_ident():
+        if current["cancel"]:
+            raise ScriptCancelled(current["cancel"])  # No longer "checked": a script swallowing this is stuck
+        current["checked"] = time.ticks_ms()
+
+
+def start_script(filename):
+    """ Runs a user script, after cancelling the one already running. """
+    if script is not None:
+        cancel_script("cancelled")
+        script_queue[:] = [filename]  # Started by check_script() once the old one has stopped
+    else:
+        launch_script(filename)
+
+
+def cancel_script(reason):
+    if script is None or script["cancel"]:
+        return
+    print(f"⏹ Cancelling {script['filename']}: {reason}")
+    script["cancel"] = reason
+    script["cancelled"] = time.ticks_ms()
+    if script["task"] is not None:
+        script["task"].cancel()
+
+
+def launch_script(filename):
+    global script
+    source = None
+    try:
+        if filename.endswith(".mpy"):
+            os.stat(filename)
+        else:
+            with open(filename) as f:
+                source = f.read()
+    except OSError as e:
+        report_script(filename, "error", error=str(e))
+        return
+    if source is not None and "async def main(" in source:
+        mode = "task"
+    else:
+        mode = "thread" if _thread is not None else "inline"
+    started = time.ticks_ms()
+    script = {"filename": filename, "mode": mode, "started": started, "cancel": None, "cancelled": None,
+              "checked": started, "busy": False, "task": None, "main": None, "status": None, "error": None}
+    print(f"🚀 Executing {filename} ({mode})...")
+    report_script(filename, "running", mode=mode, budget=SCRIPT_BUDGET, cancellable=mode != "inline")
+    if mode == "task":
+        try:
+            scope = {"__name__": "__main__"}
+            exec(source, scope)
+            script["task"] = asyncio.create_task(run_script_task(scope["main"]))
+        except Exception as e:
+            finish_script(script, e)
+    elif mode == "thread":
+        builtins.__import__ = script_import
+        _thread.stack_size(SCRIPT_STACK_SIZE)
+        _thread.start_new_thread(run_script_thread, (script, source))
+    else:
+        run_script_inline(script, source)
+
+
+def finish_script(current, error=None):
+    """ Records how a script ended; check_script() reports it. """
+    if current["cancel"]:
+        current["status"] = "timeout" if current["cancel"] == "timeout" else "cancelled"
+    elif error is not None:
+        current["status"], current["error"] = "error", str(error)
+    else:
+        current["status"] = "finished"
+
+
+def execute_script(current, source):
+    """ Runs the script body: exec of the source, or an import of the precompiled .mpy (its
+    module is dropped again so the next run executes it afresh). Returns its globals. """
+    if source is not None:
+        scope = {"__name__": "__main__"}
+        exec(source, scope)
+        return scope
+    name = current["filename"][:-4]
+    sys.modules.pop(name, None)
+    try:
+        return __import__(name).__dict__
+    finally:
+        sys.modules.pop(name, None)
+
+
+def is_async(function):
+    return type(function).__name__ == "generator"  # How MicroPython types "async def" functions
+
+
+def run_script_inline(current, source):
+    try:
+        scope = execute_script(current, source)
+        if source is None and is_async(scope.get("main")):
+            current["main"] = scope["main"]  # check_script() runs it as a task
+        else:
+            finish_script(current)
+    except Exception as e:
+        finish_script(current, e)
+
+
+def run_script_thread(current, source):
+    current["thread"] = _thread.get_ident()
+    try:
+        scope = execute_script(current, source)
+        if source is None and is_async(scope.get("main")):
+            current["main"] = scope["main"]  # check_script() runs it as a task
+        else:
+            finish_script(current)
+    except ScriptCancelled:
+        finish_script(current)
+    except Exception as e:
+        finish_script(current, e)
+
+
+async def run_script_task(main):
+    current = script
+    try:
+        await main()
+        finish_script(current)
+    except asyncio.CancelledError:
+        finish_script(current)
+    except Exception as e:
+        finish_script(current, e)
+
+
+def check_script():
+    """ Called every second: enforces SCRIPT_BUDGET, reports finished scripts and starts queued ones. """
+    global script
+    if script is not None and script["main"] is not None and script["task"] is None and script["status"] is None:
+        if script["cancel"]:
+            finish_script(script)
+        else:
+            script["mode"] = "task"
+            script["task"] = asyncio.create_task(run_script_task(script["main"]))
+    if script is not None and script["status"] is None:
+        if time.ticks_diff(time.ticks_ms(), script["started"]) > SCRIPT_BUDGET * 1000:
+            cancel_script("timeout")
+        if script["mode"] == "thread" and script["main"] is None:
+            check_busy_script(script)
+        return
+    if script is not None:
+        builtins.__import__ = real_import
+        elapsed = time.ticks_diff(time.ticks_ms(), script["started"]) // 1000
+        report_script(script["filename"], script["status"], elapsed=elapsed, error=script["error"])
+        script = None
+    if script_queue:
+        launch_script(script_queue.pop(0))
+
+
+def check_busy_script(current):
+    """ A threaded script can only be cancelled while it sleeps: one that has not slept for
+    SCRIPT_BUSY_GRACE is reported as not cancellable, and if it was cancelled the board is reset
+    (the script is then skipped at the next boot). """
+    now = time.ticks_ms()
+    busy = time.ticks_diff(now, current["checked"]) > SCRIPT_BUSY_GRACE * 1000
+    if busy != current["busy"]:
+        current["busy"] = busy
+        report_script(current["filename"], "running", mode=current["mode"], budget=SCRIPT_BUDGET,
+                      cancellable=not busy)
+    if busy and current["cancel"] and time.ticks_diff(now, current["cancelled"]) > SCRIPT_BUSY_GRACE * 1000:
+        elapsed = time.ticks_diff(now, current["started"]) // 1000
+        report_script(current["filename"], "stuck", elapsed=elapsed,
+                      error="script never sleeps, resetting the board to stop it")
+        with open(SCRIPT_STUCK_FILE, "w") as f:
+            f.write(current["filename"])
+        time.sleep_ms(500)  # Let the status leave before the reset
+        reset()
+
+
+def report_script(filename, status, **fields):
+    """ Publishes a script status; the debug pane gets a readable line too. """
+    print(f"📜 {filename}: {status}", fields.get("error") or "")
+    if not online:
+        return
+    fields["device"] = CLIENT_ID
+    fields["filename"] = filename
+    fields["status"] = status
+    try:
+        client.publish(SCRIPT_STATUS_TOPIC, json.dumps(fields))
+        if status == "finished":
+            client.publish(DEBUG_TOPIC, f"✅ Execution of {filename} complete.".encode())
+        elif status == "error":
+            client.publish(DEBUG_TOPIC, f"Script error: {fields['error']}".encode())
+    except OSError as e:
+        go_offline(e)
+
+
+def receive_script_control(msg):
+    try:
+        command = json.loads(bytes(msg).decode())
+    except ValueError:
+        return
+    if command.get("device") not in (None, CLIENT_ID):
+        return
+    if command.get("action") == "stop":
+        script_queue[:] = []
+        cancel_script("cancelled")
+
+
 def run_saved_script():
+    """ Queues the user-uploaded scripts saved on flash, as at every boot. """
     print("🔍 Looking for user-uploaded script to run...")
-
+    try:
+        with open(SCRIPT_STUCK_FILE) as f:
+            stuck = f.read()
+        os.remove(SCRIPT_STUCK_FILE)
+    except OSError:
+        stuck = None
     for fname in os.listdir():
         print(f"📁 Found file: {fname}")
-        if fname.startswith("user") and fname.endswith(".py"):
-            try:
-                print(f"🚀 Executing: {fname}")
-                with open(fname) as f:
-                    exec(f.read(), {"__name__": "__main__"})
-                client.publish(DEBUG_TOPIC, f"✅ Running user script after reboot".encode())
-            except Exception as e:
-                client.publish(DEBUG_TOPIC, f"Script error: {str(e)}".encode())
+        if fname == stuck:
+            print(f"⏭ Skipping {fname}: the board was reset to stop it")
+        elif fname.startswith("user") and (fname.endswith(".py") or fname.endswith(".mpy")):
+            script_queue.append(fname)
 
 
-# === Main Loop ===
-def main():
-    global client
-    connect_wifi()
-    connect_mqtt()
-    run_saved_script()
+# === Tasks ===
+async def sample_sensor(name, read):
+    """ Reads one sensor every SENSOR_PERIODS[name] seconds into latest. """
+    while True:
+        started = time.ticks_ms()
+        try:
+            latest[name] = (await read(), time.ticks_ms())
+        except Exception as e:
+            print(f"⚠️ {name} read error: {e}")
+        await asyncio.sleep_ms(max(0, SENSOR_PERIODS[name] * 1000 - time.ticks_diff(time.ticks_ms(), started)))
+
 
+async def record_readings():
+    """ Every SAMPLE_INTERVAL, shows and publishes (or logs, while offline) the newest readings. """
     while True:
+        await asyncio.sleep(SAMPLE_INTERVAL)
+        data = current_readings()
+        show_oled(data)
         try:
-            client.check_msg()  # OTA check
-            data = read_sensors()
-            show_oled(data)
             publish_data(data)
-            for _ in range(10):
-                client.check_msg()
-                time.sleep(1)
         except OSError as e:
-            print(f"⚠️ General error: {e}, reconnecting MQTT...")
-            connect_wifi()
-            connect_mqtt()
+            go_offline(e)
 
 
+async def socket_readable(sock):
+    """ Returns once sock has data (or an error) to read, checking every MQTT_POLL_MS so the
+    other tasks run in between. Polled rather than wrapped in a StreamReader, which would
+    consume the bytes umqtt needs to read itself. """
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    while not poller.poll(0):
+        await asyncio.sleep_ms(MQTT_POLL_MS)
 
 
+async def receive_messages():
+    """ Handles MQTT messages (OTA chunks, capabilities) as soon as they arrive. """
+    while True:
+        await connected.wait()
+        sock = client.sock
+        await socket_readable(sock)
+        if not online or sock is not client.sock:
+            continue  # The connection was replaced while waiting
+        try:
+            while client.check_msg() is not None:
+                pass  # TLS may have buffered several messages behind one wake-up
+        except OSError as e:
+            go_offline(e)
+
+
+async def maintain_connection():
+    """ Connects, reconnects every RECONNECT_INTERVAL while offline, and once a second sends
+    backlog readings, gives up on stalled OTA transfers and supervises the user script. """
+    last_attempt = None
+    while True:
+        if not online and (last_attempt is None or
+                           time.ticks_diff(time.ticks_ms(), last_attempt) >= RECONNECT_INTERVAL * 1000):
+            last_attempt = time.ticks_ms()
+            await connect()
+        if online:
+            try:
+                drain_backlog()
+            except OSError as e:
+                go_offline(e)
+        if ota is not None and time.ticks_diff(time.ticks_ms(), ota["last"]) > OTA_STALL_MS:
+            print("⚠️ OTA transfer stalled, will resume on the next upload")
+            ota_close()
+        check_script()
+        await asyncio.sleep(1)
+
+
+# === Main Loop ===
+async def run():
+    for name, read in SENSORS:
+        asyncio.create_task(sample_sensor(name, read))
+    asyncio.create_task(record_readings())
+    asyncio.create_task(receive_messages())
+    await maintain_connection()
+
+
+def main():
+    backlog_open()
+    load_file_hashes()
+    asyncio.run(run())
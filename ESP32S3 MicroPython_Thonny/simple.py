@@ -7,8 +7,13 @@ class MQTTException(Exception):
 
 class MQTTClient:
 
+    # buffer_size > 0 enables the buffered mode: every outgoing PUBLISH is assembled in a
+    # preallocated send buffer and written with one sock.write (one TLS record), and incoming
+    # packets are read with readinto into a preallocated receive buffer. The callback then gets
+    # msg as a memoryview into that buffer, valid only until the callback returns. Packets that
+    # do not fit fall back to the allocating path.
     def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0,
-                 ssl=False, ssl_params={}):
+                 ssl=False, ssl_params={}, buffer_size=0):
         if port == 0:
             port = 8883 if ssl else 1883
         self.client_id = client_id
@@ -26,16 +31,37 @@ class MQTTClient:
         self.lw_msg = None
         self.lw_qos = 0
         self.lw_retain = False
+        self._sbuf = None
+        self._rbuf = None
+        if buffer_size:
+            self._sbuf = memoryview(bytearray(buffer_size))
+            self._rbuf = memoryview(bytearray(buffer_size))
+            self._byte = memoryview(bytearray(1))
 
     def _send_str(self, s):
         self.sock.write(struct.pack("!H", len(s)))
         self.sock.write(s)
 
+    def _read_into(self, buf, n):
+        # Blocking: fills buf[:n] without allocating a bytes object
+        got = 0
+        while got < n:
+            r = self.sock.readinto(buf[got:n])
+            if not r:
+                raise OSError(-1)
+            got += r
+
+    def _read_byte(self):
+        if self._rbuf is None:
+            return self.sock.read(1)[0]
+        self._read_into(self._byte, 1)
+        return self._byte[0]
+
     def _recv_len(self):
         n = 0
         sh = 0
         while 1:
-            b = self.sock.read(1)[0]
+            b = self._read_byte()
             n |= (b & 0x7f) << sh
             if not b & 0x80:
                 return n
@@ -107,12 +133,13 @@ class MQTTClient:
         self.sock.write(b"\xc0\0")
 
     def publish(self, topic, msg, retain=False, qos=0):
-        pkt = bytearray(b"\x30\0\0\0")
-        pkt[0] |= qos << 1 | retain
+        pkt = self._sbuf if self._sbuf is not None else bytearray(b"\x30\0\0\0")
+        pkt[0] = 0x30 | qos << 1 | retain
         sz = 2 + len(topic) + len(msg)
         if qos > 0:
             sz += 2
         assert sz < 2097152
+        total = sz
         i = 1
         while sz > 0x7f:
             pkt[i] = (sz & 0x7f) | 0x80
@@ -120,14 +147,34 @@ class MQTTClient:
             i += 1
         pkt[i] = sz
         #print(hex(len(pkt)), hexlify(pkt, ":"))
-        self.sock.write(pkt, i + 1)
-        self._send_str(topic)
-        if qos > 0:
-            self.pid += 1
-            pid = self.pid
-            struct.pack_into("!H", pkt, 0, pid)
-            self.sock.write(pkt, 2)
-        self.sock.write(msg)
+        if self._sbuf is not None and i + 1 + total <= len(pkt):
+            # Whole packet in the send buffer, sent in one write
+            if isinstance(topic, str):
+                topic = topic.encode()
+            if isinstance(msg, str):
+                msg = msg.encode()
+            pos = i + 1
+            struct.pack_into("!H", pkt, pos, len(topic))
+            pos += 2
+            pkt[pos:pos + len(topic)] = topic
+            pos += len(topic)
+            if qos > 0:
+                self.pid += 1
+                pid = self.pid
+                struct.pack_into("!H", pkt, pos, pid)
+                pos += 2
+            pkt[pos:pos + len(msg)] = msg
+            pos += len(msg)
+            self.sock.write(pkt[:pos])
+        else:
+            self.sock.write(pkt, i + 1)
+            self._send_str(topic)
+            if qos > 0:
+                self.pid += 1
+                pid = self.pid
+                struct.pack_into("!H", pkt, 0, pid)
+                self.sock.write(pkt, 2)
+            self.sock.write(msg)
         if qos == 1:
             while 1:
                 op = self.wait_msg()
@@ -165,6 +212,8 @@ class MQTTClient:
     # set by .set_callback() method. Other (internal) MQTT
     # messages processed internally.
     def wait_msg(self):
+        if self._rbuf is not None:
+            return self._wait_msg_buffered()
         res = self.sock.read(1)
         self.sock.setblocking(True)
         if res is None:
@@ -174,7 +223,7 @@ class MQTTClient:
         if res == b"\xd0":  # PINGRESP
             sz = self.sock.read(1)[0]
             assert sz == 0
-            return None
+            return 0xd0
         op = res[0]
         if op & 0xf0 != 0x30:
             return op
@@ -195,10 +244,48 @@ class MQTTClient:
             self.sock.write(pkt)
         elif op & 6 == 4:
             assert 0
+        return op
+
+    # wait_msg for the buffered mode: the topic is copied (it is short and callers
+    # compare it), the message is passed as a memoryview into the receive buffer.
+    def _wait_msg_buffered(self):
+        res = self.sock.readinto(self._byte)
+        self.sock.setblocking(True)
+        if res is None:
+            return None
+        if res == 0:
+            raise OSError(-1)
+        op = self._byte[0]
+        if op == 0xd0:  # PINGRESP
+            sz = self._read_byte()
+            assert sz == 0
+            return op
+        if op & 0xf0 != 0x30:
+            return op
+        sz = self._recv_len()
+        if sz <= len(self._rbuf):
+            pkt = self._rbuf
+            self._read_into(pkt, sz)
+        else:
+            pkt = memoryview(self.sock.read(sz))  # Bigger than the buffer
+        topic_len = pkt[0] << 8 | pkt[1]
+        topic = bytes(pkt[2:2 + topic_len])
+        pos = 2 + topic_len
+        if op & 6:
+            pid = pkt[pos] << 8 | pkt[pos + 1]
+            pos += 2
+        self.cb(topic, pkt[pos:sz])
+        if op & 6 == 2:
+            struct.pack_into("!BBH", self._sbuf, 0, 0x40, 0x02, pid)
+            self.sock.write(self._sbuf[:4])
+        elif op & 6 == 4:
+            assert 0
+        return op
 
     # Checks whether a pending message from server is available.
     # If not, returns immediately with None. Otherwise, does
-    # the same processing as wait_msg.
+    # the same processing as wait_msg and returns the packet type,
+    # so callers can drain everything already received.
     def check_msg(self):
         self.sock.setblocking(False)
         return self.wait_msg()
@@ -23,8 +23,14 @@ SET_PRECHARGE = const(0xD9)
 SET_VCOM_DESEL = const(0xDB)
 SET_CHARGE_PUMP = const(0x8D)
 
+CLEAN = const(0xFF)  # Dirty column start of a page with nothing to send
+
 # Subclassing FrameBuffer provides support for graphics primitives
 # http://docs.micropython.org/en/latest/pyboard/library/framebuf.html
+#
+# The drawing methods below also record which columns of which 8-pixel pages they touched, so
+# show() only sends those windows instead of the whole 1 KB buffer. Code that writes to
+# self.buffer directly must call mark_dirty() or invalidate() afterwards.
 class SSD1306(framebuf.FrameBuffer):
     def __init__(self, width, height, external_vcc):
         self.width = width
@@ -32,6 +38,8 @@ class SSD1306(framebuf.FrameBuffer):
         self.external_vcc = external_vcc
         self.pages = self.height // 8
         self.buffer = bytearray(self.pages * self.width)
+        self.dirty_x0 = bytearray([CLEAN]) * self.pages  # Per page: first and last changed column
+        self.dirty_x1 = bytearray(self.pages)
         super().__init__(self.buffer, self.width, self.height, framebuf.MONO_VLSB)
         self.init_display()
 
@@ -89,20 +97,133 @@ class SSD1306(framebuf.FrameBuffer):
     def invert(self, invert):
         self.write_cmd(SET_NORM_INV | (invert & 1))
 
+    # Dirty tracking
+    def mark_dirty(self, x, y, w, h):
+        x0 = max(x, 0)
+        x1 = min(x + w, self.width) - 1
+        y1 = min(y + h, self.height) - 1
+        if x0 > x1 or y1 < 0:
+            return
+        for page in range(max(y, 0) >> 3, (y1 >> 3) + 1):
+            if x0 < self.dirty_x0[page]:
+                self.dirty_x0[page] = x0
+            if x1 > self.dirty_x1[page]:
+                self.dirty_x1[page] = x1
+
+    def invalidate(self):
+        self.mark_dirty(0, 0, self.width, self.height)
+
+    def fill(self, c):
+        super().fill(c)
+        self.invalidate()
+
+    def pixel(self, x, y, *c):
+        if not c:
+            return super().pixel(x, y)
+        super().pixel(x, y, c[0])
+        self.mark_dirty(x, y, 1, 1)
+
+    def hline(self, x, y, w, c):
+        super().hline(x, y, w, c)
+        self.mark_dirty(x, y, w, 1)
+
+    def vline(self, x, y, h, c):
+        super().vline(x, y, h, c)
+        self.mark_dirty(x, y, 1, h)
+
+    def line(self, x1, y1, x2, y2, c):
+        super().line(x1, y1, x2, y2, c)
+        self.mark_dirty(min(x1, x2), min(y1, y2), abs(x2 - x1) + 1, abs(y2 - y1) + 1)
+
+    def rect(self, x, y, w, h, c, *f):
+        super().rect(x, y, w, h, c, *f)
+        self.mark_dirty(x, y, w, h)
+
+    def fill_rect(self, x, y, w, h, c):
+        super().fill_rect(x, y, w, h, c)
+        self.mark_dirty(x, y, w, h)
+
+    def ellipse(self, x, y, xr, yr, c, *args):
+        super().ellipse(x, y, xr, yr, c, *args)
+        self.mark_dirty(x - xr, y - yr, 2 * xr + 1, 2 * yr + 1)
+
+    def poly(self, x, y, coords, c, *f):
+        super().poly(x, y, coords, c, *f)
+        self.invalidate()
+
+    def text(self, s, x, y, *c):
+        super().text(s, x, y, *c)
+        self.mark_dirty(x, y, 8 * len(s), 8)
+
+    def blit(self, fbuf, x, y, *args):
+        super().blit(fbuf, x, y, *args)
+        self.invalidate()  # The source size is not readable from a FrameBuffer
+
+    def scroll(self, xstep, ystep):
+        super().scroll(xstep, ystep)
+        self.invalidate()
+
     def show(self):
-        x0 = 0
-        x1 = self.width - 1
-        if self.width == 64:
-            # displays with width of 64 pixels are shifted by 32
-            x0 += 32
-            x1 += 32
+        """ Sends the changed part of the buffer: one window per run of consecutive dirty pages,
+        as wide as the widest change in the run. """
+        x0s, x1s = self.dirty_x0, self.dirty_x1
+        page = 0
+        while page < self.pages:
+            if x0s[page] > x1s[page]:
+                page += 1
+                continue
+            first, x0, x1 = page, x0s[page], x1s[page]
+            while page + 1 < self.pages and x0s[page + 1] <= x1s[page + 1]:
+                page += 1
+                x0 = min(x0, x0s[page])
+                x1 = max(x1, x1s[page])
+            self.show_window(x0, x1, first, page)
+            page += 1
+        for page in range(self.pages):
+            x0s[page] = CLEAN
+            x1s[page] = 0
+
+    def show_window(self, x0, x1, page0, page1):
+        offset = 32 if self.width == 64 else 0  # displays with width of 64 pixels are shifted by 32
         self.write_cmd(SET_COL_ADDR)
-        self.write_cmd(x0)
-        self.write_cmd(x1)
+        self.write_cmd(x0 + offset)
+        self.write_cmd(x1 + offset)
         self.write_cmd(SET_PAGE_ADDR)
-        self.write_cmd(0)
-        self.write_cmd(self.pages - 1)
-        self.write_data(self.buffer)
+        self.write_cmd(page0)
+        self.write_cmd(page1)
+        buf = memoryview(self.buffer)
+        if x0 == 0 and x1 == self.width - 1:
+            self.write_data(buf[page0 * self.width:(page1 + 1) * self.width])
+        else:
+            # The controller wraps to column x0 of the next page after x1
+            self.write_pages([buf[page * self.width + x0:page * self.width + x1 + 1]
+                              for page in range(page0, page1 + 1)])
+
+    def write_pages(self, bufs):
+        for buf in bufs:
+            self.write_data(buf)
+
+
+class TextField:
+    """ A fixed-width text value on the display. update() redraws it only when the value
+    changed, so unchanged values cost neither formatting nor I2C traffic. """
+
+    def __init__(self, display, x, y, chars, fmt="{}"):
+        self.display = display
+        self.x = x
+        self.y = y
+        self.chars = chars
+        self.fmt = fmt
+        self.value = self  # Never equal to a real value, so the first update() draws
+
+    def update(self, value):
+        """ Draws value if it changed; returns whether the display needs a show(). """
+        if value == self.value:
+            return False
+        self.value = value
+        self.display.fill_rect(self.x, self.y, 8 * self.chars, 8, 0)
+        self.display.text(self.fmt.format(value)[:self.chars], self.x, self.y, 1)
+        return True
 
 
 class SSD1306_I2C(SSD1306):
@@ -122,6 +243,10 @@ class SSD1306_I2C(SSD1306):
         self.write_list[1] = buf
         self.i2c.writevto(self.addr, self.write_list)
 
+    def write_pages(self, bufs):
+        bufs.insert(0, b"\x40")  # One I2C transaction for the whole window
+        self.i2c.writevto(self.addr, bufs)
+
 
 class SSD1306_SPI(SSD1306):
     def __init__(self, width, height, spi, dc, res, cs, external_vcc=False):
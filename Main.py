@@ -4,15 +4,28 @@ from app.data_store import add_sensor_data
 from app.layout import create_layout
 from app.mqtt_client import start_mqtt
 from app.callbacks import register_callbacks
+from app.export import register_export_routes
+from app.metrics import instrument_callbacks, register_metrics_routes
+from app.live import register_live_routes
 import sys
 
 
 print("Python Path:", sys.path)
 # Set up the layout
-app.layout = create_layout()
+app.layout = create_layout  # Rebuilt per page load so new tabs list every known board
 
 # Register the callbacks
 register_callbacks(app)
+instrument_callbacks(app)
+
+# Streaming data export routes
+register_export_routes(app.server)
+
+# Prometheus metrics and callback profiling
+register_metrics_routes(app.server)
+
+# Push channel for live updates (see app/assets/live.js)
+register_live_routes(app.server)
 
 if __name__ == '__main__':
     # Start MQTT in a separate thread
@@ -0,0 +1,262 @@
+import heapq
+import io
+import os
+import re
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as pads
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+except ImportError:  # Optional: only needed for Parquet/Arrow export and the cold archive
+    pa = None
+
+ARCHIVE_COMPRESSION = 'zstd'
+_ARCHIVE_NAME = re.compile(r"^sensor_data_(\d+)_(\d+)(?:_\d+)?\.parquet$")
+
+
+def require_pyarrow():
+    if pa is None:
+        raise RuntimeError("pyarrow is not installed; run 'pip install pyarrow' for Parquet/Arrow support")
+
+
+def arrow_schema(columns):
+    types = {'id': pa.int64(), 'ts_ms': pa.int64(), 'timestamp': pa.string(), 'device_id': pa.string()}
+    return pa.schema([(name, types.get(name, pa.float64())) for name in columns])
+
+
+def rows_to_batch(rows, schema):
+    """ Converts a list of row tuples (as returned by a SQLite cursor) to an Arrow record batch. """
+    columns = list(zip(*rows)) if rows else [()] * len(schema)
+    return pa.RecordBatch.from_arrays(
+        [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema)
+
+
+class _ChunkSink(io.RawIOBase):
+    """ Write-only file object that hands written bytes back out, so Arrow writers can stream. """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _stream_chunks(batches, columns, open_writer):
+    require_pyarrow()
+    schema = arrow_schema(columns)
+    sink = _ChunkSink()
+    writer = open_writer(pa.PythonFile(sink, mode='w'), schema)
+    try:
+        for rows in batches:
+            writer.write_batch(rows_to_batch(rows, schema))
+            data = sink.take()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    yield sink.take()
+
+
+def iter_parquet_chunks(batches, columns, compression=ARCHIVE_COMPRESSION):
+    """ Yields Parquet file bytes as they are produced; every row batch becomes one row group. """
+    return _stream_chunks(batches, columns,
+                          lambda sink, schema: pq.ParquetWriter(sink, schema, compression=compression))
+
+
+def iter_arrow_chunks(batches, columns):
+    """ Yields an Arrow IPC file, one record batch per row batch. """
+    return _stream_chunks(batches, columns, ipc.new_file)
+
+
+# ------------------------- Cold Archive -------------------------
+def list_archives(archive_dir):
+    """ Returns (first_ts_ms, last_ts_ms, path) for every archive file, oldest first. """
+    if not os.path.isdir(archive_dir):
+        return []
+    archives = []
+    for name in os.listdir(archive_dir):
+        match = _ARCHIVE_NAME.match(name)
+        if match:
+            archives.append((int(match.group(1)), int(match.group(2)), os.path.join(archive_dir, name)))
+    return sorted(archives)
+
+
+def write_archive(archive_dir, batches, columns):
+    """ Writes row batches (sorted by ts_ms) into a new zstd Parquet file in archive_dir.
+
+    The file is named after its first and last ts_ms so readers can skip it without opening it.
+    Returns (path, row_count), or (None, 0) if there were no rows.
+    """
+    require_pyarrow()
+    os.makedirs(archive_dir, exist_ok=True)
+    schema = arrow_schema(columns)
+    ts_index = columns.index('ts_ms')
+    tmp_path = os.path.join(archive_dir, ".sensor_data.parquet.tmp")
+    first = last = None
+    count = 0
+    with pq.ParquetWriter(tmp_path, schema, compression=ARCHIVE_COMPRESSION) as writer:
+        for rows in batches:
+            writer.write_batch(rows_to_batch(rows, schema))
+            first = rows[0][ts_index] if first is None else first
+            last = rows[-1][ts_index]
+            count += len(rows)
+    if not count:
+        os.remove(tmp_path)
+        return None, 0
+
+    path = os.path.join(archive_dir, f"sensor_data_{first}_{last}.parquet")
+    suffix = 1
+    while os.path.exists(path):
+        path = os.path.join(archive_dir, f"sensor_data_{first}_{last}_{suffix}.parquet")
+        suffix += 1
+    os.replace(tmp_path, path)
+    return path, count
+
+
+def _archive_filter(start_ms, end_ms, device_id):
+    terms = []
+    if start_ms is not None:
+        terms.append(pads.field('ts_ms') >= start_ms)
+    if end_ms is not None:
+        terms.append(pads.field('ts_ms') <= end_ms)
+    if device_id is not None:
+        terms.append(pads.field('device_id') == device_id)
+    expr = None
+    for term in terms:
+        expr = term if expr is None else expr & term
+    return expr
+
+
+def _archive_paths(archive_dir, start_ms, end_ms):
+    """ Returns (first_ts_ms, last_ts_ms, path) of the archive files overlapping the time range. """
+    archives = [(first, last, path) for first, last, path in list_archives(archive_dir)
+                if (start_ms is None or last >= start_ms) and (end_ms is None or first <= end_ms)]
+    if archives and pa is None:
+        print("Warning: archived data skipped because pyarrow is not installed.")
+        return []
+    return archives
+
+
+def _table_names(columns, device_id):
+    return list(dict.fromkeys(list(columns) + ['ts_ms'] + (['device_id'] if device_id is not None else [])))
+
+
+def _iter_file_tables(path, names, start_ms, end_ms, device_id, defaults, newest_first=False):
+    """ Yields one Arrow table of `names` per row group of an archive file, restricted to the time
+    range and device. The filters go to the Parquet reader, which skips row groups whose
+    statistics rule them out without reading them.
+
+    Columns missing from older archive files are filled in from `defaults`.
+    """
+    fragment = next(pads.dataset(path, format='parquet').get_fragments())
+    available = set(fragment.physical_schema.names)
+    if device_id is not None and 'device_id' not in available:
+        # Written before device_id existed: every row belongs to the default board
+        if (defaults or {}).get('device_id') != device_id:
+            return
+        device_id = None
+    expr = _archive_filter(start_ms, end_ms, device_id)
+    schema = arrow_schema(names)
+    groups = fragment.split_by_row_group(expr)
+    for group in (reversed(groups) if newest_first else groups):
+        table = group.to_table(columns=[name for name in names if name in available], filter=expr)
+        if not table.num_rows:
+            continue
+        for name in names:
+            if name not in available:
+                field = schema.field(name)
+                fill = (defaults or {}).get(name)
+                table = table.append_column(field, pa.array([fill] * table.num_rows, field.type))
+        yield table.select(names)
+
+
+def _iter_archive_tables(archive_dir, columns, start_ms, end_ms, device_id, defaults):
+    """ Yields one Arrow table per archive row group in the time range and device, oldest first. """
+    names = _table_names(columns, device_id)
+    for _, _, path in _archive_paths(archive_dir, start_ms, end_ms):
+        yield from _iter_file_tables(path, names, start_ms, end_ms, device_id, defaults)
+
+
+def _newest_archive_tables(archive_dir, columns, start_ms, end_ms, device_id, defaults, limit):
+    """ Returns archive row groups holding the newest `limit` rows in the time range and device.
+
+    Files and their row groups (each sorted by ts_ms) are read newest first, and reading stops
+    as soon as nothing left can be newer than the `limit` newest rows read so far.
+    """
+    names = _table_names(columns, device_id)
+    tables, newest = [], []  # newest: ts_ms of the newest `limit` rows read so far, descending
+    archives = _archive_paths(archive_dir, start_ms, end_ms)
+    for _, last, path in sorted(archives, key=lambda archive: archive[1], reverse=True):
+        if len(newest) == limit and last < newest[-1]:
+            break  # This file and the ones left all end before the rows already found
+        for table in _iter_file_tables(path, names, start_ms, end_ms, device_id, defaults, newest_first=True):
+            tables.append(table)
+            ts = table.column('ts_ms')
+            newest = heapq.nlargest(limit, newest + ts.to_pylist())
+            if len(newest) == limit and newest[-1] >= pc.min(ts).as_py():
+                break  # The file's earlier row groups are all older
+    return tables
+
+
+def read_archive_rows(archive_dir, columns, start_ms=None, end_ms=None, device_id=None, defaults=None,
+                      limit=None):
+    """ Returns archived rows in [start_ms, end_ms] as tuples of `columns`, ordered by ts_ms;
+    only the newest `limit` of them if a limit is given, reading no more of the archive than that needs.
+
+    Returns an empty list when there is no archive (or pyarrow is not installed).
+    """
+    if limit is None:
+        tables = list(_iter_archive_tables(archive_dir, columns, start_ms, end_ms, device_id, defaults))
+    elif limit > 0:
+        tables = _newest_archive_tables(archive_dir, columns, start_ms, end_ms, device_id, defaults, limit)
+    else:
+        tables = []
+    if not tables:
+        return []
+    table = pa.concat_tables(tables).sort_by([('ts_ms', 'ascending')])
+    if limit is not None:
+        table = table.slice(max(0, table.num_rows - limit))
+    return list(zip(*[table.column(name).to_pylist() for name in columns]))
+
+
+def iter_archive_batches(archive_dir, columns, start_ms=None, end_ms=None, device_id=None, defaults=None,
+                         batch_size=5000):
+    """ Yields archived rows in [start_ms, end_ms] as lists of tuples, at most batch_size at a time. """
+    for table in _iter_archive_tables(archive_dir, columns, start_ms, end_ms, device_id, defaults):
+        for batch in table.to_batches(max_chunksize=batch_size):
+            yield list(zip(*[batch.column(table.schema.get_field_index(name)).to_pylist() for name in columns]))
+
+
+def delete_archive_range(archive_dir, start_ms=None, end_ms=None):
+    """ Removes archived rows in [start_ms, end_ms) (all of them if no range), rewriting files
+    that only partly overlap. Returns the number of rows removed. """
+    removed = 0
+    for first, last, path in list_archives(archive_dir):
+        if start_ms is not None and (last < start_ms or first >= end_ms):
+            continue
+        if start_ms is None or (first >= start_ms and last < end_ms):
+            if pa is not None:
+                removed += pq.ParquetFile(path).metadata.num_rows
+            os.remove(path)
+            continue
+        require_pyarrow()
+        table = pq.read_table(path)
+        ts = table.column('ts_ms').to_numpy()
+        keep = (ts < start_ms) | (ts >= end_ms)
+        removed += int((~keep).sum())
+        tmp_path = path + ".tmp"
+        pq.write_table(table.filter(pa.array(keep)), tmp_path, compression=ARCHIVE_COMPRESSION)
+        os.replace(tmp_path, path)
+    return removed
@@ -0,0 +1,87 @@
+/*
+ * Live updates: listens to the server's /live event stream (app/live.py) and wakes only the
+ * Dash callbacks that have new work, through the live-* stores in app/layout.py. While the
+ * stream is connected the update-interval polling is switched off, so an idle dashboard makes
+ * no requests; if the stream drops, polling resumes until EventSource reconnects.
+ */
+(function () {
+    var THROTTLE_MS = 200;  // At most one refresh per store in this window; later events are merged
+    var lastFired = {};
+    var pending = {};
+
+    function setProps(id, props) {
+        var clientside = window.dash_clientside;
+        if (clientside && clientside.set_props) {
+            clientside.set_props(id, props);
+        }
+    }
+
+    function fire(key, id) {
+        var wait = (lastFired[key] || 0) + THROTTLE_MS - Date.now();
+        if (wait <= 0) {
+            lastFired[key] = Date.now();
+            setProps(id, {data: lastFired[key]});
+        } else if (!pending[key]) {
+            pending[key] = setTimeout(function () {
+                pending[key] = null;
+                lastFired[key] = Date.now();
+                setProps(id, {data: lastFired[key]});
+            }, wait);
+        }
+    }
+
+    function panelDevices() {
+        // Graphs with dict ids render them as JSON, e.g. {"device":"board1","sensor":"...","type":"sensor-chart"}
+        var devices = {};
+        document.querySelectorAll('.sensor-chart').forEach(function (graph) {
+            try {
+                devices[JSON.parse(graph.id).device] = true;
+            } catch (e) { /* not a board chart */ }
+        });
+        return devices;
+    }
+
+    function fireReadings(device) {
+        // Boards without a panel yet are picked up by the 'device' event
+        if (panelDevices()[device]) {
+            fire('readings:' + device, {type: 'live-data', device: device});
+        }
+    }
+
+    function catchUp() {
+        // Notifications sent while the stream was down are lost: refresh everything once
+        Object.keys(panelDevices()).forEach(fireReadings);
+        ['live-devices', 'live-reset', 'live-debug', 'live-ota', 'live-script'].forEach(function (id) {
+            fire(id, id);
+        });
+    }
+
+    function connect() {
+        var source = new EventSource('/live');
+        source.onopen = function () {
+            setProps('update-interval', {disabled: true});
+            catchUp();
+        };
+        source.onerror = function () {
+            setProps('update-interval', {disabled: false});  // EventSource retries by itself
+        };
+        source.addEventListener('readings', function (event) {
+            fireReadings(JSON.parse(event.data).device);
+        });
+        source.addEventListener('device', function () { fire('live-devices', 'live-devices'); });
+        source.addEventListener('reset', function () { fire('live-reset', 'live-reset'); });
+        source.addEventListener('debug', function () { fire('live-debug', 'live-debug'); });
+        source.addEventListener('ota', function () { fire('live-ota', 'live-ota'); });
+        source.addEventListener('script', function () { fire('live-script', 'live-script'); });
+    }
+
+    // set_props needs the rendered layout, so wait for it before connecting
+    var waitForLayout = setInterval(function () {
+        if (document.getElementById('device-panels')) {
+            clearInterval(waitForLayout);
+            if (window.EventSource) {
+                connect();
+            }
+        }
+    }, 100);
+})();
@@ -1,78 +1,206 @@
-import pandas as pd
 import io
-import json
 import base64
-from dash import dcc, callback_context, exceptions
-from dash.dependencies import Input, Output, State
+from urllib.parse import urlencode
+from dash import dcc, callback_context, exceptions, no_update, Patch
+from dash.dependencies import Input, Output, State, MATCH, ALL
 from plotly.graph_objs import Scatter, Figure
-from app.data_store import get_sensor_data, clear_in_memory_data, clear_database, clear_year_data
-from app.mqtt_client import send_code_to_esp32, client, MQTT_TOPIC_CODE, MQTT_TOPIC_DEBUG,debug_messages
+from app.data_store import (get_sensor_columns, get_recent_columns, get_sensor_series, get_latest_id,
+                            get_data_version, list_devices,
+                            clear_in_memory_data, clear_database, clear_year_data)
+from app.downsample import downsample
+from app.layout import CHARTS, create_device_panel
+from app.mqtt_client import client, MQTT_TOPIC_CODE, MQTT_TOPIC_DEBUG,debug_messages, script_status, stop_script
+from app.ota_jobs import submit_ota_job, list_jobs, JOB_DELIVERED, JOB_FAILED, TRANSFER_DELTA, TRANSFER_UNCHANGED
+from app.precompile import ScriptSyntaxError, compile_script
 from dash import html
 
+CHART_DEFAULT_WIDTH = 600     # px, used until the browser reports the real chart width
+CHART_POINTS_PER_PIXEL = 1.0  # Rendered points per horizontal pixel
+CHART_MIN_POINTS = 100
+CHART_MAX_POINTS = 4000
+CHART_DOWNSAMPLE_METHOD = 'lttb'  # or 'minmax'
+
+CHART_INFO = {sensor: (title, name) for sensor, title, name in CHARTS}
+
+
+def _point_budget(width):
+    """ Max points worth sending to a chart that is `width` pixels wide. """
+    points = int((width or CHART_DEFAULT_WIDTH) * CHART_POINTS_PER_PIXEL)
+    return min(max(points, CHART_MIN_POINTS), CHART_MAX_POINTS)
+
+
+def _relayout_range(relayout):
+    """ Extracts the x-axis range from a plotly relayoutData event.
+
+    Returns [start, end] after a zoom/pan, None after an autorange reset, or False if the
+    event did not touch the x-axis.
+    """
+    if not relayout:
+        return False
+    if relayout.get('xaxis.autorange'):
+        return None
+    if 'xaxis.range[0]' in relayout and 'xaxis.range[1]' in relayout:
+        return [relayout['xaxis.range[0]'], relayout['xaxis.range[1]']]
+    if 'xaxis.range' in relayout:
+        return list(relayout['xaxis.range'][:2])
+    return False
+
+
 def register_callbacks(app):
+    # ------------------------- Device Panels Callback -------------------------
+    @app.callback(
+        Output('device-panels', 'children'),
+        Output('known-devices', 'data'),
+        Input('update-interval', 'n_intervals'),
+        Input('live-devices', 'data'),
+        State('known-devices', 'data')
+    )
+    def add_device_panels(n, live, known):
+        """ Appends a chart panel for every board that has started publishing since the page loaded. """
+        known = known or []
+        devices = list_devices()
+        new_devices = [device_id for device_id in devices if device_id not in known]
+        if not new_devices:
+            raise exceptions.PreventUpdate
+        if not known:
+            # Replaces the "waiting for boards" placeholder
+            return [create_device_panel(device_id) for device_id in new_devices], devices
+        panels = Patch()  # Leaves the existing panels (and their charts) untouched
+        for device_id in new_devices:
+            panels.append(create_device_panel(device_id))
+        return panels, known + new_devices
+
     # ------------------------- Sensor Data Update Callback -------------------------
+    # Reads the rendered chart width in the browser so the server knows its point budget
+    app.clientside_callback(
+        """
+        function(n, known, current) {
+            var graph = document.querySelector('.sensor-chart');
+            var width = graph ? graph.offsetWidth : null;
+            return (width && width !== current) ? width : window.dash_clientside.no_update;
+        }
+        """,
+        Output('chart-width', 'data'),
+        Input('update-interval', 'n_intervals'),
+        Input('known-devices', 'data'),
+        State('chart-width', 'data')
+    )
+
     @app.callback(
-        [
-            Output('dht11-temp-chart', 'figure'),
-            Output('dht11-humidity-chart', 'figure'),
-            Output('ds18b20-temp-chart', 'figure'),
-            Output('light-intensity-chart', 'figure')
-        ],
-        Input('update-interval', 'n_intervals')
+        Output({'type': 'sensor-chart', 'device': MATCH, 'sensor': ALL}, 'figure'),
+        Output({'type': 'sensor-chart', 'device': MATCH, 'sensor': ALL}, 'extendData'),
+        Output({'type': 'chart-cursor', 'device': MATCH}, 'data'),
+        Input('update-interval', 'n_intervals'),
+        Input({'type': 'live-data', 'device': MATCH}, 'data'),
+        Input('live-reset', 'data'),
+        Input({'type': 'sensor-chart', 'device': MATCH, 'sensor': ALL}, 'relayoutData'),
+        State({'type': 'chart-cursor', 'device': MATCH}, 'data'),
+        State('chart-width', 'data')
     )
-    def update_charts(n):
-        """ Fetches and updates sensor data charts in real time. """
-        data = get_sensor_data()
+    def update_charts(n, live, reset, relayouts, cursor, width):
+        """ Fetches and updates one board's sensor charts in real time (called once per board,
+        when the /live stream reports new readings for it, or on the fallback interval).
 
-        if not data:
+        A full redraw downsamples the visible time range (all history by default) to the chart
+        width. If that drew every raw reading, later rows past the tab's cursor are appended via
+        extendData until the appended points exceed the budget; a chart drawn from rollups or
+        downsampled points is redrawn instead, so one trace never mixes resolutions.
+        """
+        ctx = callback_context
+        device_id = ctx.outputs_list[2]['id']['device']
+        sensors = [output['id']['sensor'] for output in ctx.outputs_list[0]]
+        budget = _point_budget(width)
+        version = get_data_version(device_id)
+        cursor = cursor or {}
+        visible_range = cursor.get('range')
+
+        triggered = ctx.triggered_id
+        if isinstance(triggered, dict) and triggered['type'] == 'sensor-chart':
+            new_range = _relayout_range(relayouts[sensors.index(triggered['sensor'])])
+            if new_range is False:
+                raise exceptions.PreventUpdate
+            visible_range = new_range
+        elif cursor.get('version') == version and cursor.get('last_id') is not None and cursor.get('raw'):
+            # New rows normally come straight from the in-memory ring buffer
+            rows = get_recent_columns(device_id, after_id=cursor['last_id'], limit=budget + 1)
+            if rows is None:
+                rows = get_sensor_columns(after_id=cursor['last_id'], limit=budget + 1, device_id=device_id)
+            if not len(rows['id']):
+                raise exceptions.PreventUpdate
+            appended = cursor.get('appended', 0) + len(rows['id'])
+            if appended <= budget:
+                timestamps = rows['ts_ms'].astype('datetime64[ms]')
+                extend = [
+                    (dict(x=[timestamps], y=[rows[sensor]]), [0], 2 * budget)
+                    for sensor in sensors
+                ]
+                new_cursor = dict(cursor, last_id=int(rows['id'][-1]), appended=appended)
+                return [no_update] * len(sensors), extend, new_cursor
+            # Too many raw points appended since the last redraw: redraw below
+
+        start, end = visible_range if visible_range else (None, None)
+        # Taken before the query: a row landing in between may be drawn twice, but never missed
+        last_id = get_latest_id()
+        data = get_sensor_series(start=start, end=end, max_points=budget, device_id=device_id)
+        no_extend = [no_update] * len(sensors)
+        new_cursor = {'version': version, 'range': visible_range, 'appended': 0, 'last_id': last_id,
+                      'raw': data['resolution'] == 'raw'}
+
+        if not len(data['ts_ms']):
             empty_fig = Figure()
             empty_fig.update_layout(title="No Data Available", xaxis_title="Time", yaxis_title="Value")
-            return empty_fig, empty_fig, empty_fig, empty_fig
-
-        timestamps = [entry['timestamp'] for entry in data]
-        temp_dht11 = [entry['temp_dht11'] for entry in data]
-        hum_dht11 = [entry['hum_dht11'] for entry in data]
-        temp_ds18b20 = [entry['temp_ds18b20'] for entry in data]
-        light_intensity = [entry['light_intensity'] for entry in data]
+            return [empty_fig] * len(sensors), no_extend, new_cursor
 
         try:
-            return (
-                Figure(data=[Scatter(x=timestamps, y=temp_dht11, mode='lines+markers', name='DHT11 Temp (°C)')],
-                       layout_title_text="DHT11 Temperature"),
-                Figure(data=[Scatter(x=timestamps, y=hum_dht11, mode='lines+markers', name='DHT11 Humidity (%)')],
-                       layout_title_text="DHT11 Humidity"),
-                Figure(data=[Scatter(x=timestamps, y=temp_ds18b20, mode='lines+markers', name='DS18B20 Temp (°C)')],
-                       layout_title_text="DS18B20 Temperature"),
-                Figure(data=[Scatter(x=timestamps, y=light_intensity, mode='lines+markers', name='Light Intensity')],
-                       layout_title_text="Light Intensity"),
-            )
+            figures = []
+            for sensor in sensors:
+                title, name = CHART_INFO[sensor]
+                # Downsampling stage: keeps the rendered point count bounded by the chart width
+                idx = downsample(data['ts_ms'], data[sensor], budget, CHART_DOWNSAMPLE_METHOD)
+                if len(idx) < len(data['ts_ms']):
+                    new_cursor['raw'] = False  # Appending raw rows would mix in undownsampled points
+                x = data['ts_ms'][idx].astype('datetime64[ms]')
+                traces = [Scatter(x=x, y=data[sensor][idx], mode='lines+markers', name=name)]
+                if data['resolution'] != 'raw':
+                    # Rollups average each bucket, so show the min/max envelope to keep the peaks
+                    traces += [
+                        Scatter(x=x, y=data[f"{sensor}_max"][idx], mode='lines', line=dict(width=0),
+                                showlegend=False, hoverinfo='skip'),
+                        Scatter(x=x, y=data[f"{sensor}_min"][idx], mode='lines', line=dict(width=0),
+                                fill='tonexty', showlegend=False, hoverinfo='skip'),
+                    ]
+                figures.append(Figure(
+                    data=traces,
+                    layout=dict(title_text=f"{title} ({data['resolution']})" if data['resolution'] != 'raw'
+                                else title, uirevision=f"{device_id}-{sensor}")))
+            return figures, no_extend, new_cursor
         except Exception as e:
             print(f"Error updating charts: {e}")
             empty_fig = Figure()
             empty_fig.update_layout(title="Error Loading Data", xaxis_title="Time", yaxis_title="Value")
-            return empty_fig, empty_fig, empty_fig, empty_fig
+            return [empty_fig] * len(sensors), no_extend, None
 
     # ------------------------- Data Download Callbacks -------------------------
     @app.callback(
-        Output("download-datafile", "data"),
-        [Input("download-csv-button", "n_clicks"),
-         Input("download-json-button", "n_clicks")],
-        prevent_initial_call=True
+        [Output("download-csv-button", "href"),
+         Output("download-json-button", "href"),
+         Output("download-parquet-button", "href")],
+        [Input("download-range", "start_date"),
+         Input("download-range", "end_date"),
+         Input("download-gzip", "value")]
     )
-    def download_data(n_csv, n_json):
-        """ Allows users to download sensor data as CSV or JSON. """
-        ctx = callback_context
-        if not ctx.triggered:
-            raise exceptions.PreventUpdate
-
-        data = get_sensor_data()
-        df = pd.DataFrame(data)
-        triggered_id = ctx.triggered[0]['prop_id'].split('.')[0]
-
-        if triggered_id == "download-csv-button":
-            return dcc.send_data_frame(df.to_csv, "sensor_data.csv", index=False)
-        elif triggered_id == "download-json-button":
-            return dcc.send_bytes(json.dumps(data, indent=2).encode(), "sensor_data.json")
+    def update_download_links(start_date, end_date, use_gzip):
+        """ Points the download buttons at the streaming export routes for the chosen range. """
+        params = {}
+        if start_date:
+            params['start'] = start_date[:10]
+        if end_date:
+            params['end'] = end_date[:10] + " 23:59:59.999"  # Include the whole end day
+        if use_gzip:
+            params['gzip'] = 1
+        query = "?" + urlencode(params) if params else ""
+        return (f"/export/sensor_data.csv{query}", f"/export/sensor_data.ndjson{query}",
+                f"/export/sensor_data.parquet{query}")
 
     # ------------------------- Data Clearing Callbacks -------------------------
     @app.callback(
@@ -104,9 +232,10 @@ def register_callbacks(app):
     # ------------------------- Code Upload & MQTT OTA Callback -------------------------
     @app.callback(
         Output("debug-output", "children"),
-        [Input("update-interval", "n_intervals")]
+        [Input("update-interval", "n_intervals"),
+         Input("live-debug", "data")]
     )
-    def update_debug_output(n_intervals):
+    def update_debug_output(n_intervals, live):
         if debug_messages:
             latest_messages = list(debug_messages)[-10:]  # display last 5 clearly
             formatted_messages = [html.Div(msg) for msg in reversed(latest_messages)]
@@ -127,10 +256,82 @@ def register_callbacks(app):
             content_type, content_string = contents.split(',')
             decoded = base64.b64decode(content_string).decode('utf-8')
 
-            # ✅ Pass both filename and decoded code string
-            send_code_to_esp32(filename, decoded)
+            # Syntax errors are reported here, before anything is sent; boards get .mpy bytecode
+            # when mpy-cross is installed
+            target, data = compile_script(filename, decoded)
+            fallback = (filename, decoded.encode('utf-8')) if target != filename else None
 
-            return f"✅ {filename} sent to ESP32S3 via OTA"
+            # ✅ Queued for the OTA worker; the job list below reports delivery
+            job_id = submit_ota_job(target, data, fallback)
+
+            return f"⏳ {target} queued for OTA as job #{job_id}"
+        except ScriptSyntaxError as e:
+            return f"❌ {filename} not sent, it does not compile: {e}"
         except Exception as e:
             return f"❌ Error sending code: {e}"
 
+    @app.callback(
+        Output("ota-jobs", "children"),
+        Input("update-interval", "n_intervals"),
+        Input("live-ota", "data")
+    )
+    def update_ota_jobs(n_intervals, live):
+        """ Shows the status of the most recent OTA jobs. """
+        jobs = list_jobs(limit=5)
+        if not jobs:
+            raise exceptions.PreventUpdate
+        icons = {JOB_DELIVERED: "✅", JOB_FAILED: "❌"}
+        rows = []
+        for job in jobs:
+            text = f"{icons.get(job['status'], '⏳')} Job #{job['id']}: {job['filename']} ({job['size']} bytes) - {job['status']}"
+            if job['boards']:
+                text += " to " + ", ".join(job['boards'])
+            if job['transfer'] == TRANSFER_UNCHANGED:
+                text += ", unchanged, not resent"
+            elif job['transfer'] == TRANSFER_DELTA:
+                text += f", delta {job['sent']} bytes"
+            if job['chunks'] and job['status'] not in (JOB_DELIVERED, JOB_FAILED):
+                text += f", chunk {job['acked']}/{job['chunks']}"
+            if job['attempts'] > 1:
+                text += f", attempt {job['attempts']}"
+            if job['status'] == JOB_FAILED and job['error']:
+                text += f": {job['error']}"
+            rows.append(html.Div(text))
+        return rows
+
+    @app.callback(
+        Output("stop-script-status", "children"),
+        Input("stop-script-button", "n_clicks"),
+        prevent_initial_call=True
+    )
+    def stop_user_script(n_clicks):
+        """ Asks every board to cancel its running user script. """
+        try:
+            stop_script()
+            return "⏹ Stop sent to the boards"
+        except Exception as e:
+            return f"❌ Error sending stop: {e}"
+
+    @app.callback(
+        Output("script-status", "children"),
+        Input("update-interval", "n_intervals"),
+        Input("live-script", "data")
+    )
+    def update_script_status(n_intervals, live):
+        """ Shows the user-script state each board last reported. """
+        if not script_status:
+            raise exceptions.PreventUpdate
+        icons = {'running': "▶️", 'finished': "✅", 'cancelled': "⏹", 'timeout': "⏱", 'error': "❌", 'stuck': "🔁"}
+        rows = []
+        for device_id, status in sorted(script_status.items()):
+            text = f"{icons.get(status['status'], '❔')} {device_id}: {status.get('filename')} - {status['status']}"
+            if status['status'] == 'running':
+                text += f" ({status.get('mode')}, budget {status.get('budget')} s)"
+                if status.get('cancellable') is False:
+                    text += " - not cancellable"
+            elif status.get('elapsed') is not None:
+                text += f" after {status['elapsed']} s"
+            if status.get('error'):
+                text += f": {status['error']}"
+            rows.append(html.Div(text))
+        return rows
@@ -1,118 +1,1042 @@
+import atexit
+import queue
 import sqlite3
-from datetime import datetime
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 
-DB_NAME = 'sensor_data.db'
+import numpy as np
+
+from app import archive, live, metrics
+from app.ring_buffer import RingBuffer
 
-sensor_data_list = []
+DB_NAME = 'sensor_data.db'
 
 DB_PATH = "sensor_data.db"  # Path to your SQLite database file
 
+# SQLite connection settings, applied to every new connection.
+# WAL lets the chart/export readers and the ingestion writer work without blocking each other.
+DB_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',        # OFF / NORMAL / FULL; NORMAL is durable enough with WAL
+    'cache_size': -16000,           # Negative values are in KiB (~16 MB page cache)
+    'mmap_size': 64 * 1024 * 1024,  # Bytes of the DB file to memory-map for reads
+    'busy_timeout': 5000,           # ms to wait for a lock instead of failing
+    'temp_store': 'MEMORY',
+}
+DB_POOL_SIZE = 8  # Idle connections kept around for reuse
+ARCHIVE_DIR = "archive"  # Parquet files holding readings moved out of sensor_data
+
+# Ingestion writer configuration
+INGEST_QUEUE_SIZE = 10000     # Max messages (single readings or board batches) waiting to be written
+INGEST_BATCH_SIZE = 200       # Commit once this many rows are pending...
+INGEST_FLUSH_INTERVAL = 1.0   # ...or once the oldest pending row is this many seconds old
+INGEST_FULL_POLICY = 'drop_oldest'  # 'block', 'drop_newest' or 'drop_oldest' when the queue is full
+INGEST_BLOCK_TIMEOUT = 0.5    # Max seconds the 'block' policy waits before dropping the row
+INGEST_LATENCY_SAMPLES = 10000  # Newest per-row enqueue-to-commit latencies kept for percentiles
+
+DEFAULT_DEVICE_ID = 'default'  # Device of readings stored before boards were told apart
+HOT_BUFFER_SIZE = 10000  # Newest readings per board kept in memory for the charts
+
+_INSERT_SQL = '''INSERT INTO sensor_data 
+                 (timestamp, temp_dht11, hum_dht11, temp_ds18b20, light_intensity, device_id, ts_ms) 
+                 VALUES (?, ?, ?, ?, ?, ?, ?)'''
+SENSOR_COLUMNS = ('temp_dht11', 'hum_dht11', 'temp_ds18b20', 'light_intensity')
+
+# Rollup tables: (name, bucket width in ms). Each keeps min/max/sum/count per sensor and bucket.
+DAY_MS = 24 * 60 * 60 * 1000
+ROLLUP_RESOLUTIONS = (
+    ('1m', 60 * 1000),
+    ('1h', 60 * 60 * 1000),
+    ('1d', DAY_MS),
+)
+_ROLLUP_STATS = ('min', 'max', 'sum', 'n')
+RAW_OVERSAMPLE = 4  # Raw rows are served up to this multiple of max_points; LTTB then keeps the peaks
+_SELECT_COLUMNS = ('id', 'timestamp', 'device_id') + SENSOR_COLUMNS
+EXPORT_COLUMNS = ('timestamp', 'device_id') + SENSOR_COLUMNS
+_ARCHIVE_DEFAULTS = {'device_id': DEFAULT_DEVICE_ID}  # For archive files written before device_id existed
+
+_EPOCH = datetime(1970, 1, 1)
+
+_ingest_queue = queue.Queue(maxsize=INGEST_QUEUE_SIZE)
+_ingest_lock = threading.Lock()
+_writer_thread = None
+_flush_waiters = []
+_stop_event = threading.Event()
+
+_pool = queue.LifoQueue()
+_pool_generation = 0
+_data_version = 0  # Bumped whenever rows are deleted, so clients know to redraw
+_device_versions = {}  # device id -> bumped when rows older than its newest reading arrive
+_latest_ts = {}  # device id -> newest committed ts_ms, filled on first use
+_known_devices = None  # Cached set of device ids, filled on first use
+_hot_buffers = {}  # device id -> RingBuffer of its newest committed readings
+
+ingest_stats = {
+    'enqueued': 0,
+    'dropped': 0,
+    'committed': 0,
+    'batches': 0,
+    'errors': 0,
+    'rejected': 0,  # Invalid readings dropped: unparseable timestamps, rows the database refused
+    'last_batch_size': 0,
+    'last_commit_ms': 0.0,
+    'max_commit_ms': 0.0,
+    'total_commit_ms': 0.0,
+    'last_lag_ms': 0.0,
+}
+_commit_latencies = deque(maxlen=INGEST_LATENCY_SAMPLES)  # ms from add_sensor_data() to commit, per row
+
+
+# ------------------------- Connection Management -------------------------
+def _open_connection():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    for name, value in DB_PRAGMAS.items():
+        if value is not None:
+            conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
+
+@contextmanager
+def get_connection():
+    """ Borrows a pooled connection, rolling back anything left uncommitted on return. """
+    try:
+        generation, conn = _pool.get_nowait()
+    except queue.Empty:
+        generation, conn = _pool_generation, _open_connection()
+    if generation != _pool_generation:
+        conn.close()
+        generation, conn = _pool_generation, _open_connection()
+
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        if generation == _pool_generation and _pool.qsize() < DB_POOL_SIZE:
+            _pool.put((generation, conn))
+        else:
+            conn.close()
+
+
+def close_connections():
+    """ Closes every idle pooled connection. """
+    while True:
+        try:
+            _, conn = _pool.get_nowait()
+        except queue.Empty:
+            return
+        conn.close()
+
+
+def configure_db(db_path=None, archive_dir=None, **pragmas):
+    """ Switches the database file / archive directory and/or overrides DB_PRAGMAS (e.g. synchronous='FULL').
+
+    Pooled connections and the ingestion writer are restarted so the new settings apply everywhere.
+    """
+    global DB_PATH, ARCHIVE_DIR, _pool_generation, _known_devices
+    stop_ingest_writer()
+    if db_path is not None:
+        DB_PATH = db_path
+    if archive_dir is not None:
+        ARCHIVE_DIR = archive_dir
+    DB_PRAGMAS.update(pragmas)
+    _pool_generation += 1
+    _known_devices = None
+    _reset_hot_buffers()
+    close_connections()
+    init_db()
+
 
 # Initialize the database
 def init_db():
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS sensor_data (
-                            id INTEGER PRIMARY KEY AUTOINCREMENT,
-                            timestamp TEXT NOT NULL,
-                            temp_dht11 REAL,
-                            hum_dht11 REAL,
-                            temp_ds18b20 REAL,
-                            light_intensity REAL
-                        )''')
-        conn.commit()
-        conn.close()
+        with get_connection() as conn:
+            conn.execute(f'''CREATE TABLE IF NOT EXISTS sensor_data (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                timestamp TEXT NOT NULL,
+                                temp_dht11 REAL,
+                                hum_dht11 REAL,
+                                temp_ds18b20 REAL,
+                                light_intensity REAL,
+                                ts_ms INTEGER,
+                                device_id TEXT NOT NULL DEFAULT '{DEFAULT_DEVICE_ID}'
+                            )''')
+            _migrate(conn)
+            conn.commit()
         print("Database initialized successfully.")
     except sqlite3.DatabaseError as e:
         print(f"Error initializing database: {e}")
 
 
+def _migrate(conn):
+    """ Brings databases created by older versions up to the current schema. """
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(sensor_data)")]
+    if 'ts_ms' not in columns:
+        print("Migrating sensor_data: adding ts_ms column...")
+        conn.execute("ALTER TABLE sensor_data ADD COLUMN ts_ms INTEGER")
+    # Same "wall clock as UTC" convention as to_epoch_ms()
+    conn.execute("""UPDATE sensor_data SET ts_ms = CAST(strftime('%s', timestamp) AS INTEGER) * 1000
+                    WHERE ts_ms IS NULL""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sensor_data_ts_ms ON sensor_data (ts_ms)")
+    if 'device_id' not in columns:
+        print("Migrating sensor_data: adding device_id column...")
+        conn.execute(f"ALTER TABLE sensor_data ADD COLUMN device_id TEXT NOT NULL DEFAULT '{DEFAULT_DEVICE_ID}'")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sensor_data_device_ts ON sensor_data (device_id, ts_ms)")
+
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    created = False
+    for name, _ in ROLLUP_RESOLUTIONS:
+        table = f"sensor_rollup_{name}"
+        single = None
+        if table in existing:
+            if 'device_id' in [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]:
+                continue
+            # Rollups from before per-device storage all belong to DEFAULT_DEVICE_ID. They are
+            # copied rather than rebuilt, which would lose the buckets of archived readings.
+            single = f"{table}_single"
+            conn.execute(f"ALTER TABLE {table} RENAME TO {single}")
+        stats = ",\n".join(f"{col}_{stat} {'INTEGER NOT NULL DEFAULT 0' if stat == 'n' else 'REAL'}"
+                           for col in SENSOR_COLUMNS for stat in _ROLLUP_STATS)
+        conn.execute(f"""CREATE TABLE {table} (
+                            device_id TEXT NOT NULL,
+                            bucket_ms INTEGER NOT NULL,
+                            n INTEGER NOT NULL,
+                            {stats},
+                            PRIMARY KEY (device_id, bucket_ms)
+                        )""")
+        if single is None:
+            created = True
+            continue
+        print(f"Migrating {table}: adding device_id...")
+        names = ", ".join(['bucket_ms', 'n'] + [f"{col}_{stat}" for col in SENSOR_COLUMNS for stat in _ROLLUP_STATS])
+        conn.execute(f"INSERT INTO {table} (device_id, {names}) SELECT ?, {names} FROM {single}", (DEFAULT_DEVICE_ID,))
+        conn.execute(f"DROP TABLE {single}")
+    if created:
+        if conn.execute("SELECT 1 FROM sensor_data LIMIT 1").fetchone():
+            print("Migrating sensor_data: building rollup tables...")
+        _rebuild_rollups(conn)
+
+
+def to_epoch_ms(value):
+    """ Converts a timestamp string, datetime or epoch-ms number to epoch milliseconds.
+
+    The ESP32 reports local wall-clock time without a zone, so naive values are treated as
+    UTC; that keeps ts_ms in the same order as the timestamp text column.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.strip())
+        except ValueError:
+            return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return (value - _EPOCH) // timedelta(milliseconds=1)
+
+
 # Add sensor data to the database
 def add_sensor_data(data):
+    """ Queues a reading for the background writer; never waits on disk. """
+    return add_sensor_readings([data])
+
+
+def add_sensor_readings(readings):
+    """ Queues a batch of readings (e.g. one board message) to be committed in the same transaction.
+
+    Readings whose timestamp does not parse are dropped and counted in ingest_stats['rejected'].
+    """
+    rows = []
+    for data in readings:
+        try:
+            ts_ms = to_epoch_ms(data['timestamp'])
+        except (TypeError, ValueError, AttributeError, OverflowError):
+            ts_ms = None
+        if ts_ms is None:
+            ingest_stats['rejected'] += 1
+            print(f"Dropped reading with an invalid timestamp: {data['timestamp']!r}")
+            continue
+        rows.append((data['timestamp'], data['temp_dht11'], data['hum_dht11'], data['temp_ds18b20'],
+                     data['light_intensity'], data.get('device_id') or DEFAULT_DEVICE_ID, ts_ms))
+    if not rows:
+        return not readings  # False when every reading was dropped
+    start_ingest_writer()
+    return _enqueue((time.monotonic(), rows))
+
+
+def _enqueue(item):
+    """ Puts an (enqueued_at, rows) item on the writer queue, applying INGEST_FULL_POLICY when it is full. """
+    rows = len(item[1])
+    try:
+        _ingest_queue.put_nowait(item)
+        ingest_stats['enqueued'] += rows
+        return True
+    except queue.Full:
+        pass
+
+    if INGEST_FULL_POLICY == 'block':
+        try:
+            _ingest_queue.put(item, timeout=INGEST_BLOCK_TIMEOUT)
+            ingest_stats['enqueued'] += rows
+            return True
+        except queue.Full:
+            pass
+    elif INGEST_FULL_POLICY == 'drop_oldest':
+        try:
+            oldest = _ingest_queue.get_nowait()
+            if oldest is not None:
+                ingest_stats['dropped'] += len(oldest[1])
+            _ingest_queue.put_nowait(item)
+            ingest_stats['enqueued'] += rows
+            return True
+        except (queue.Empty, queue.Full):
+            pass
+
+    ingest_stats['dropped'] += rows
+    return False
+
+
+def _insert_rows(conn, rows):
+    """ Inserts rows (with ts_ms appended) in one transaction and copies them to the hot buffers.
+
+    Returns the boards that appear in the database for the first time.
+    """
+    # Ids follow time within a batch, even when a board sends a backlog after being offline
+    rows.sort(key=lambda row: row[6])
+    # Boards never seen before get a buffer that holds their whole history
+    missing = {row[5] for row in rows if row[5] not in _hot_buffers}
+    new_devices = missing - set(list_devices()) if missing else set()
+    late = _late_devices(conn, rows)
+    last_id = conn.execute("SELECT MAX(id) FROM sensor_data").fetchone()[0] or 0
+    conn.executemany(_INSERT_SQL, rows)
+    # With a single writer the batch gets consecutive ids ending at the new maximum
+    first_id = conn.execute("SELECT MAX(id) FROM sensor_data").fetchone()[0] - len(rows) + 1
+    # Fold the new rows into the rollups inside the same transaction
+    _update_rollups(conn, "id > ?", (last_id,))
+    # Before the commit, so a row visible in the database is always in its buffer too.
+    # The buffers assume time order, so boards catching up drop theirs and read from SQL.
+    for device_id in late:
+        _hot_buffers.pop(device_id, None)
+    _fill_hot_buffers(first_id, rows, new_devices, skip=late)
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('''INSERT INTO sensor_data 
-                          (timestamp, temp_dht11, hum_dht11, temp_ds18b20, light_intensity) 
-                          VALUES (?, ?, ?, ?, ?)''',
-                       (data['timestamp'], data['temp_dht11'], data['hum_dht11'], data['temp_ds18b20'],
-                        data['light_intensity']))
         conn.commit()
+    except sqlite3.DatabaseError:
+        _reset_hot_buffers()
+        raise
+    for row in rows:
+        if row[5] in _latest_ts:  # Otherwise loaded from SQL by the next batch
+            _latest_ts[row[5]] = max(_latest_ts[row[5]], row[6])
+    # After the commit, so a chart redrawn for the new version includes the late rows
+    for device_id in late:
+        _device_versions[device_id] = _device_versions.get(device_id, 0) + 1
+    return new_devices
+
+
+def _late_devices(conn, rows):
+    """ Returns the boards with rows (sorted by ts_ms) older than their newest stored reading. """
+    late = set()
+    for row in rows:
+        device_id = row[5]
+        if device_id not in _latest_ts:
+            newest = conn.execute("SELECT MAX(ts_ms) FROM sensor_data WHERE device_id = ?",
+                                  (device_id,)).fetchone()[0]
+            _latest_ts[device_id] = newest if newest is not None else row[6]
+        if row[6] < _latest_ts[device_id]:
+            late.add(device_id)
+    return late
+
+
+def _commit_batch(conn, batch):
+    """ Writes a batch of (enqueued_at, rows) items in one transaction. """
+    started = time.monotonic()
+    rows = [row for _, item_rows in batch for row in item_rows]
+    try:
+        new_devices = _insert_rows(conn, rows)
+    except Exception as e:  # Not only DatabaseError: nothing may stop the writer thread
+        conn.rollback()
+        ingest_stats['errors'] += 1
+        print(f"Error adding data to database: {e}; retrying the batch row by row")
+        rows, new_devices = _insert_each(conn, rows)
+        if not rows:
+            return
+    finished = time.monotonic()
+    commit_ms = (finished - started) * 1000
+    ingest_stats['committed'] += len(rows)
+    ingest_stats['batches'] += 1
+    ingest_stats['last_batch_size'] = len(rows)
+    ingest_stats['last_commit_ms'] = commit_ms
+    ingest_stats['total_commit_ms'] += commit_ms
+    ingest_stats['max_commit_ms'] = max(ingest_stats['max_commit_ms'], commit_ms)
+    ingest_stats['last_lag_ms'] = (finished - batch[0][0]) * 1000
+    _commit_latencies.extend([(finished - enqueued_at) * 1000 for enqueued_at, item_rows in batch
+                              for _ in item_rows])
+    metrics.observe(metrics.DB_COMMIT_SECONDS, finished - started)
+    metrics.observe(metrics.DB_BATCH_ROWS, len(rows))
+    devices = dict.fromkeys(row[5] for row in rows)
+    if _known_devices is not None:
+        _known_devices.update(devices)
+    # Committed, so callbacks woken by these notifications see the rows
+    for device_id in new_devices:
+        live.publish(live.EVENT_DEVICE, device=device_id)
+    for device_id in devices:
+        live.publish(live.EVENT_READINGS, device=device_id)
+
+
+def _insert_each(conn, rows):
+    """ Commits rows one transaction each after their batch failed, so only the rows the
+    database rejects are lost. Returns the rows written and the new boards among them. """
+    inserted, new_devices = [], set()
+    for row in rows:
+        try:
+            new_devices |= _insert_rows(conn, [row])
+            inserted.append(row)
+        except Exception as e:
+            conn.rollback()
+            ingest_stats['rejected'] += 1
+            print(f"Dropped reading rejected by the database ({e}): {row[:6]}")
+    return inserted, new_devices
+
+
+# ------------------------- Hot Buffers -------------------------
+def _fill_hot_buffers(first_id, rows, new_devices=(), skip=()):
+    """ Appends rows (with their ts_ms appended) to the per-board ring buffers, except skip's.
+
+    The buffers are only a cache: if they cannot take the rows they are dropped and reads go
+    to SQL, but the rows themselves are still committed.
+    """
+    try:
+        _extend_hot_buffers(first_id, rows, new_devices, skip)
+    except Exception as e:
+        print(f"Error updating the in-memory buffers, dropping them: {e}")
+        _hot_buffers.clear()
+
+
+def _extend_hot_buffers(first_id, rows, new_devices, skip):
+    by_device = {}
+    for i, row in enumerate(rows):
+        if row[5] not in skip:
+            by_device.setdefault(row[5], []).append(i)
+    for device_id, positions in by_device.items():
+        if any(rows[i][6] is None for i in positions):
+            # No place in a time-ordered buffer; the board is read from SQL until a new one starts
+            _hot_buffers.pop(device_id, None)
+            continue
+        buffer = _hot_buffers.get(device_id)
+        if buffer is None:
+            buffer = _hot_buffers[device_id] = RingBuffer(HOT_BUFFER_SIZE, SENSOR_COLUMNS,
+                                                          holds_all=device_id in new_devices)
+        # None readings become NaN
+        values = np.array([rows[i][1:5] for i in positions], dtype=float).T
+        buffer.extend([first_id + i for i in positions], [rows[i][6] for i in positions], values)
+
+
+def get_recent_columns(device_id=DEFAULT_DEVICE_ID, after_id=None, start=None, end=None, limit=None):
+    """ Columnar read of one board's newest readings straight from memory, no SQL.
+
+    Returns the same dict of NumPy arrays as get_sensor_columns() ('id', 'ts_ms' and
+    SENSOR_COLUMNS, oldest first) for the rows after after_id (at most limit of them) or else
+    for [start, end], or None when the in-memory buffer cannot answer completely; callers
+    then fall back to get_sensor_columns().
+    """
+    buffer = _hot_buffers.get(device_id)
+    if buffer is None:
+        return None
+    if after_id is not None:
+        return buffer.since_id(after_id, limit)
+    columns = buffer.time_range(to_epoch_ms(start), to_epoch_ms(end))
+    if columns is not None and limit:
+        columns = {name: values[-limit:] for name, values in columns.items()}
+    return columns
+
+
+def _reset_hot_buffers():
+    _hot_buffers.clear()
+    _latest_ts.clear()
+
+
+def _drain_queue():
+    items = []
+    while True:
+        try:
+            item = _ingest_queue.get_nowait()
+        except queue.Empty:
+            return items
+        if item is not None:
+            items.append(item)
+
+
+def _wake_writer():
+    # A None marker only wakes the writer up; if the queue is full it is busy anyway.
+    try:
+        _ingest_queue.put_nowait(None)
+    except queue.Full:
+        pass
+
+
+def _ingest_writer_loop():
+    """ Drains the ingestion queue, group-committing on a size-or-time trigger. """
+    # The writer keeps its own connection for its whole lifetime, outside the reader pool.
+    conn = _open_connection()
+    batch = []
+    pending = 0  # Rows in batch
+    try:
+        while True:
+            if batch:
+                timeout = max(0.0, batch[0][0] + INGEST_FLUSH_INTERVAL - time.monotonic())
+            else:
+                timeout = None
+            try:
+                item = _ingest_queue.get(timeout=timeout)
+                if item is not None:
+                    batch.append(item)
+                    pending += len(item[1])
+            except queue.Empty:
+                pass
+
+            with _ingest_lock:
+                waiters = list(_flush_waiters)
+                del _flush_waiters[:]
+            stopping = _stop_event.is_set()
+
+            if waiters or stopping:
+                batch.extend(_drain_queue())
+            elif not batch or (pending < INGEST_BATCH_SIZE and
+                               time.monotonic() - batch[0][0] < INGEST_FLUSH_INTERVAL and
+                               not _live_flush_due()):
+                continue
+
+            if batch:
+                try:
+                    _commit_batch(conn, batch)
+                except Exception as e:
+                    print(f"Error in the ingestion writer: {e}")
+                batch = []
+                pending = 0
+            for event in waiters:
+                event.set()
+            if stopping:
+                break
+    finally:
         conn.close()
-        #print("Sensor data added successfully.")
-    except sqlite3.DatabaseError as e:
-        print(f"Error adding data to database: {e}")
+
+
+def _live_flush_due():
+    """ While dashboards are connected to /live, commit as soon as the queue is idle instead of
+    waiting out the flush interval; under load batches still form while the previous commit runs. """
+    return live.subscriber_count() > 0 and _ingest_queue.empty()
+
+
+def start_ingest_writer():
+    """ Starts the background writer thread if it is not already running. """
+    global _writer_thread
+    if _writer_thread is not None and _writer_thread.is_alive():
+        return
+    with _ingest_lock:
+        if _writer_thread is None or not _writer_thread.is_alive():
+            _stop_event.clear()
+            _writer_thread = threading.Thread(target=_ingest_writer_loop, name="ingest-writer", daemon=True)
+            _writer_thread.start()
+
+
+def flush_ingest(timeout=5.0):
+    """ Blocks until every reading queued before this call is committed. """
+    if _writer_thread is None or not _writer_thread.is_alive():
+        return True
+    done = threading.Event()
+    with _ingest_lock:
+        _flush_waiters.append(done)
+    _wake_writer()
+    return done.wait(timeout)
+
+
+def stop_ingest_writer(timeout=5.0):
+    """ Commits pending readings and stops the writer thread. """
+    global _writer_thread
+    if _writer_thread is None:
+        return
+    _stop_event.set()
+    _wake_writer()
+    _writer_thread.join(timeout)
+    _writer_thread = None
+
+
+def get_ingest_stats():
+    """ Returns a snapshot of the writer counters plus the current queue depth. """
+    stats = dict(ingest_stats)
+    stats['queue_depth'] = _ingest_queue.qsize()
+    stats['queue_capacity'] = INGEST_QUEUE_SIZE
+    stats['avg_commit_ms'] = stats['total_commit_ms'] / stats['batches'] if stats['batches'] else 0.0
+    latencies = get_ingest_latencies()
+    stats['p50_lag_ms'] = float(np.percentile(latencies, 50)) if len(latencies) else 0.0
+    stats['p99_lag_ms'] = float(np.percentile(latencies, 99)) if len(latencies) else 0.0
+    return stats
+
+
+def get_ingest_latencies():
+    """ Returns the newest INGEST_LATENCY_SAMPLES enqueue-to-commit latencies (ms) as an array. """
+    return np.array(_commit_latencies.copy(), dtype=float)
+
+
+def reset_ingest_stats():
+    """ Zeroes the writer counters and latency samples (e.g. between benchmark runs). """
+    for key, value in ingest_stats.items():
+        ingest_stats[key] = type(value)()
+    _commit_latencies.clear()
+
+
+def get_data_version(device_id=None):
+    """ Returns a counter that changes every time stored readings are deleted, or for a board,
+    also when readings older than its newest one arrive (charts then redraw instead of appending). """
+    if device_id is None:
+        return _data_version
+    return _data_version + _device_versions.get(device_id, 0)
+
+
+def _bump_data_version():
+    global _data_version, _known_devices
+    _data_version += 1
+    _reset_hot_buffers()  # They may hold deleted rows
+    _known_devices = None  # Boards whose readings were all deleted are gone
+    live.publish(live.EVENT_RESET)
 
 
 def clear_database():
+    flush_ingest()
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM sensor_data")
-        conn.commit()
-        conn.close()
+        with get_connection() as conn:
+            conn.execute("DELETE FROM sensor_data")
+            _delete_rollups(conn)
+            conn.commit()
+        archive.delete_archive_range(ARCHIVE_DIR)
+        _bump_data_version()
         print("All data cleared successfully.")
     except Exception as e:
         print(f"Error clearing data: {e}")
 
 
+# ------------------------- Rollups -------------------------
+def _rollup_sql(table, bucket_ms, where, source='sensor_data'):
+    """ INSERT ... SELECT that aggregates the `source` rows matching `where` into `table`,
+    merging with buckets that already exist. """
+    names = ['device_id', 'bucket_ms', 'n'] + [f"{col}_{stat}" for col in SENSOR_COLUMNS for stat in _ROLLUP_STATS]
+    aggregates = []
+    updates = ['n = n + excluded.n']
+    for col in SENSOR_COLUMNS:
+        aggregates += [f"MIN({col})", f"MAX({col})", f"TOTAL({col})", f"COUNT({col})"]
+        updates += [
+            f"{col}_min = MIN(COALESCE({col}_min, excluded.{col}_min), COALESCE(excluded.{col}_min, {col}_min))",
+            f"{col}_max = MAX(COALESCE({col}_max, excluded.{col}_max), COALESCE(excluded.{col}_max, {col}_max))",
+            f"{col}_sum = COALESCE({col}_sum, 0) + COALESCE(excluded.{col}_sum, 0)",
+            f"{col}_n = {col}_n + excluded.{col}_n",
+        ]
+    return (f"INSERT INTO {table} ({', '.join(names)}) "
+            f"SELECT device_id, (ts_ms / {bucket_ms}) * {bucket_ms}, COUNT(*), {', '.join(aggregates)} "
+            f"FROM {source} WHERE ts_ms IS NOT NULL AND {where} GROUP BY 1, 2 "
+            f"ON CONFLICT(device_id, bucket_ms) DO UPDATE SET {', '.join(updates)}")
+
+
+def _update_rollups(conn, where="1", params=()):
+    for name, bucket_ms in ROLLUP_RESOLUTIONS:
+        conn.execute(_rollup_sql(f"sensor_rollup_{name}", bucket_ms, where), params)
+
+
+def _range_where(column, lo=None, hi=None):
+    """ SQL condition for lo <= column < hi; a missing bound leaves that side open. """
+    clauses, params = [], []
+    if lo is not None:
+        clauses.append(f"{column} >= ?")
+        params.append(lo)
+    if hi is not None:
+        clauses.append(f"{column} < ?")
+        params.append(hi)
+    return " AND ".join(clauses) or "1", params
+
+
+def _delete_rollups(conn, start=None, end=None):
+    """ Drops rollup buckets overlapping [start, end); a missing bound leaves that side open. """
+    for name, bucket_ms in ROLLUP_RESOLUTIONS:
+        where, params = _range_where("bucket_ms", None if start is None else start - start % bucket_ms, end)
+        conn.execute(f"DELETE FROM sensor_rollup_{name} WHERE {where}", params)
+
+
+def _rebuild_rollups(conn, start=None, end=None):
+    """ Recomputes the rollup buckets overlapping [start, end) (all of them if no range is given)
+    from sensor_data and the cold archive. """
+    archives = archive.list_archives(ARCHIVE_DIR)
+    kept = None  # Without pyarrow, buckets up to the newest archived reading are left as they are
+    if archives and archive.pa is None:
+        kept = max(last for _, last, _ in archives)
+        print("Warning: pyarrow is not installed, so rollups of archived readings are not rebuilt.")
+    windows = []
+    for name, bucket_ms in ROLLUP_RESOLUTIONS:
+        # Whole buckets, including readings just outside the range that share one
+        lo = None if start is None else start - start % bucket_ms
+        hi = None if end is None else -(-end // bucket_ms) * bucket_ms
+        if kept is not None:
+            lo = max(lo or 0, kept - kept % bucket_ms + bucket_ms)
+            if hi is not None and lo >= hi:
+                continue
+        windows.append((name, bucket_ms, lo, hi))
+        where, params = _range_where("bucket_ms", lo, hi)
+        conn.execute(f"DELETE FROM sensor_rollup_{name} WHERE {where}", params)
+        where, params = _range_where("ts_ms", lo, hi)
+        conn.execute(_rollup_sql(f"sensor_rollup_{name}", bucket_ms, where), params)
+    if archives and kept is None and windows:
+        _rollup_archive(conn, windows)
+
+
+def _rollup_archive(conn, windows):
+    """ Folds the archived readings inside each (name, bucket_ms, lo, hi) window into that
+    rollup, loading them through a temporary table so the same SQL aggregates them. """
+    columns = ('device_id', 'ts_ms') + SENSOR_COLUMNS
+    # The coarsest window contains all the others
+    los, his = [window[2] for window in windows], [window[3] for window in windows]
+    lo = None if None in los else min(los)
+    hi = None if None in his else max(his)
+    conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS archived_rows ({', '.join(columns)})")
+    conn.execute("DELETE FROM archived_rows")
+    insert = f"INSERT INTO archived_rows VALUES ({', '.join('?' * len(columns))})"
+    for rows in archive.iter_archive_batches(ARCHIVE_DIR, columns, lo, None if hi is None else hi - 1,
+                                             defaults={'device_id': DEFAULT_DEVICE_ID}):
+        conn.executemany(insert, rows)
+    for name, bucket_ms, lo, hi in windows:
+        where, params = _range_where("ts_ms", lo, hi)
+        conn.execute(_rollup_sql(f"sensor_rollup_{name}", bucket_ms, where, source='archived_rows'), params)
+    conn.execute("DELETE FROM archived_rows")
+
+
+def backfill_rollups(start=None, end=None):
+    """ Rebuilds the rollup tables from sensor_data and the archive, optionally only for [start, end). """
+    flush_ingest()
+    started = time.monotonic()
+    with get_connection() as conn:
+        _rebuild_rollups(conn, to_epoch_ms(start), to_epoch_ms(end))
+        conn.commit()
+    print(f"Rollups rebuilt in {time.monotonic() - started:.1f}s.")
+
+
+def _time_bounds(conn, start, end, device_id=None):
+    """ Fills in a missing start/end from the oldest and newest stored reading. Archive file names
+    bound the archived rows; for a single board the 1m rollup does, as files mix boards. """
+    if start is not None and end is not None:
+        return start, end
+    where, params = ("WHERE device_id = ?", (device_id,)) if device_id is not None else ("", ())
+    # Separate subqueries so SQLite answers each from the index instead of a scan
+    lo, hi = conn.execute(f"SELECT (SELECT MIN(ts_ms) FROM sensor_data {where}), "
+                          f"(SELECT MAX(ts_ms) FROM sensor_data {where})", params * 2).fetchone()
+    archives = archive.list_archives(ARCHIVE_DIR)
+    if archives:
+        first, last = archives[0][0], max(archived_last for _, archived_last, _ in archives)
+        if device_id is not None:
+            name, bucket_ms = ROLLUP_RESOLUTIONS[0]
+            table = f"sensor_rollup_{name}"
+            bucket_lo, bucket_hi = conn.execute(
+                f"SELECT (SELECT MIN(bucket_ms) FROM {table} WHERE device_id = ?), "
+                f"(SELECT MAX(bucket_ms) FROM {table} WHERE device_id = ? AND bucket_ms <= ?)",
+                (device_id, device_id, last)).fetchone()
+            first = None if bucket_lo is None or bucket_lo > last else max(first, bucket_lo)
+            last = None if first is None else min(last, bucket_hi + bucket_ms - 1)
+        if first is not None:
+            lo = first if lo is None else min(lo, first)
+            hi = last if hi is None else max(hi, last)
+    start = lo if start is None else start
+    end = hi if end is None else end
+    return start, end
+
+
+def _rollup_where(start, end, bucket_ms, device_id):
+    clauses, params = [], []
+    if device_id is not None:
+        clauses.append("device_id = ?")
+        params.append(device_id)
+    if start is not None:
+        clauses.append("bucket_ms >= ?")
+        params.append(start - start % bucket_ms)
+    if end is not None:
+        clauses.append("bucket_ms <= ?")
+        params.append(end)
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+def choose_resolution(start=None, end=None, max_points=1000, device_id=None):
+    """ Query planner: returns 'raw' if [start, end] holds at most RAW_OVERSAMPLE * max_points
+    readings (the charts' LTTB stage reduces them), else the finest ROLLUP_RESOLUTIONS name that
+    covers the range within max_points buckets, or the coarsest rollup if none does. """
+    start, end = to_epoch_ms(start), to_epoch_ms(end)
+    with get_connection() as conn:
+        start, end = _time_bounds(conn, start, end, device_id)
+        if start is None:
+            return 'raw'
+        # Estimate the raw row count from the finest rollup that needs only a short scan
+        for name, bucket_ms in ROLLUP_RESOLUTIONS:
+            if (end - start) // bucket_ms <= 2000:
+                break
+        where, params = _rollup_where(start, end, bucket_ms, device_id)
+        raw_rows = conn.execute(f"SELECT TOTAL(n) FROM sensor_rollup_{name}{where}", params).fetchone()[0]
+    if raw_rows <= RAW_OVERSAMPLE * max_points:
+        return 'raw'
+    for name, bucket_ms in ROLLUP_RESOLUTIONS:
+        if (end - start) // bucket_ms + 1 <= max_points:
+            return name
+    return ROLLUP_RESOLUTIONS[-1][0]
+
+
+def get_sensor_series(start=None, end=None, max_points=1000, device_id=None):
+    """ Returns chart-ready columns for [start, end] from the resolution picked by choose_resolution().
+
+    Keys: 'resolution', 'ts_ms', one mean value array per SENSOR_COLUMNS entry, and
+    '<column>_min' / '<column>_max' envelopes (equal to the values for raw rows). Raw series may
+    hold up to RAW_OVERSAMPLE * max_points rows, for the caller to downsample.
+    """
+    data = get_recent_columns(device_id, start=start, end=end) if device_id is not None else None
+    if data is not None and len(data['ts_ms']) <= RAW_OVERSAMPLE * max_points:
+        resolution = 'raw'  # Served from memory, no planner queries
+    else:
+        resolution = choose_resolution(start, end, max_points, device_id)
+        data = None
+    if resolution == 'raw':
+        if data is None:
+            data = get_sensor_columns(start=start, end=end, device_id=device_id)
+        series = {'resolution': 'raw', 'ts_ms': data['ts_ms']}
+        for col in SENSOR_COLUMNS:
+            series[col] = series[f"{col}_min"] = series[f"{col}_max"] = data[col]
+        return series
+
+    bucket_ms = dict(ROLLUP_RESOLUTIONS)[resolution]
+    names = ['bucket_ms']
+    for col in SENSOR_COLUMNS:
+        names += [f"{col}_sum / NULLIF({col}_n, 0)", f"{col}_min", f"{col}_max"]
+    where, params = _rollup_where(to_epoch_ms(start), to_epoch_ms(end), bucket_ms, device_id)
+    if device_id is None:
+        # Several boards share each bucket: combine them
+        names = ['bucket_ms']
+        for col in SENSOR_COLUMNS:
+            names += [f"TOTAL({col}_sum) / NULLIF(SUM({col}_n), 0)", f"MIN({col}_min)", f"MAX({col}_max)"]
+        where += " GROUP BY bucket_ms"
+    try:
+        with get_connection() as conn:
+            rows = conn.execute(f"SELECT {', '.join(names)} FROM sensor_rollup_{resolution}{where} "
+                                "ORDER BY bucket_ms", params).fetchall()
+    except sqlite3.DatabaseError as e:
+        print(f"Error retrieving data from database: {e}")
+        rows = []
+
+    table = np.array(rows, dtype=float).reshape(len(rows), len(names))
+    series = {'resolution': resolution, 'ts_ms': table[:, 0].astype(np.int64)}
+    for i, col in enumerate(SENSOR_COLUMNS):
+        series[col] = table[:, 1 + 3 * i]
+        series[f"{col}_min"] = table[:, 2 + 3 * i]
+        series[f"{col}_max"] = table[:, 3 + 3 * i]
+    return series
+
+
+def list_devices():
+    """ Returns the ids of every board that has stored readings, sorted. """
+    global _known_devices
+    if _known_devices is None:
+        try:
+            with get_connection() as conn:
+                # The daily rollup is tiny and still knows about archived boards
+                rows = conn.execute(f"SELECT DISTINCT device_id FROM sensor_rollup_{ROLLUP_RESOLUTIONS[-1][0]}")
+                _known_devices = {row[0] for row in rows}
+        except sqlite3.DatabaseError as e:
+            print(f"Error retrieving data from database: {e}")
+            return []
+    return sorted(_known_devices)
+
+
 # Clear data for a specific year
 def clear_year_data(year):
+    flush_ingest()
+    start = to_epoch_ms(datetime(int(year), 1, 1))
+    end = to_epoch_ms(datetime(int(year) + 1, 1, 1))
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM sensor_data WHERE utctime('%Y', timestamp) = ?", (str(year),))
-        conn.commit()
-        conn.close()
+        with get_connection() as conn:
+            deleted = conn.execute("DELETE FROM sensor_data WHERE ts_ms >= ? AND ts_ms < ?",
+                                   (start, end)).rowcount
+            # Before the rollups are rebuilt, which also reads the archive
+            deleted += archive.delete_archive_range(ARCHIVE_DIR, start, end)
+            _rebuild_rollups(conn, start, end)
+            conn.commit()
+        _bump_data_version()
         print(f"Data for year {year} cleared successfully.")
+        return f"Cleared {deleted} readings from {year}."
     except Exception as e:
         print(f"Error clearing data for year {year}: {e}")
+        return f"Error clearing data for year {year}: {e}"
+
+
+def _build_query(start=None, end=None, limit=None, after_id=None, device_id=None):
+    """ Builds the WHERE/ORDER/LIMIT part shared by the range queries. """
+    clauses, params = [], []
+    if device_id is not None:
+        clauses.append("device_id = ?")
+        params.append(device_id)
+    if after_id is not None:
+        clauses.append("id > ?")
+        params.append(int(after_id))
+    if start is not None:
+        clauses.append("ts_ms >= ?")
+        params.append(to_epoch_ms(start))
+    if end is not None:
+        clauses.append("ts_ms <= ?")
+        params.append(to_epoch_ms(end))
+
+    sql = " WHERE " + " AND ".join(clauses) if clauses else ""
+    newest_first = limit is not None and after_id is None
+    if after_id is not None:
+        sql += " ORDER BY id"
+    else:
+        sql += " ORDER BY ts_ms DESC, id DESC" if newest_first else " ORDER BY ts_ms, id"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(int(limit))
+    return sql, params, newest_first
+
+
+def _fetch_rows(names, start=None, end=None, limit=None, after_id=None, device_id=None):
+    """ Runs a range query for `names` over sensor_data plus the cold archive, oldest first. """
+    sql, params, newest_first = _build_query(start, end, limit, after_id, device_id)
+    with get_connection() as conn:
+        rows = conn.execute(f"SELECT {', '.join(names)} FROM sensor_data" + sql, params).fetchall()
+    if newest_first:
+        rows.reverse()
+
+    # Archived rows are all older than the live ones; after_id only ever asks for new rows
+    if after_id is None and (limit is None or len(rows) < limit):
+        archived = archive.read_archive_rows(ARCHIVE_DIR, names, to_epoch_ms(start), to_epoch_ms(end),
+                                             device_id, _ARCHIVE_DEFAULTS,
+                                             limit=None if limit is None else limit - len(rows))
+        rows = archived + rows
+    return rows
 
 
 # Retrieve sensor data from the database
-def get_sensor_data():
+def get_sensor_data(start=None, end=None, limit=None, after_id=None, device_id=None):
+    """ Returns readings as a list of dicts, oldest first.
+
+    start/end bound the reading time (inclusive) and accept datetimes, timestamp strings or
+    epoch ms. after_id returns only rows inserted after that row id, in insertion order.
+    limit caps the row count: paging forward from after_id, otherwise keeping the newest rows.
+    device_id restricts the result to one board. Rows moved to the cold archive are included
+    transparently.
+    """
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('''SELECT timestamp, temp_dht11, hum_dht11, temp_ds18b20, light_intensity FROM sensor_data''')
-        rows = cursor.fetchall()
-        conn.close()
+        rows = _fetch_rows(_SELECT_COLUMNS, start, end, limit, after_id, device_id)
 
         # Convert the data into a list of dictionaries
         sensor_data = [
             {
-                'timestamp': row[0],
-                'temp_dht11': row[1],
-                'hum_dht11': row[2],
-                'temp_ds18b20': row[3],
-                'light_intensity': row[4]
+                'id': row[0],
+                'timestamp': row[1],
+                'device_id': row[2],
+                'temp_dht11': row[3],
+                'hum_dht11': row[4],
+                'temp_ds18b20': row[5],
+                'light_intensity': row[6]
             }
             for row in rows
         ]
         return sensor_data
-    except sqlite3.DatabaseError as e:
+    except (sqlite3.DatabaseError, OSError) as e:
         print(f"Error retrieving data from database: {e}")
         return []
 
 
-def add_sensor_data_csv(data):
-    global sensor_data_list
-    sensor_data_list.append(data)
-    # Limit the size of the data list
-    if len(sensor_data_list) > 1000:
-        sensor_data_list.pop(0)
+def get_sensor_columns(start=None, end=None, limit=None, after_id=None, device_id=None):
+    """ Same filters as get_sensor_data(), but returns one NumPy array per column
+    ('id', 'ts_ms' and SENSOR_COLUMNS) instead of a dict per row. Missing values are NaN. """
+    names = ('id', 'ts_ms') + SENSOR_COLUMNS
+    try:
+        rows = _fetch_rows(names, start, end, limit, after_id, device_id)
+    except (sqlite3.DatabaseError, OSError) as e:
+        print(f"Error retrieving data from database: {e}")
+        rows = []
+
+    table = np.array(rows, dtype=float).reshape(len(rows), len(names))
+    columns = {name: table[:, i] for i, name in enumerate(names)}
+    columns['id'] = columns['id'].astype(np.int64)
+    columns['ts_ms'] = np.nan_to_num(columns['ts_ms']).astype(np.int64)
+    return columns
+
 
+def iter_sensor_data(start=None, end=None, batch_size=5000, columns=EXPORT_COLUMNS, device_id=None):
+    """ Yields readings in [start, end] as lists of row tuples, batch_size rows at a time.
 
-def get_sensor_data_csv():
-    return sensor_data_list
+    Archived rows come first, then rows straight off one SQLite cursor, so memory stays flat
+    however big the table is.
+    """
+    yield from archive.iter_archive_batches(ARCHIVE_DIR, columns, to_epoch_ms(start), to_epoch_ms(end),
+                                            device_id, _ARCHIVE_DEFAULTS, batch_size)
+    sql, params, _ = _build_query(start, end, device_id=device_id)
+    with get_connection() as conn:
+        cursor = conn.execute(f"SELECT {', '.join(columns)} FROM sensor_data" + sql, params)
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield rows
+        finally:
+            cursor.close()
+
+
+# ------------------------- Cold Archive -------------------------
+def archive_old_data(days, batch_size=50000):
+    """ Moves readings older than `days` days from sensor_data into a zstd Parquet file in
+    ARCHIVE_DIR. Rollups are kept, and the query functions above keep returning the rows. """
+    archive.require_pyarrow()
+    flush_ingest()
+    cutoff = to_epoch_ms(datetime.now()) - int(days * DAY_MS)
+    columns = ('id', 'timestamp', 'device_id', 'ts_ms') + SENSOR_COLUMNS
+    with get_connection() as conn:
+        # Bound by id too, so rows that arrive while the file is written are left for next time
+        max_id = conn.execute("SELECT MAX(id) FROM sensor_data").fetchone()[0] or 0
+        cursor = conn.execute(f"SELECT {', '.join(columns)} FROM sensor_data WHERE ts_ms < ? AND id <= ? "
+                              "ORDER BY ts_ms, id", (cutoff, max_id))
+        path, count = archive.write_archive(ARCHIVE_DIR, iter(lambda: cursor.fetchmany(batch_size), []), columns)
+        if count:
+            conn.execute("DELETE FROM sensor_data WHERE ts_ms < ? AND id <= ?", (cutoff, max_id))
+            conn.commit()
+    print(f"Archived {count} readings older than {days} days" + (f" to {path}." if path else "."))
+    return path, count
+
+
+def get_latest_id():
+    """ Returns the id of the most recently inserted reading, or None if there is none. """
+    try:
+        with get_connection() as conn:
+            return conn.execute("SELECT MAX(id) FROM sensor_data").fetchone()[0]
+    except sqlite3.DatabaseError as e:
+        print(f"Error retrieving data from database: {e}")
+        return None
 
 
 def clear_in_memory_data():
     """Clears the in-memory sensor data."""
-    global sensor_data_list
-    sensor_data_list = []
+    _reset_hot_buffers()
+
+
+def _ingest_metrics():
+    """ Ingestion counters for the /metrics endpoint (see app.metrics). """
+    stats = get_ingest_stats()
+    rows = [({'outcome': outcome}, stats[outcome]) for outcome in ('enqueued', 'committed', 'dropped', 'rejected')]
+    lags = [({'quantile': q}, stats[f"p{int(float(q) * 100)}_lag_ms"] / 1000) for q in ('0.5', '0.99')]
+    return [
+        ('remoteiot_ingest_rows_total', 'counter', "Readings by ingestion outcome.", rows),
+        ('remoteiot_ingest_errors_total', 'counter', "Failed ingestion batch commits.", [({}, stats['errors'])]),
+        ('remoteiot_ingest_queue_depth', 'gauge', "Messages (readings or board batches) waiting for the writer.",
+         [({}, stats['queue_depth'])]),
+        ('remoteiot_ingest_lag_seconds', 'summary', "Enqueue-to-commit latency of recent readings.", lags),
+    ]
 
 
 # Call init_db() to ensure the database is set up when the module is imported
 init_db()
+atexit.register(stop_ingest_writer)
+metrics.register_collector(_ingest_metrics)
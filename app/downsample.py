@@ -0,0 +1,72 @@
+import numpy as np
+
+DOWNSAMPLE_METHODS = ('lttb', 'minmax')
+
+
+def lttb(x, y, n_out):
+    """ Largest-Triangle-Three-Buckets: returns the indices of n_out points that keep the
+    visual shape of the series (peaks included). x must be sorted ascending. """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # First and last points are always kept; the n - 2 points between them go into n_out - 2 buckets
+    n_buckets = n_out - 2
+    edges = np.linspace(1, n - 1, n_buckets + 1).astype(np.int64)
+
+    # Average point of every bucket, computed in one pass (NaN readings are ignored)
+    valid = ~np.isnan(y)
+    cum_x = np.concatenate(([0.0], np.cumsum(np.where(valid, x, 0.0))))
+    cum_y = np.concatenate(([0.0], np.cumsum(np.where(valid, y, 0.0))))
+    cum_n = np.concatenate(([0], np.cumsum(valid)))
+    counts = np.maximum(cum_n[edges[1:]] - cum_n[edges[:-1]], 1)
+    avg_x = (cum_x[edges[1:]] - cum_x[edges[:-1]]) / counts
+    avg_y = (cum_y[edges[1:]] - cum_y[edges[:-1]]) / counts
+    # The "next bucket" of the last bucket is the final point
+    avg_x = np.append(avg_x[1:], x[-1])
+    avg_y = np.append(avg_y[1:], y[-1] if valid[-1] else avg_y[-1])
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for i in range(n_buckets):
+        lo, hi = edges[i], edges[i + 1]
+        xa, ya = x[a], y[a] if valid[a] else avg_y[i]
+        area = np.abs((xa - avg_x[i]) * (y[lo:hi] - ya) - (xa - x[lo:hi]) * (avg_y[i] - ya))
+        area = np.where(np.isnan(area), -1.0, area)
+        a = lo + int(np.argmax(area))
+        selected[i + 1] = a
+    return selected
+
+
+def minmax(x, y, n_out):
+    """ Keeps the minimum and maximum of n_out // 2 equal-width buckets. Returns sorted indices. """
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    n_buckets = max(n_out // 2, 1)
+    if n_out >= n:
+        return np.arange(n)
+
+    size = -(-n // n_buckets)  # ceil division
+    padded = np.full(n_buckets * size, np.nan)
+    padded[:n] = y
+    padded = padded.reshape(n_buckets, size)
+
+    # Empty (all-NaN) buckets fall back to their first index and get clipped/deduplicated below
+    lows = np.argmin(np.where(np.isnan(padded), np.inf, padded), axis=1)
+    highs = np.argmax(np.where(np.isnan(padded), -np.inf, padded), axis=1)
+    base = np.arange(n_buckets) * size
+    indices = np.concatenate((base + lows, base + highs, [0, n - 1]))
+    return np.unique(np.clip(indices, 0, n - 1))
+
+
+def downsample(x, y, n_out, method='lttb'):
+    """ Returns indices into x/y selecting at most ~n_out points with the given method. """
+    if method == 'lttb':
+        return lttb(x, y, n_out)
+    if method == 'minmax':
+        return minmax(x, y, n_out)
+    raise ValueError(f"Unknown downsampling method: {method}")
@@ -0,0 +1,96 @@
+import csv
+import io
+import json
+import zlib
+
+from flask import Response, abort, request, stream_with_context
+
+from app import archive
+from app.data_store import EXPORT_COLUMNS, iter_sensor_data, to_epoch_ms
+
+EXPORT_BATCH_SIZE = 5000  # Rows fetched from SQLite per chunk
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'json': 'application/json',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.file',
+}
+
+
+def _csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def _ndjson_chunks(batches):
+    for rows in batches:
+        yield "".join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + "\n" for row in rows).encode()
+
+
+def _json_chunks(batches):
+    """ A JSON array written one batch at a time. """
+    yield b"["
+    first = True
+    for rows in batches:
+        chunk = ",\n".join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) for row in rows)
+        yield (("\n" if first else ",\n") + chunk).encode()
+        first = False
+    yield b"\n]\n"
+
+
+def _gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 writes a gzip header
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_export(fmt, start=None, end=None, compress=False, device_id=None):
+    """ Returns an iterator of encoded export bytes for the given format, time range and board. """
+    batches = iter_sensor_data(start, end, batch_size=EXPORT_BATCH_SIZE, device_id=device_id)
+    if fmt == 'parquet':
+        # Already compressed column by column; every batch becomes one row group
+        return archive.iter_parquet_chunks(batches, EXPORT_COLUMNS)
+    if fmt == 'arrow':
+        chunks = archive.iter_arrow_chunks(batches, EXPORT_COLUMNS)
+    else:
+        chunks = {'csv': _csv_chunks, 'ndjson': _ndjson_chunks, 'json': _json_chunks}[fmt](batches)
+    return _gzip_chunks(chunks) if compress else chunks
+
+
+def register_export_routes(server):
+    """ Adds /export/sensor_data.<csv|ndjson|json|parquet|arrow> to the Flask server behind Dash.
+
+    Query parameters: start, end (timestamps, inclusive), device and gzip=1 (ignored for Parquet).
+    """
+    @server.route('/export/sensor_data.<fmt>')
+    def export_sensor_data(fmt):
+        if fmt not in EXPORT_FORMATS:
+            abort(404)
+        start = request.args.get('start') or None
+        end = request.args.get('end') or None
+        device_id = request.args.get('device') or None
+        compress = request.args.get('gzip') in ('1', 'true', 'yes') and fmt != 'parquet'
+        if fmt in ('parquet', 'arrow') and archive.pa is None:
+            abort(501, "pyarrow is not installed on the server")
+        for value in (start, end):
+            if value is not None and to_epoch_ms(value) is None:
+                abort(400, f"Invalid time: {value}")
+
+        filename = f"sensor_data.{fmt}" + (".gz" if compress else "")
+        headers = {'Content-Disposition': f'attachment; filename="{filename}"'}
+        mimetype = 'application/gzip' if compress else EXPORT_FORMATS[fmt]
+        return Response(stream_with_context(stream_export(fmt, start, end, compress, device_id)),
+                        mimetype=mimetype, headers=headers)
@@ -1,23 +1,46 @@
 from dash import dcc, html
 import dash_bootstrap_components as dbc
 from datetime import datetime
+from app.data_store import list_devices
+
+# (data column, chart title, trace name), drawn 2x2 for every board
+CHARTS = [
+    ('temp_dht11', "DHT11 Temperature", 'DHT11 Temp (°C)'),
+    ('hum_dht11', "DHT11 Humidity", 'DHT11 Humidity (%)'),
+    ('temp_ds18b20', "DS18B20 Temperature", 'DS18B20 Temp (°C)'),
+    ('light_intensity', "Light Intensity", 'Light Intensity'),
+]
+
+NO_DEVICES_MESSAGE = html.P("Waiting for the first board to publish sensor data...", className="text-center")
+
+
+def create_device_panel(device_id):
+    """ Charts for one board. Every id carries the device so one set of pattern-matching
+    callbacks serves all boards. """
+    def chart(sensor):
+        return dcc.Graph(id={'type': 'sensor-chart', 'device': device_id, 'sensor': sensor},
+                         className='sensor-chart', style={'height': '300px'})
+
+    return html.Div([
+        html.H3(f"Board: {device_id}", className="my-3"),
+        dbc.Row([
+            dbc.Col([chart(CHARTS[0][0]), chart(CHARTS[1][0])], width=6),
+            dbc.Col([chart(CHARTS[2][0]), chart(CHARTS[3][0])], width=6),
+        ]),
+        dcc.Store(id={'type': 'chart-cursor', 'device': device_id}),  # Per-tab position of the incremental updates
+        dcc.Store(id={'type': 'live-data', 'device': device_id}),  # Set by live.js when the board has new readings
+    ])
 
 
 def create_layout() -> object:
+    devices = list_devices()
     return dbc.Container([
         html.H1("IoT Sensor Dashboard", className="text-center my-4"),
 
-        dbc.Row([
-            dbc.Col([
-                dcc.Graph(id='dht11-temp-chart', style={'height': '300px'}),
-                dcc.Graph(id='dht11-humidity-chart', style={'height': '300px'}),
-            ], width=6),
-
-            dbc.Col([
-                dcc.Graph(id='ds18b20-temp-chart', style={'height': '300px'}),
-                dcc.Graph(id='light-intensity-chart', style={'height': '300px'}),
-            ], width=6),
-        ]),
+        # One panel per board, added as new boards start publishing
+        html.Div(id='device-panels',
+                 children=[create_device_panel(device_id) for device_id in devices] or NO_DEVICES_MESSAGE),
+        dcc.Store(id='known-devices', data=devices),
 
         dbc.Row([
             dbc.Col([
@@ -29,9 +52,15 @@ def create_layout() -> object:
 
             dbc.Col([
                 html.H4("Download Data"),
-                dbc.Button("Download CSV", id="download-csv-button", color="secondary", className="my-2"),
-                dbc.Button("Download JSON", id="download-json-button", color="secondary", className="my-2"),
-                dcc.Download(id="download-datafile")
+                dcc.DatePickerRange(id="download-range", clearable=True, className="my-2"),
+                dbc.Checkbox(id="download-gzip", label="gzip", value=False),
+                # Plain links: the export routes stream the file instead of building it in a callback
+                dbc.Button("Download CSV", id="download-csv-button", color="secondary", className="my-2 me-2",
+                           href="/export/sensor_data.csv", external_link=True),
+                dbc.Button("Download JSON", id="download-json-button", color="secondary", className="my-2 me-2",
+                           href="/export/sensor_data.ndjson", external_link=True),
+                dbc.Button("Download Parquet", id="download-parquet-button", color="secondary", className="my-2",
+                           href="/export/sensor_data.parquet", external_link=True),
             ], width=4),
         ]),
 
@@ -69,11 +98,23 @@ def create_layout() -> object:
 
         dbc.Button("Send to ESP32S3", id="send-code-button", color="primary", className="my-2"),
         html.Div(id="upload-status", className="text-info"),
+        html.Div(id="ota-jobs", className="text-monospace"),
+        dbc.Button("Stop Script", id="stop-script-button", color="warning", className="my-2"),
+        html.Div(id="stop-script-status", className="text-info"),
+        html.Div(id="script-status", className="text-monospace"),
 
         html.Hr(),
 
         html.H3("ESP32S3 Debug Output", className="text-center my-4"),
         html.Div(id="debug-output", className="text-monospace"),
 
-        dcc.Interval(id='update-interval', interval=2000, n_intervals=0)
+        # Push updates: assets/live.js sets these stores on /live notifications
+        dcc.Store(id='live-devices'),
+        dcc.Store(id='live-reset'),
+        dcc.Store(id='live-debug'),
+        dcc.Store(id='live-ota'),
+        dcc.Store(id='live-script'),
+        # Fallback polling, switched off by live.js while the /live stream is connected
+        dcc.Interval(id='update-interval', interval=2000, n_intervals=0),
+        dcc.Store(id='chart-width')  # Rendered chart width in px, drives the downsampling budget
     ])
@@ -0,0 +1,74 @@
+""" Push channel to open dashboards (server-sent events on /live).
+
+The ingestion path publishes small "something changed" notifications here and every
+connected browser tab receives them within milliseconds; app/assets/live.js turns them into
+Dash store updates that trigger only the callbacks that have new work to do.
+"""
+import itertools
+import json
+import queue
+import threading
+
+from flask import Response
+
+LIVE_KEEPALIVE = 15  # Seconds between keepalive comments on an idle stream
+LIVE_QUEUE_SIZE = 256  # Notifications buffered per tab before new ones are dropped
+LIVE_RETRY_MS = 2000  # Browser reconnect delay after the stream drops
+
+# Event names, mirrored in app/assets/live.js
+EVENT_READINGS = 'readings'  # New readings committed for a board: {'device'}
+EVENT_DEVICE = 'device'      # A board published for the first time: {'device'}
+EVENT_RESET = 'reset'        # Stored readings were deleted; charts redraw
+EVENT_DEBUG = 'debug'        # New line on the debug topic
+EVENT_OTA = 'ota'            # An OTA job changed state: {'job'}
+EVENT_SCRIPT = 'script'      # A board reported its user-script state: {'device'}
+
+_subscribers = set()
+_lock = threading.Lock()
+_seq = itertools.count(1)
+
+
+# ------------------------- Publishing -------------------------
+def publish(event, **data):
+    """ Sends one notification to every connected tab; costs nothing when none are connected. """
+    if not _subscribers:
+        return
+    data['seq'] = next(_seq)  # Lets the browser tell two otherwise identical notifications apart
+    message = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    with _lock:
+        subscribers = list(_subscribers)
+    for subscriber in subscribers:
+        try:
+            subscriber.put_nowait(message)
+        except queue.Full:
+            pass  # Stalled tab: it still gets the next notification once it drains
+
+
+def subscriber_count():
+    return len(_subscribers)
+
+
+# ------------------------- Streaming -------------------------
+def _stream():
+    """ Yields SSE messages for one tab until it disconnects. """
+    subscriber = queue.Queue(LIVE_QUEUE_SIZE)
+    with _lock:
+        _subscribers.add(subscriber)
+    try:
+        yield f"retry: {LIVE_RETRY_MS}\n\n"
+        while True:
+            try:
+                yield subscriber.get(timeout=LIVE_KEEPALIVE)
+            except queue.Empty:
+                yield ": keepalive\n\n"  # Also how a closed connection is noticed
+    finally:
+        with _lock:
+            _subscribers.discard(subscriber)
+
+
+def register_live_routes(server):
+    """ Adds the /live event stream to the Flask server. """
+    @server.route('/live')
+    def live_stream():
+        return Response(_stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -0,0 +1,262 @@
+import cProfile
+import io
+import itertools
+import pstats
+import threading
+import time
+
+from flask import Response, g, request
+
+try:
+    from pyinstrument import Profiler as SamplingProfiler
+except ImportError:  # Optional: pip install pyinstrument
+    SamplingProfiler = None
+
+# Buckets (upper bounds) for the histograms
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# Callback profiling: 'cprofile' (deterministic, stdlib) or 'pyinstrument' (sampling, if installed)
+PROFILER = 'pyinstrument' if SamplingProfiler is not None else 'cprofile'
+PROFILE_SAMPLE_EVERY = 10  # Profile one call in this many of each enabled callback
+PROFILE_TOP = 40  # Functions listed in a cProfile report
+
+_DASH_UPDATE_PATH = '/_dash-update-component'
+
+_lock = threading.Lock()
+_metrics = {}  # name -> {'type', 'help', 'buckets', 'values': {label tuple: value or [bucket counts, sum, count]}}
+_collectors = []  # Functions returning (name, type, help, [(labels dict, value), ...]) at scrape time
+_profiled = {}  # callback name -> {'calls': call counter, 'report': pstats.Stats, report text or None}
+
+
+# ------------------------- Registry -------------------------
+def counter(name, help_text):
+    _metrics.setdefault(name, {'type': 'counter', 'help': help_text, 'buckets': None, 'values': {}})
+    return name
+
+
+def histogram(name, help_text, buckets=LATENCY_BUCKETS):
+    _metrics.setdefault(name, {'type': 'histogram', 'help': help_text, 'buckets': tuple(buckets), 'values': {}})
+    return name
+
+
+def inc(name, value=1, **labels):
+    """ Adds value to a counter. """
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        values = _metrics[name]['values']
+        values[key] = values.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    """ Records one observation in a histogram. """
+    metric = _metrics[name]
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        entry = metric['values'].get(key)
+        if entry is None:
+            entry = metric['values'][key] = [[0] * len(metric['buckets']), 0.0, 0]
+        for i, bound in enumerate(metric['buckets']):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+
+
+def register_collector(collector):
+    """ Adds a function called on every scrape that returns extra (name, type, help, samples) metrics. """
+    _collectors.append(collector)
+
+
+def get_value(name, **labels):
+    """ Current value of a counter, or (bucket counts, sum, count) of a histogram; for tools and tests. """
+    with _lock:
+        value = _metrics[name]['values'].get(tuple(sorted(labels.items())))
+        return value if not isinstance(value, list) else (list(value[0]), value[1], value[2])
+
+
+# ------------------------- Prometheus Text Format -------------------------
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """ Returns every metric in the Prometheus text exposition format (version 0.0.4). """
+    lines = []
+    with _lock:
+        for name, metric in _metrics.items():
+            if not metric['values']:
+                continue
+            lines += [f"# HELP {name} {metric['help']}", f"# TYPE {name} {metric['type']}"]
+            for key, value in sorted(metric['values'].items()):
+                if metric['type'] != 'histogram':
+                    lines.append(f"{name}{_labels(key)} {_number(value)}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, n in zip(metric['buckets'], counts):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{_labels(key, [('le', _number(bound))])} {cumulative}")
+                lines.append(f"{name}_bucket{_labels(key, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{_labels(key)} {_number(total)}")
+                lines.append(f"{name}_count{_labels(key)} {count}")
+    for collector in _collectors:
+        try:
+            for name, kind, help_text, samples in collector():
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                lines += [f"{name}{_labels(sorted(labels.items()))} {_number(value)}" for labels, value in samples]
+        except Exception as e:
+            print(f"Error collecting metrics: {e}")
+    return "\n".join(lines) + "\n"
+
+
+# ------------------------- Metrics Used Across the App -------------------------
+CALLBACK_SECONDS = histogram('remoteiot_callback_duration_seconds',
+                             "Time to serve a Dash callback request, including (de)serialisation.")
+CALLBACK_BYTES = histogram('remoteiot_callback_response_bytes', "Size of Dash callback responses.", BYTES_BUCKETS)
+CALLBACK_REQUESTS = counter('remoteiot_callback_requests_total',
+                            "Dash callback requests by outcome (ok, prevented = PreventUpdate, error).")
+MQTT_MESSAGES = counter('remoteiot_mqtt_messages_total', "MQTT messages received, by topic.")
+MQTT_PARSE_FAILURES = counter('remoteiot_mqtt_parse_failures_total', "MQTT messages that could not be parsed, by topic.")
+DB_COMMIT_SECONDS = histogram('remoteiot_db_commit_seconds', "Time to insert and commit one ingestion batch.")
+DB_BATCH_ROWS = histogram('remoteiot_db_batch_rows', "Rows per committed ingestion batch.",
+                          (1, 5, 10, 25, 50, 100, 200, 500, 1000, 5000))
+
+
+# ------------------------- Callback Instrumentation -------------------------
+def _callback_name(app, output):
+    entry = app.callback_map.get(output)
+    if entry is None:
+        return output
+    func = entry.get('callback')
+    return getattr(func, '__name__', None) or output
+
+
+def instrument_callbacks(app):
+    """ Times every Dash callback request on app.server, records its response size and outcome,
+    and profiles the callbacks enabled with enable_profiling(). Call after register_callbacks(app). """
+    server = app.server
+
+    @server.before_request
+    def _start_callback_timer():
+        if request.path != _DASH_UPDATE_PATH:
+            return
+        body = request.get_json(silent=True) or {}
+        g.callback_name = _callback_name(app, body.get('output', ''))
+        g.callback_started = time.perf_counter()
+        g.callback_profiler = _start_profiler(g.callback_name)
+
+    @server.after_request
+    def _record_callback(response):
+        started = g.pop('callback_started', None)
+        if started is None:
+            return response
+        name = g.pop('callback_name')
+        _stop_profiler(name, g.pop('callback_profiler', None))
+        observe(CALLBACK_SECONDS, time.perf_counter() - started, callback=name)
+        if response.status_code >= 500:
+            outcome = 'error'
+        elif response.status_code == 204:
+            outcome = 'prevented'
+        else:
+            outcome = 'ok'
+            if not response.is_streamed:
+                observe(CALLBACK_BYTES, response.calculate_content_length() or 0, callback=name)
+        inc(CALLBACK_REQUESTS, callback=name, outcome=outcome)
+        return response
+
+
+# ------------------------- Profiling -------------------------
+def enable_profiling(callback_name, enabled=True):
+    """ Starts (or stops) profiling one callback in PROFILE_SAMPLE_EVERY of its calls. """
+    with _lock:
+        if enabled:
+            _profiled.setdefault(callback_name, {'calls': itertools.count(), 'report': None})
+        else:
+            _profiled.pop(callback_name, None)
+
+
+def _start_profiler(name):
+    with _lock:
+        state = _profiled.get(name)
+        if state is None or next(state['calls']) % PROFILE_SAMPLE_EVERY:
+            return None
+    try:
+        if PROFILER == 'pyinstrument' and SamplingProfiler is not None:
+            profiler = SamplingProfiler()
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+    except ValueError:
+        return None  # Another profiler is already running in this process (Python 3.12+); skip this call
+    return profiler
+
+
+def _stop_profiler(name, profiler):
+    if profiler is None:
+        return
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        with _lock:
+            state = _profiled.get(name)
+            if state is not None:
+                # Accumulate over all sampled calls
+                if state['report'] is None:
+                    state['report'] = pstats.Stats(profiler)
+                else:
+                    state['report'].add(profiler)
+    else:
+        profiler.stop()
+        with _lock:
+            if name in _profiled:
+                _profiled[name]['report'] = profiler.output_text(unicode=True)  # Latest sampled call
+
+
+def profile_report(callback_name):
+    """ Returns the profile collected so far for a callback as text, or None. """
+    with _lock:
+        state = _profiled.get(callback_name)
+        report = state and state['report']
+        if report is None or isinstance(report, str):
+            return report
+        out = io.StringIO()
+        report.stream = out
+        report.sort_stats('cumulative').print_stats(PROFILE_TOP)
+        return out.getvalue()
+
+
+# ------------------------- Routes -------------------------
+def register_metrics_routes(server):
+    """ Adds /metrics (Prometheus text) and /metrics/profile/<callback> to the Flask server.
+
+    /metrics/profile/<callback>?enable=1 starts profiling that callback, ?enable=0 stops it,
+    and a plain GET returns the profile collected so far.
+    """
+    @server.route('/metrics')
+    def metrics_endpoint():
+        return Response(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    @server.route('/metrics/profile/<callback_name>')
+    def profile_endpoint(callback_name):
+        enable = request.args.get('enable')
+        if enable is not None:
+            enable_profiling(callback_name, enable in ('1', 'true', 'yes'))
+            state = "enabled" if enable in ('1', 'true', 'yes') else "disabled"
+            return Response(f"Profiling {state} for {callback_name} ({PROFILER}, 1 in {PROFILE_SAMPLE_EVERY} calls)\n",
+                            mimetype='text/plain')
+        report = profile_report(callback_name)
+        if report is None:
+            return Response(f"No profile for {callback_name} yet; enable it with ?enable=1\n",
+                            status=404, mimetype='text/plain')
+        return Response(report, mimetype='text/plain')
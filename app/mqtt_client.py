@@ -1,16 +1,25 @@
-import time
+import queue
 from collections import deque
 import paho.mqtt.client as mqtt
 import json
+import time
 from datetime import datetime
-from app.data_store import add_sensor_data
+from app.data_store import add_sensor_readings, DEFAULT_DEVICE_ID
+from app import live, metrics
+from app.sensor_codec import SENSOR_FORMATS, decode_readings, is_binary
 
 # MQTT configuration
 MQTT_BROKER = 'fa8abb9aa92b4c85bb9540320242427f.s1.eu.hivemq.cloud'
 MQTT_PORT = 8883
-MQTT_TOPIC = 'fyp/RemoteIoT'
+MQTT_TOPIC = 'fyp/RemoteIoT'  # Legacy single-board topic, stored as DEFAULT_DEVICE_ID
+MQTT_TOPIC_DEVICES = 'fyp/+/RemoteIoT'  # One topic level per board: fyp/<device_id>/RemoteIoT
 MQTT_TOPIC_CODE = 'fyp/code_update'
+MQTT_TOPIC_CODE_ACK = 'fyp/code_ack'  # Boards acknowledge OTA manifest/chunks here
 MQTT_TOPIC_DEBUG = 'fyp/debug_output'
+MQTT_TOPIC_CAPS = 'fyp/capabilities'  # Retained: payload formats this server understands
+MQTT_TOPIC_SCRIPT = 'fyp/script_control'  # Commands for the boards' user-script runner
+MQTT_TOPIC_SCRIPT_STATUS = 'fyp/script_status'  # Boards report user-script state here
+MQTT_TOPIC_FILES = 'fyp/+/files'  # Retained: SHA-256 of every script stored on a board
 MQTT_USER = 'ESP32S3-1'
 MQTT_PASSWORD = 'HiveMQ11'
 
@@ -20,45 +29,96 @@ client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
 client.tls_set()  # Enable TLS for secure connection
 
 debug_messages = deque(maxlen=100)
+ota_acks = queue.Queue()  # Parsed OTA acknowledgements, consumed by the OTA worker
+script_status = {}  # device id -> newest user-script status reported by that board
+device_files = {}  # device id -> {filename: sha256} of the scripts stored on that board
 
 def on_connect(client, userdata, flags, rc):
     print(f"Connected to MQTT Broker with result code {rc}")
     client.subscribe(MQTT_TOPIC)
+    client.subscribe(MQTT_TOPIC_DEVICES)
     client.subscribe(MQTT_TOPIC_DEBUG)
-    client.subscribe(MQTT_TOPIC_CODE)  # Subscribe to OTA updates
+    client.subscribe(MQTT_TOPIC_CODE_ACK)
+    client.subscribe(MQTT_TOPIC_SCRIPT_STATUS)
+    client.subscribe(MQTT_TOPIC_FILES)
+    # Boards read this before choosing between binary and JSON readings
+    client.publish(MQTT_TOPIC_CAPS, json.dumps({'sensor_formats': SENSOR_FORMATS}), qos=1, retain=True)
 
 
 def on_message(client, userdata, msg):
     """ Handles incoming MQTT messages """
+    metrics.inc(metrics.MQTT_MESSAGES, topic=msg.topic)
     try:
+        device_id = device_from_topic(msg.topic)
+        if device_id is not None and is_binary(msg.payload):
+            print(f"Received MQTT message on {msg.topic}: {len(msg.payload)} bytes binary")
+            if not process_binary_sensor_data(msg.payload, device_id):
+                metrics.inc(metrics.MQTT_PARSE_FAILURES, topic=msg.topic)
+            return
+
         payload = msg.payload.decode('utf-8')
         print(f"Received MQTT message on {msg.topic}: {payload}")
 
-        if msg.topic == MQTT_TOPIC:
-            process_sensor_data(payload)
+        if device_id is not None:
+            if not process_sensor_data(payload, device_id):
+                metrics.inc(metrics.MQTT_PARSE_FAILURES, topic=msg.topic)
         elif msg.topic == MQTT_TOPIC_DEBUG:
             process_debug_message(payload)
             debug_messages.append(payload)  # Save messages clearly
-        elif msg.topic == MQTT_TOPIC_CODE:
-            send_code_to_esp32(payload)  # Handle OTA update
+            live.publish(live.EVENT_DEBUG)
+        elif msg.topic == MQTT_TOPIC_CODE_ACK:
+            ota_acks.put(json.loads(payload))
+        elif msg.topic == MQTT_TOPIC_SCRIPT_STATUS:
+            process_script_status(payload)
+        elif msg.topic.startswith('fyp/') and msg.topic.endswith('/files'):
+            process_file_report(payload)
     except Exception as e:
+        metrics.inc(metrics.MQTT_PARSE_FAILURES, topic=msg.topic)
         print(f"Error processing MQTT message: {e}")
 
 
-def process_sensor_data(payload):
-    """ Parses and stores sensor data """
+def device_from_topic(topic):
+    """ Returns the board id for a sensor topic, or None if it is not a sensor topic. """
+    if topic == MQTT_TOPIC:
+        return DEFAULT_DEVICE_ID
+    parts = topic.split('/')
+    if len(parts) == 3 and parts[0] == 'fyp' and parts[2] == 'RemoteIoT' and parts[1]:
+        return parts[1]
+    return None
+
+
+def process_sensor_data(payload, device_id=DEFAULT_DEVICE_ID):
+    """ Parses and stores sensor data, one reading or a batched JSON array of them;
+    returns False if the payload could not be parsed. """
     try:
         data = json.loads(payload)
-        formatted_data = {
-            'timestamp': data.get('time', datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
-            'temp_dht11': data.get('DHT11_Temperature', 0),
-            'hum_dht11': data.get('DHT11_Humidity', 0),
-            'temp_ds18b20': data.get('DS18B20_Temperature', 0),
-            'light_intensity': data.get('Light_Intensity', 0)
-        }
-        add_sensor_data(formatted_data)
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        readings = [{
+            'device_id': device_id,
+            'timestamp': reading.get('time', now),
+            'temp_dht11': reading.get('DHT11_Temperature', 0),
+            'hum_dht11': reading.get('DHT11_Humidity', 0),
+            'temp_ds18b20': reading.get('DS18B20_Temperature', 0),
+            'light_intensity': reading.get('Light_Intensity', 0)
+        } for reading in (data if isinstance(data, list) else [data])]
+        add_sensor_readings(readings)  # A batch is committed in one transaction
+        return True
     except Exception as e:
         print(f"Error processing sensor data: {e}")
+        return False
+
+
+def process_binary_sensor_data(payload, device_id=DEFAULT_DEVICE_ID):
+    """ Stores the readings in a binary payload (app.sensor_codec); returns False if it could not be decoded. """
+    try:
+        readings = decode_readings(payload)
+    except ValueError as e:
+        print(f"Error processing sensor data: {e}")
+        return False
+    for reading in readings:
+        reading['device_id'] = device_id
+    add_sensor_readings(readings)
+    return True
 
 
 def process_debug_message(payload):
@@ -66,24 +126,41 @@ def process_debug_message(payload):
     print(f"ESP32 Debug Output: {payload}")
 
 
-def send_code_to_esp32(filename, code_string):
-    try:
-        new_client = mqtt.Client()
-        new_client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
-        new_client.tls_set()
-        new_client.connect(MQTT_BROKER, MQTT_PORT, 60)
-
-        payload = {
-            "filename": filename,        # e.g. "student_script.py"
-            "code": code_string          # full code text
-        }
-
-        new_client.publish("fyp/code_update", json.dumps(payload))
-        print("✅ Code sent to ESP32S3")
-        time.sleep(5)
-        new_client.disconnect()
-    except Exception as e:
-        print("MQTT OTA Send Error:", e)
+def process_script_status(payload):
+    """ Keeps the newest user-script status per board: running, finished, cancelled, timeout or error. """
+    status = json.loads(payload)
+    status['received'] = time.time()
+    script_status[status.get('device', DEFAULT_DEVICE_ID)] = status
+    live.publish(live.EVENT_SCRIPT, device=status.get('device'))
+
+
+def process_file_report(payload):
+    """ Keeps each board's stored-file hashes, which app/ota_jobs.py uses to send deltas. """
+    report = json.loads(payload)
+    device_files[report.get('device', DEFAULT_DEVICE_ID)] = report.get('files', {})
+
+
+def stop_script(device_id=None):
+    """ Asks one board (or every board) to cancel its running user script. """
+    command = {'action': 'stop'}
+    if device_id is not None:
+        command['device'] = device_id
+    client.publish(MQTT_TOPIC_SCRIPT, json.dumps(command), qos=1)
+
+
+def publish_and_wait(topic, payload, timeout=10.0):
+    """ Publishes on the shared connection and waits for the broker's QoS 1 acknowledgement.
+
+    Raises if the client is not connected or the PUBACK does not arrive within timeout seconds.
+    Called from the OTA worker (app.ota_jobs), never from a Dash callback.
+    """
+    if not client.is_connected():
+        raise ConnectionError("MQTT client is not connected")
+
+    info = client.publish(topic, payload, qos=1)
+    info.wait_for_publish(timeout)
+    if not info.is_published():
+        raise TimeoutError(f"No PUBACK from the broker within {timeout}s")
 
 
 def start_mqtt():
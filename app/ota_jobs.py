@@ -0,0 +1,383 @@
+import difflib
+import hashlib
+import itertools
+import json
+import queue
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from app import live, mqtt_client, precompile
+
+# OTA job configuration
+OTA_PUBLISH_TIMEOUT = 10.0  # Seconds to wait for the broker's PUBACK on each attempt
+OTA_ACK_TIMEOUT = 5.0  # Seconds to wait for the boards to acknowledge a manifest or chunk
+OTA_ACK_GRACE = 1.0  # After a manifest ack, seconds to wait for other boards not known in advance
+OTA_MAX_ATTEMPTS = 3  # Sends of the same manifest/chunk before a board is given up on
+OTA_RETRY_DELAY = 2.0  # Seconds between attempts when the broker is unreachable
+OTA_JOB_HISTORY = 50  # Finished jobs kept for the dashboard
+
+# Chunked transfer protocol (see receive_code_update in ota_core.py for the board side):
+#   1. JSON manifest: {"transfer", "filename", "size", "sha256", "chunks", "chunk_size"}
+#   2. Binary chunks: b"OC" + struct "!HHB" (transfer, seq, flags) + data, in seq order
+# The board answers every frame on MQTT_TOPIC_CODE_ACK with {"device", "transfer", "status", ...}:
+# "ok" with the next seq it expects (so lost or duplicate chunks just rewind/skip, and a
+# half-written file from an earlier transfer resumes where it stopped), "done" once the
+# SHA-256 of the written file matches, or "error". Every ack also carries "mpy" (the .mpy
+# format the board imports; see app/precompile.py), the manifest ack "zlib".
+#
+# Boards publish the SHA-256 of their stored scripts on fyp/<device>/files, so when every
+# reporting board holds the same version of the file the manifest can be smaller:
+#   - {"unchanged": true, "sha256"}: the board already has this exact file; it just reruns it.
+#   - {"patch": {"base", "sha256", "size"}}: the chunks carry a delta against the stored file
+#     (base), and sha256/size/chunks describe the delta. Its ops, back to back:
+#       COPY   "!BII" (1, offset in the old file, length)
+#       INSERT "!BI" (2, length) + the new bytes
+#     The board rebuilds the file next to the old one and checks patch["sha256"] before
+#     replacing it.
+# A board whose file does not match answers "error" and the worker sends the whole file.
+#
+# The code topic is shared by every board, so the worker tracks each board that acknowledges
+# the manifest separately: every chunk round sends the lowest seq any of them still needs
+# (boards that are ahead just repeat their ack), and the job is only delivered once all of
+# them answered "done". Follow-up transfers for some of the boards (the source instead of a
+# .mpy, the whole file instead of a delta) get their own transfer id and a "devices" list in
+# the manifest, so the other boards ignore them.
+OTA_CHUNK_SIZE = 2048  # Raw bytes per chunk; bounds the board's receive and write buffers
+OTA_CHUNK_MAGIC = b"OC"
+OTA_CHUNK_HEADER = struct.Struct("!HHB")
+OTA_FLAG_ZLIB = 0x01  # Chunk data is a zlib stream of its own
+OTA_COMPRESS = True  # Compress chunks when the board reports zlib support and it saves space
+OTA_DELTA = True  # Send deltas/skip unchanged files when the boards report their stored files
+OTA_DELTA_MAX_RATIO = 0.7  # Send a delta only when it is smaller than this share of the file
+OTA_BASE_CACHE_FILES = 32  # Delivered files kept as delta bases
+DELTA_COPY = 1
+DELTA_INSERT = 2
+DELTA_COPY_OP = struct.Struct("!BII")
+DELTA_INSERT_OP = struct.Struct("!BI")
+
+# Transfer kinds
+TRANSFER_FULL = 'full'
+TRANSFER_DELTA = 'delta'
+TRANSFER_UNCHANGED = 'unchanged'
+
+# Job states
+JOB_QUEUED = 'queued'
+JOB_SENDING = 'sending'
+JOB_DELIVERED = 'delivered'
+JOB_FAILED = 'failed'
+
+_jobs = OrderedDict()  # job id -> job dict, oldest first
+_jobs_lock = threading.Lock()
+_job_queue = queue.Queue()
+_job_ids = itertools.count(1)
+_transfer_ids = itertools.count(1)
+_worker_thread = None
+_sent_files = OrderedDict()  # sha256 -> bytes of recently delivered files, oldest first
+
+
+# ------------------------- Job Registry -------------------------
+def submit_ota_job(filename, code, fallback=None):
+    """ Queues a code upload (source text or compiled bytes) for the OTA worker and returns its
+    job id without waiting. fallback is a (filename, bytes) pair sent instead of a compiled .mpy
+    when the board reports that it cannot import it. """
+    data = code.encode('utf-8') if isinstance(code, str) else code
+    job_id = next(_job_ids)
+    job = {
+        'id': job_id,
+        'filename': filename,
+        'size': len(data),
+        'status': JOB_QUEUED,
+        'attempts': 0,
+        'error': None,
+        'boards': {},  # device -> 'sending', 'done' or why it failed, for every board that acked
+        'chunks': None,
+        'acked': 0,  # Chunks confirmed written by every board still receiving
+        'transfer': None,  # TRANSFER_FULL, TRANSFER_DELTA or TRANSFER_UNCHANGED
+        'sent': None,  # Bytes of file data sent (the delta's size for a delta)
+        'created': time.time(),
+        'finished': None,
+    }
+    with _jobs_lock:
+        _jobs[job_id] = job
+        _prune_jobs()
+    start_ota_worker()
+    _job_queue.put((job_id, data, fallback))
+    live.publish(live.EVENT_OTA, job=job_id)
+    return job_id
+
+
+def _prune_jobs():
+    """ Drops the oldest finished jobs beyond OTA_JOB_HISTORY (caller holds _jobs_lock). """
+    finished = [job_id for job_id, job in _jobs.items() if job['finished'] is not None]
+    for job_id in finished[:max(0, len(finished) - OTA_JOB_HISTORY)]:
+        del _jobs[job_id]
+
+
+def _update_job(job_id, **fields):
+    with _jobs_lock:
+        if job_id in _jobs:
+            _jobs[job_id].update(fields)
+    live.publish(live.EVENT_OTA, job=job_id)
+
+
+def get_job(job_id):
+    """ Returns a copy of one job, or None if it is unknown or has been pruned. """
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job else None
+
+
+def list_jobs(limit=10):
+    """ Returns copies of the most recent jobs, newest first. """
+    with _jobs_lock:
+        return [dict(job) for job in reversed(list(_jobs.values())[-limit:])]
+
+
+# ------------------------- OTA Worker -------------------------
+def build_chunk(transfer, seq, data, compress=False):
+    """ Encodes one chunk frame, zlib-compressing the data when that makes it smaller. """
+    flags = 0
+    if compress:
+        packed = zlib.compress(data)
+        if len(packed) < len(data):
+            data, flags = packed, OTA_FLAG_ZLIB
+    return OTA_CHUNK_MAGIC + OTA_CHUNK_HEADER.pack(transfer, seq, flags) + data
+
+
+def _publish(job_id, payload):
+    """ Publishes one manifest/chunk on the code topic, retrying while the broker is unreachable. """
+    for attempt in range(1, OTA_MAX_ATTEMPTS + 1):
+        try:
+            mqtt_client.publish_and_wait(mqtt_client.MQTT_TOPIC_CODE, payload, timeout=OTA_PUBLISH_TIMEOUT)
+            return
+        except Exception as e:
+            print(f"MQTT OTA Send Error (job {job_id}, attempt {attempt}/{OTA_MAX_ATTEMPTS}): {e}")
+            _update_job(job_id, error=str(e))
+            time.sleep(OTA_RETRY_DELAY)
+    raise ConnectionError(f"Could not publish to the broker after {OTA_MAX_ATTEMPTS} attempts")
+
+
+def _gather(job_id, payload, transfer, expected, grace=None):
+    """ Sends a frame and returns {device: newest ack} for this transfer.
+
+    Resends (up to OTA_MAX_ATTEMPTS) until every board in expected has answered. With grace,
+    expected is only a hint: once any board answered, the worker waits at most grace seconds
+    for more instead of resending.
+    """
+    acks = {}
+    for attempt in range(1, OTA_MAX_ATTEMPTS + 1):
+        _update_job(job_id, attempts=attempt)
+        _publish(job_id, payload)
+        deadline = last = time.monotonic() + OTA_ACK_TIMEOUT
+        while not (expected and expected <= set(acks)):
+            now = time.monotonic()
+            if acks and grace is not None:
+                deadline = min(deadline, last + grace)
+            if now >= deadline:
+                break
+            try:
+                ack = mqtt_client.ota_acks.get(timeout=deadline - now)
+            except queue.Empty:
+                break
+            if ack.get('transfer') == transfer and ack.get('device'):
+                acks[ack['device']] = ack
+                last = time.monotonic()
+        if (expected and expected <= set(acks)) or (acks and grace is not None):
+            return acks
+        _update_job(job_id, error="No acknowledgement from " + (", ".join(sorted(expected - set(acks)))
+                                                                 if expected else "any board"))
+    return acks
+
+
+def build_delta(base, data):
+    """ Encodes data as COPY/INSERT ops against base, matching whole lines (scripts are
+    mostly edited a few lines at a time). """
+    old, new = base.splitlines(keepends=True), data.splitlines(keepends=True)
+    offsets = list(itertools.accumulate((len(line) for line in old), initial=0))
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old, new, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            ops.append(DELTA_COPY_OP.pack(DELTA_COPY, offsets[i1], offsets[i2] - offsets[i1]))
+        elif j2 > j1:
+            inserted = b"".join(new[j1:j2])
+            ops.append(DELTA_INSERT_OP.pack(DELTA_INSERT, len(inserted)) + inserted)
+    return b"".join(ops)
+
+
+def _stored_hash(filename):
+    """ The hash of filename on the boards, if every board that reported its files has the same one. """
+    hashes = {files.get(filename) for files in list(mqtt_client.device_files.values())}
+    return hashes.pop() if len(hashes) == 1 else None
+
+
+def _remember_sent(data):
+    digest = hashlib.sha256(data).hexdigest()
+    with _jobs_lock:
+        _sent_files[digest] = data
+        _sent_files.move_to_end(digest)
+        while len(_sent_files) > OTA_BASE_CACHE_FILES:
+            _sent_files.popitem(last=False)
+
+
+def _plan(filename, data, delta=OTA_DELTA):
+    """ Chooses how to send data: returns (kind, manifest fields, payload to chunk). """
+    digest = hashlib.sha256(data).hexdigest()
+    fields = {'filename': filename, 'size': len(data), 'sha256': digest}
+    stored = _stored_hash(filename) if delta else None
+    if stored is not None and stored == digest:
+        return TRANSFER_UNCHANGED, dict(fields, unchanged=True), b""
+    with _jobs_lock:
+        base = _sent_files.get(stored)
+    if base is not None:
+        patch = build_delta(base, data)
+        if len(patch) < len(data) * OTA_DELTA_MAX_RATIO:
+            fields = {'filename': filename, 'size': len(patch), 'sha256': hashlib.sha256(patch).hexdigest(),
+                      'patch': {'base': stored, 'sha256': digest, 'size': len(data)}}
+            return TRANSFER_DELTA, fields, patch
+    return TRANSFER_FULL, fields, data
+
+
+def _chunk_count(fields, payload):
+    if fields.get('unchanged'):
+        return 0
+    return max(1, -(-len(payload) // OTA_CHUNK_SIZE))  # An empty file is still one (empty) chunk
+
+
+def _manifest(transfer, fields, payload):
+    return json.dumps({
+        'transfer': transfer,
+        **fields,
+        'chunks': _chunk_count(fields, payload),
+        'chunk_size': OTA_CHUNK_SIZE,
+    })
+
+
+def _start_transfers(job_id, filename, data, devices, fallback, delta=OTA_DELTA):
+    """ Announces data to devices (None = every board) and returns the transfers to run: this
+    one for the boards that accepted it, then the follow-ups for the boards that did not. """
+    kind, fields, payload = _plan(filename, data, delta)
+    transfer = {
+        'id': next(_transfer_ids) & 0xFFFF,
+        'filename': filename,
+        'data': data,
+        'kind': kind,
+        'payload': payload,
+        'chunks': _chunk_count(fields, payload),
+        'boards': {},  # device -> newest ack
+    }
+    if devices is not None:
+        fields = dict(fields, devices=sorted(devices))
+        expected, grace = set(devices), None
+    else:
+        # Boards that report their files are expected; others are waited for briefly
+        expected, grace = set(mqtt_client.device_files), OTA_ACK_GRACE
+    acks = _gather(job_id, _manifest(transfer['id'], fields, payload), transfer['id'], expected, grace)
+
+    source, full = set(), set()
+    for device, ack in acks.items():
+        if fallback is not None and ack.get('status') != 'done' and not precompile.mpy_compatible(data, ack.get('mpy')):
+            source.add(device)  # A different MicroPython release (or no .mpy support)
+        elif ack.get('status') == 'error' and kind != TRANSFER_FULL:
+            full.add(device)  # Its copy is not the one it reported (e.g. edited since)
+        else:
+            transfer['boards'][device] = ack
+    transfer['zlib'] = all(ack.get('zlib', False) for ack in transfer['boards'].values())
+    transfers = [transfer]
+    if source:
+        print(f"OTA job {job_id}: {', '.join(sorted(source))} cannot import {filename}, sending {fallback[0]} instead")
+        transfers += _start_transfers(job_id, fallback[0], fallback[1], source, None, delta)
+    if full:
+        print(f"OTA job {job_id}: {', '.join(sorted(full))} rejected the {kind} transfer, sending all of {filename}")
+        transfers += _start_transfers(job_id, filename, data, full, None, delta=False)
+    missing = set(devices or ()) - set(acks)
+    if missing:
+        transfer['boards'].update({device: {'status': 'error', 'error': "No acknowledgement"} for device in missing})
+    return transfers
+
+
+def _board_states(transfers):
+    states = {}
+    for transfer in transfers:
+        for device, ack in transfer['boards'].items():
+            status = ack.get('status')
+            states[device] = 'sending' if status == 'ok' else 'done' if status == 'done' else \
+                ack.get('error') or f"unexpected ack status {status!r}"
+    return states
+
+
+def _run_job(job_id, data, fallback=None):
+    job = get_job(job_id)
+    if job is None:
+        return
+    while not mqtt_client.ota_acks.empty():  # Drop acks left over from earlier transfers
+        mqtt_client.ota_acks.get_nowait()
+    _update_job(job_id, status=JOB_SENDING)
+    transfers = _start_transfers(job_id, job['filename'], data, None, fallback)
+    if not any(transfer['boards'] for transfer in transfers):
+        raise TimeoutError(f"No board acknowledged the upload after {OTA_MAX_ATTEMPTS} attempts")
+    main = next(transfer for transfer in transfers if transfer['boards'])  # Shown on the dashboard
+    _update_job(job_id, filename=main['filename'], size=len(main['data']), transfer=main['kind'],
+                sent=len(main['payload']), chunks=main['chunks'], boards=_board_states(transfers))
+
+    while True:
+        rounds = []
+        for transfer in transfers:
+            receiving = {}
+            for device, ack in transfer['boards'].items():
+                if ack.get('status') != 'ok':
+                    continue
+                if not 0 <= ack.get('next', 0) < transfer['chunks']:
+                    transfer['boards'][device] = {'status': 'error',
+                                                  'error': f"Asked for chunk {ack.get('next')} of {transfer['chunks']}"}
+                    continue
+                receiving[device] = ack
+            if receiving:
+                rounds.append((transfer, receiving))
+        if not rounds:
+            break
+        for transfer, receiving in rounds:
+            # Boards that are further along ignore this chunk and repeat their ack
+            seq = min(ack.get('next', 0) for ack in receiving.values())
+            if transfer is main:
+                _update_job(job_id, acked=seq, error=None)
+            payload = transfer['payload'][seq * OTA_CHUNK_SIZE:(seq + 1) * OTA_CHUNK_SIZE]
+            chunk = build_chunk(transfer['id'], seq, payload, OTA_COMPRESS and transfer['zlib'])
+            acks = _gather(job_id, chunk, transfer['id'], set(receiving))
+            for device in receiving:
+                transfer['boards'][device] = acks.get(device) or {'status': 'error', 'error': "No acknowledgement"}
+            for device, ack in acks.items():
+                if not any(device in other['boards'] for other in transfers):
+                    transfer['boards'][device] = ack  # Its manifest ack was lost, but it is receiving
+        _update_job(job_id, boards=_board_states(transfers))
+
+    states = _board_states(transfers)
+    for transfer in transfers:
+        if any(ack.get('status') == 'done' for ack in transfer['boards'].values()):
+            _remember_sent(transfer['data'])
+    _update_job(job_id, boards=states)
+    failed = {device: state for device, state in states.items() if state != 'done'}
+    if failed:
+        raise RuntimeError("Not delivered to " + "; ".join(f"{device}: {state}" for device, state in sorted(failed.items())))
+    _update_job(job_id, status=JOB_DELIVERED, acked=main['chunks'], error=None, finished=time.time())
+    print(f"✅ OTA job {job_id}: {main['filename']} ({main['kind']}) written and verified on {', '.join(sorted(states))}")
+
+
+def _ota_worker_loop():
+    while True:
+        job_id, data, fallback = _job_queue.get()
+        try:
+            _run_job(job_id, data, fallback)
+        except Exception as e:
+            print(f"❌ OTA job {job_id} failed: {e}")
+            _update_job(job_id, status=JOB_FAILED, error=str(e), finished=time.time())
+
+
+def start_ota_worker():
+    """ Starts the background OTA worker once. Jobs run one at a time, in submission order. """
+    global _worker_thread
+    with _jobs_lock:
+        if _worker_thread is None or not _worker_thread.is_alive():
+            _worker_thread = threading.Thread(target=_ota_worker_loop, name="ota-worker", daemon=True)
+            _worker_thread.start()
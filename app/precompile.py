@@ -0,0 +1,135 @@
+""" Compile stage for uploaded MicroPython scripts (see upload_code in app/callbacks.py).
+
+Every upload is syntax-checked on the server, so a broken script never reaches a board. When
+mpy-cross is available (pip install mpy-cross, or an mpy-cross binary on PATH) the script is
+also cross-compiled to .mpy bytecode, which the boards import directly instead of parsing and
+compiling the source in their small heap. Compiled files are cached by content hash.
+
+The mpy-cross version must match the boards' MicroPython release; boards report the .mpy
+format they load (sys.implementation._mpy) when they acknowledge an OTA manifest, and
+app/ota_jobs.py sends the source instead when it does not match.
+"""
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+
+try:
+    import mpy_cross
+except ImportError:  # Optional: pip install mpy-cross
+    mpy_cross = None
+
+MPY_CROSS = None  # Path of the mpy-cross binary; None = the mpy_cross package's, else "mpy-cross" on PATH
+MPY_MARCH = 'xtensawin'  # Native code architecture of the ESP32-S3 (for @micropython.native/viper)
+MPY_CROSS_ARGS = ()  # Extra mpy-cross options, e.g. ('-O2',)
+MPY_TIMEOUT = 30  # Seconds one compile may take
+MPY_CACHE_DIR = 'mpy_cache'
+MPY_CACHE_MAX_FILES = 200  # Newest compiled scripts kept on disk
+
+# Boards import .mpy scripts, so __name__ would be the module name instead of "__main__"
+_MAIN_PRELUDE = "__name__ = '__main__'\n"
+
+_tool_versions = {}  # mpy-cross path -> its --version output, part of the cache key
+
+
+class ScriptSyntaxError(ValueError):
+    """ The uploaded script does not compile; the message says where. """
+
+
+def _mpy_cross_path():
+    if MPY_CROSS is not None:
+        return MPY_CROSS
+    if mpy_cross is not None:
+        mpy_cross.fix_perms()
+        return mpy_cross.mpy_cross
+    return shutil.which('mpy-cross')
+
+
+def _tool_version(binary):
+    if binary not in _tool_versions:
+        result = subprocess.run([binary, '--version'], capture_output=True, text=True, timeout=MPY_TIMEOUT)
+        _tool_versions[binary] = result.stdout.strip()
+    return _tool_versions[binary]
+
+
+def check_syntax(source, filename):
+    """ Raises ScriptSyntaxError if the source is not valid Python. """
+    try:
+        compile(source, filename, 'exec')
+    except (SyntaxError, ValueError) as e:
+        line = f", line {e.lineno}" if getattr(e, 'lineno', None) else ""
+        raise ScriptSyntaxError(f"{filename}{line}: {getattr(e, 'msg', e)}") from None
+
+
+def compile_script(filename, source):
+    """ Syntax-checks an uploaded script and returns the (filename, bytes) to send to the boards:
+    <name>.mpy when mpy-cross is available, otherwise the checked source unchanged.
+
+    Raises ScriptSyntaxError when the script does not compile.
+    """
+    check_syntax(source, filename)
+    binary = _mpy_cross_path()
+    stem, ext = os.path.splitext(os.path.basename(filename))
+    if binary is None or ext != '.py' or not stem.isidentifier():
+        return filename, source.encode('utf-8')  # Boards import .mpy files, so the name must be a module name
+
+    if '__name__' in source:
+        source = _MAIN_PRELUDE + source  # Only then, as it shifts line numbers by one
+    args = [f'-march={MPY_MARCH}', *MPY_CROSS_ARGS]
+    key = hashlib.sha256("\0".join([_tool_version(binary), *args, filename, source]).encode('utf-8')).hexdigest()
+    target = stem + '.mpy'
+    path = os.path.join(MPY_CACHE_DIR, key + '.mpy')
+    try:
+        with open(path, 'rb') as f:
+            return target, f.read()
+    except FileNotFoundError:
+        pass
+
+    with tempfile.TemporaryDirectory() as workdir:
+        src = os.path.join(workdir, stem + '.py')
+        out = os.path.join(workdir, target)
+        with open(src, 'w', encoding='utf-8') as f:
+            f.write(source)
+        result = subprocess.run([binary, *args, '-s', os.path.basename(filename), '-o', out, src],
+                                capture_output=True, text=True, timeout=MPY_TIMEOUT)
+        if result.returncode != 0:
+            # 'Traceback ...', '  File "<filename>", line N', 'SyntaxError: ...'
+            message = [line.strip() for line in result.stderr.strip().splitlines()[1:]]
+            raise ScriptSyntaxError(" ".join(message) or f"mpy-cross failed with code {result.returncode}")
+        with open(out, 'rb') as f:
+            data = f.read()
+
+    os.makedirs(MPY_CACHE_DIR, exist_ok=True)
+    partial = path + '.tmp'
+    with open(partial, 'wb') as f:
+        f.write(data)
+    os.replace(partial, path)
+    _prune_cache()
+    return target, data
+
+
+def _prune_cache():
+    """ Deletes the least recently written compiled files beyond MPY_CACHE_MAX_FILES. """
+    try:
+        paths = [os.path.join(MPY_CACHE_DIR, name) for name in os.listdir(MPY_CACHE_DIR) if name.endswith('.mpy')]
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:max(0, len(paths) - MPY_CACHE_MAX_FILES)]:
+            os.remove(path)
+    except OSError as e:
+        print(f"Error pruning the .mpy cache: {e}")
+
+
+def mpy_compatible(data, board_mpy):
+    """ Whether a board reporting sys.implementation._mpy == board_mpy can import this .mpy file.
+
+    The header holds b'M', the format version and (architecture << 2 | sub-version); the board
+    value packs version | sub-version << 8 | architecture << 10. Like MicroPython's loader, only
+    files with native code (architecture other than 0) need a matching architecture and sub-version.
+    """
+    if board_mpy is None or len(data) < 4 or data[0] != ord('M'):
+        return False
+    version, sub_version, arch = data[1], data[2] & 3, data[2] >> 2
+    if version != board_mpy & 0xFF:
+        return False
+    return arch == 0 or (arch == board_mpy >> 10 and sub_version == (board_mpy >> 8) & 3)
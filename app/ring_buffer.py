@@ -0,0 +1,102 @@
+import threading
+
+import numpy as np
+
+
+class RingBuffer:
+    """ Fixed-capacity, column-oriented store of the newest readings of one board.
+
+    Ids, timestamps (epoch ms) and every value column live in preallocated NumPy arrays;
+    appending overwrites the oldest slots in place, and reads return copies so callers can
+    slice them freely while the writer keeps appending.
+    """
+
+    def __init__(self, capacity, columns, holds_all=False):
+        self.capacity = capacity
+        self.columns = tuple(columns)
+        self._ids = np.zeros(capacity, dtype=np.int64)
+        self._ts = np.zeros(capacity, dtype=np.int64)
+        self._values = np.full((len(self.columns), capacity), np.nan)
+        self._start = 0  # Slot of the oldest reading
+        self._size = 0
+        # Every reading of the board with id > complete_after is in the buffer. When holds_all is
+        # set the buffer is the board's whole history (it has not evicted anything yet).
+        self.complete_after = None
+        self.holds_all = holds_all
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def extend(self, ids, ts_ms, values):
+        """ Appends readings in id order. values has one row per column and one column per reading. """
+        n = len(ids)
+        if not n:
+            return
+        ids = np.asarray(ids, dtype=np.int64)
+        ts_ms = np.asarray(ts_ms, dtype=np.int64)
+        values = np.asarray(values, dtype=float)
+        with self._lock:
+            if self.complete_after is None:
+                self.complete_after = int(ids[0]) - 1
+            overflow = self._size + n - self.capacity
+            if overflow > 0:
+                self.holds_all = False
+                if n >= self.capacity:
+                    # Only the newest `capacity` of the new readings survive
+                    if n > self.capacity:
+                        self.complete_after = int(ids[n - self.capacity - 1])
+                    elif self._size:
+                        self.complete_after = int(self._ids[(self._start + self._size - 1) % self.capacity])
+                    ids, ts_ms, values = ids[-self.capacity:], ts_ms[-self.capacity:], values[:, -self.capacity:]
+                    n = self.capacity
+                    self._start, self._size = 0, 0
+                else:
+                    self.complete_after = int(self._ids[(self._start + overflow - 1) % self.capacity])
+                    self._start = (self._start + overflow) % self.capacity
+                    self._size -= overflow
+            slots = (self._start + self._size + np.arange(n)) % self.capacity
+            self._ids[slots] = ids
+            self._ts[slots] = ts_ms
+            self._values[:, slots] = values
+            self._size += n
+
+    def clear(self):
+        with self._lock:
+            self._start, self._size = 0, 0
+            self.complete_after = None
+            self.holds_all = False
+
+    def _slots(self):
+        return (self._start + np.arange(self._size)) % self.capacity
+
+    def _take(self, slots):
+        columns = {'id': self._ids[slots], 'ts_ms': self._ts[slots]}
+        for i, name in enumerate(self.columns):
+            columns[name] = self._values[i, slots]
+        return columns
+
+    def since_id(self, after_id, limit=None):
+        """ Columns of the readings with id > after_id (oldest first, at most limit of them),
+        or None if some of them have already been evicted. """
+        with self._lock:
+            if self.complete_after is None or after_id < self.complete_after:
+                return None
+            slots = self._slots()
+            slots = slots[np.searchsorted(self._ids[slots], after_id, side='right'):]
+            return self._take(slots[:limit] if limit else slots)
+
+    def time_range(self, start_ms=None, end_ms=None):
+        """ Columns of the readings with start_ms <= ts_ms <= end_ms (None = open), or None if
+        readings older than the buffer might fall inside the range. """
+        with self._lock:
+            if not self.holds_all and (start_ms is None or not self._size or start_ms < self._ts[self._start]):
+                return None
+            slots = self._slots()
+            ts = self._ts[slots]
+            mask = np.ones(len(slots), dtype=bool)
+            if start_ms is not None:
+                mask &= ts >= start_ms
+            if end_ms is not None:
+                mask &= ts <= end_ms
+            return self._take(slots[mask])
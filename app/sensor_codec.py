@@ -0,0 +1,88 @@
+""" Compact binary sensor payloads (see publish_data in ota_core.py for the board side).
+
+Format 1, all fields big-endian:
+    header  "!2sBB"  magic b"SR", format version, record count
+    record  "!Ihhhh" board time in seconds since 2000-01-01, DHT11 temperature (°C),
+                     DHT11 humidity (%), DS18B20 temperature (hundredths of °C), light (raw ADC)
+A field of -32768 means the sensor returned nothing. One reading is 16 bytes instead of ~130
+bytes of JSON. Boards only switch to it after the server advertises it on MQTT_TOPIC_CAPS,
+so an older dashboard keeps receiving JSON.
+"""
+import struct
+from datetime import datetime, timedelta
+
+import numpy as np
+
+SENSOR_MAGIC = b"SR"
+SENSOR_FORMAT_VERSION = 1
+SENSOR_HEADER = struct.Struct("!2sBB")
+SENSOR_RECORD = np.dtype([
+    ('time', '>u4'),
+    ('temp_dht11', '>i2'),
+    ('hum_dht11', '>i2'),
+    ('temp_ds18b20', '>i2'),
+    ('light_intensity', '>i2'),
+])
+SENSOR_RECORD_STRUCT = struct.Struct("!Ihhhh")  # Same layout, for small payloads
+SENSOR_MISSING = -32768
+DS18B20_SCALE = 100
+SENSOR_EPOCH = np.datetime64('2000-01-01T00:00:00', 's')
+_EPOCH_DATETIME = datetime(2000, 1, 1)
+VECTORIZE_MIN_READINGS = 32  # Below this NumPy's per-call overhead outweighs the per-row work
+
+# Advertised to the boards, preferred first
+SENSOR_FORMATS = [f"sr{SENSOR_FORMAT_VERSION}", 'json']
+
+
+def is_binary(payload):
+    return payload[:2] == SENSOR_MAGIC
+
+
+def decode_readings(payload):
+    """ Decodes a binary payload into a list of reading dicts (as passed to add_sensor_readings).
+
+    Raises ValueError if the payload is truncated or uses an unknown format version.
+    """
+    if len(payload) < SENSOR_HEADER.size:
+        raise ValueError("Binary sensor payload is shorter than its header")
+    magic, version, count = SENSOR_HEADER.unpack_from(payload)
+    if magic != SENSOR_MAGIC or version != SENSOR_FORMAT_VERSION:
+        raise ValueError(f"Unsupported binary sensor payload version {version}")
+    if len(payload) != SENSOR_HEADER.size + count * SENSOR_RECORD.itemsize:
+        raise ValueError(f"Binary sensor payload has {len(payload)} bytes for {count} readings")
+    if count < VECTORIZE_MIN_READINGS:
+        return [_reading(*fields) for fields in SENSOR_RECORD_STRUCT.iter_unpack(payload[SENSOR_HEADER.size:])]
+    records = np.frombuffer(payload, dtype=SENSOR_RECORD, count=count, offset=SENSOR_HEADER.size)
+
+    # Whole columns at once; NULL where the board had no reading
+    timestamps = np.char.replace(np.datetime_as_string(
+        SENSOR_EPOCH + records['time'].astype('timedelta64[s]'), unit='s'), 'T', ' ')
+    columns = {'timestamp': timestamps.tolist()}
+    for name in ('temp_dht11', 'hum_dht11', 'temp_ds18b20', 'light_intensity'):
+        values = records[name]
+        scaled = values / DS18B20_SCALE if name == 'temp_ds18b20' else values
+        columns[name] = np.where(values == SENSOR_MISSING, None, scaled.astype(object)).tolist()
+    return [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+
+def _reading(seconds, temp_dht11, hum_dht11, temp_ds18b20, light):
+    """ One decoded record, for payloads too small to vectorize. """
+    return {
+        'timestamp': (_EPOCH_DATETIME + timedelta(seconds=seconds)).isoformat(' '),
+        'temp_dht11': None if temp_dht11 == SENSOR_MISSING else temp_dht11,
+        'hum_dht11': None if hum_dht11 == SENSOR_MISSING else hum_dht11,
+        'temp_ds18b20': None if temp_ds18b20 == SENSOR_MISSING else temp_ds18b20 / DS18B20_SCALE,
+        'light_intensity': None if light == SENSOR_MISSING else light,
+    }
+
+
+def encode_readings(readings):
+    """ Encodes reading dicts ('timestamp' as 'YYYY-MM-DD HH:MM:SS') the way a board does;
+    used by the benchmarks and board simulators. """
+    records = np.zeros(len(readings), dtype=SENSOR_RECORD)
+    times = np.array([r['timestamp'] for r in readings], dtype='datetime64[s]')
+    records['time'] = (times - SENSOR_EPOCH).astype(np.int64)
+    for name in ('temp_dht11', 'hum_dht11', 'temp_ds18b20', 'light_intensity'):
+        scale = DS18B20_SCALE if name == 'temp_ds18b20' else 1
+        records[name] = [SENSOR_MISSING if r[name] is None else round(r[name] * scale) for r in readings]
+    return SENSOR_HEADER.pack(SENSOR_MAGIC, SENSOR_FORMAT_VERSION, len(readings)) + records.tobytes()
@@ -0,0 +1,65 @@
+""" Helpers shared by the benchmark scripts. """
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_DIR, 'benchmarks', 'results')
+DATA_DIR = os.path.join(REPO_DIR, 'benchmarks', 'data')
+
+
+def import_app(prefix):
+    """ Makes the app package importable from a scratch directory and returns that directory.
+
+    Importing app.data_store opens ./sensor_data.db, so the benchmarks chdir somewhere
+    harmless first; pass absolute paths for anything given on the command line.
+    """
+    workdir = tempfile.mkdtemp(prefix=prefix)
+    os.chdir(workdir)
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    return workdir
+
+
+def environment():
+    """ Where and on what the benchmark ran, stored next to the results. """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+    }
+
+
+def default_output(name):
+    return os.path.join(RESULTS_DIR, f"{name}-{datetime.now():%Y%m%d-%H%M%S}.json")
+
+
+def write_results(path, results):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {path}")
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def parse_count(text):
+    """ '1k' -> 1000, '2.5m' -> 2500000, '500' -> 500. """
+    text = text.strip().lower()
+    scale = {'k': 1000, 'm': 1000000}.get(text[-1:], 1)
+    return int(float(text[:-1] if scale > 1 else text) * scale)
@@ -0,0 +1,114 @@
+""" Fills SQLite databases with realistic multi-year sensor history for the query benchmarks.
+
+Readings follow seasonal and daily temperature cycles with noise, humidity that falls as it
+gets warmer, a daylight curve for the light sensor and occasional DHT11 dropouts (NULLs),
+spread round-robin over several boards. Generation is deterministic for a given seed.
+
+    python benchmarks/generate_dataset.py --rows 1k 100k 1m 10m
+    python benchmarks/generate_dataset.py --rows 100k --db sensor_data.db   # fill a specific file
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+from common import DATA_DIR, import_app, parse_count
+
+DAY_MS = 24 * 60 * 60 * 1000
+YEAR_MS = 365 * DAY_MS
+START = np.datetime64('2022-01-01T00:00:00', 'ms')
+CHUNK_ROWS = 200000  # Rows generated and inserted per transaction
+DROPOUT_RATE = 0.001  # Share of readings where the DHT11 returned nothing
+
+_INSERT_SQL = '''INSERT INTO sensor_data
+                 (timestamp, temp_dht11, hum_dht11, temp_ds18b20, light_intensity, device_id, ts_ms)
+                 VALUES (?, ?, ?, ?, ?, ?, ?)'''
+
+
+def dataset_path(rows):
+    return os.path.join(DATA_DIR, f"sensor_data-{rows}.db")
+
+
+def generate_chunk(rng, first_row, count, devices, step_ms):
+    """ Returns rows first_row .. first_row + count - 1 as a list of insert tuples. """
+    index = np.arange(first_row, first_row + count)
+    device = index % devices
+    ts_ms = START.astype(np.int64) + (index // devices) * step_ms
+    day = (ts_ms % DAY_MS) / DAY_MS
+    year = ((ts_ms - START.astype(np.int64)) % YEAR_MS) / YEAR_MS
+
+    # Warmest in July and mid-afternoon; every board sits in a slightly different spot
+    temp = (22 + 6 * np.sin(2 * np.pi * (year - 0.3)) + 4 * np.sin(2 * np.pi * (day - 0.375))
+            + device * 0.7 + rng.normal(0, 0.5, count))
+    temp_ds18b20 = np.round(temp + rng.normal(0, 0.2, count), 4)
+    temp_dht11 = np.round(temp).astype(np.int64).astype(object)
+    hum_dht11 = np.clip(np.round(60 - 1.5 * (temp - 22) + rng.normal(0, 5, count)), 20, 95).astype(np.int64).astype(object)
+    light = np.clip(3500 * np.sin(2 * np.pi * (day - 0.25)) + rng.normal(0, 100, count), 0, 4095).astype(np.int64)
+
+    dropout = rng.random(count) < DROPOUT_RATE
+    temp_dht11[dropout] = None
+    hum_dht11[dropout] = None
+
+    timestamps = np.char.replace(np.datetime_as_string(ts_ms.astype('datetime64[ms]'), unit='s'), 'T', ' ')
+    names = np.array([f"board{d}" for d in range(devices)])[device]
+    return list(zip(timestamps.tolist(), temp_dht11.tolist(), hum_dht11.tolist(), temp_ds18b20.tolist(),
+                    light.tolist(), names.tolist(), ts_ms.tolist()))
+
+
+def generate(data_store, path, rows, years, devices, seed):
+    if os.path.exists(path):
+        os.remove(path)
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    # Bulk load: no fsync per transaction
+    data_store.configure_db(path, synchronous='OFF')
+    rng = np.random.default_rng(seed)
+    step_ms = max(1000, int(years * YEAR_MS / max(1, rows // devices)))
+    started = time.perf_counter()
+    with data_store.get_connection() as conn:
+        for first in range(0, rows, CHUNK_ROWS):
+            conn.executemany(_INSERT_SQL, generate_chunk(rng, first, min(CHUNK_ROWS, rows - first), devices, step_ms))
+            conn.commit()
+            print(f"\r{path}: {min(first + CHUNK_ROWS, rows):,}/{rows:,} rows", end='', flush=True)
+    print()
+    data_store.backfill_rollups()
+    with data_store.get_connection() as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    data_store.close_connections()
+    print(f"{path}: {rows:,} rows, {os.path.getsize(path) / 1e6:.1f} MB, {time.perf_counter() - started:.1f}s")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Generate benchmark datasets.")
+    parser.add_argument('--rows', nargs='+', default=['1k', '100k', '1m'],
+                        help="Dataset sizes, e.g. 1k 100k 1m 10m (default: %(default)s)")
+    parser.add_argument('--years', type=float, default=3, help="Time span of every dataset (default: %(default)s)")
+    parser.add_argument('--devices', type=int, default=4, help="Boards to spread rows over (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', help="Write a single dataset to this file instead of benchmarks/data/")
+    parser.add_argument('--force', action='store_true', help="Overwrite the --db file if it exists")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.db and len(args.rows) != 1:
+        sys.exit("--db takes exactly one --rows size")
+    if args.db and os.path.exists(args.db) and not args.force:
+        sys.exit(f"{args.db} exists; pass --force to replace it")
+    targets = [(os.path.abspath(args.db), args.rows[0])] if args.db else \
+        [(dataset_path(size), size) for size in args.rows]
+    import_app('dataset-gen-')
+    from app import data_store
+
+    os.makedirs(DATA_DIR, exist_ok=True)
+    for path, size in targets:
+        generate(data_store, path, parse_count(size), args.years, args.devices, args.seed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
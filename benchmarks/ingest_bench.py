@@ -0,0 +1,228 @@
+""" Ingestion throughput benchmark.
+
+Pushes synthetic board payloads (the JSON or binary readings that ota_core.publish_data sends) through
+mqtt_client.on_message -> process_sensor_data -> data_store, at each requested rate and writer
+batch size, and writes messages/sec, enqueue-to-commit latency percentiles and database growth
+to a JSON file. Every run uses a fresh database in a temporary directory.
+
+    python benchmarks/ingest_bench.py --rates 0 200 1000 --batch-sizes 50 200 --messages 5000
+    python benchmarks/ingest_bench.py --baseline benchmarks/results/ingest-before.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from common import default_output, environment, import_app, load_results, write_results
+
+# Regression check: a run is flagged when it is this much worse than the baseline
+THROUGHPUT_TOLERANCE = 0.20  # messages/sec may drop by up to 20%
+LATENCY_TOLERANCE = 0.50     # p99 latency may grow by up to 50%
+
+
+class FakeMessage:
+    """ The two attributes of paho's MQTTMessage that on_message reads. """
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def make_messages(count, devices, seed=0, payload_format='json', per_message=1):
+    """ Builds encoded payloads for `count` readings in the ota_core.publish_data format ('json' or
+    'binary'), round-robin over `devices` boards, with up to `per_message` readings per message
+    (the board's BATCH_SIZE). """
+    from app.sensor_codec import encode_readings
+
+    rng = random.Random(seed)
+    start = datetime(2025, 1, 1)
+    pending = {}
+    messages = []
+    for i in range(count):
+        device = f"bench{i % devices}"
+        readings = pending.setdefault(device, [])
+        readings.append({
+            'timestamp': (start + timedelta(seconds=i // devices)).strftime('%Y-%m-%d %H:%M:%S'),
+            'temp_dht11': rng.randint(18, 32),
+            'hum_dht11': rng.randint(30, 80),
+            'temp_ds18b20': round(rng.uniform(18, 32), 2),
+            'light_intensity': rng.randint(0, 4095),
+        })
+        if len(readings) >= per_message or i >= count - devices:
+            messages.append(FakeMessage(f"fyp/{device}/RemoteIoT", _encode(readings, payload_format, encode_readings)))
+            pending[device] = []
+    return messages
+
+
+def _encode(readings, payload_format, encode_readings):
+    if payload_format == 'binary':
+        return encode_readings(readings)
+    objects = [{
+        "time": reading['timestamp'],
+        "DHT11_Temperature": reading['temp_dht11'],
+        "DHT11_Humidity": reading['hum_dht11'],
+        "DS18B20_Temperature": reading['temp_ds18b20'],
+        "Light_Intensity": reading['light_intensity'],
+    } for reading in readings]
+    return json.dumps(objects[0] if len(objects) == 1 else objects).encode()
+
+
+def db_size(path):
+    """ Bytes on disk of the database including its WAL file. """
+    return sum(os.path.getsize(p) for p in (path, path + '-wal') if os.path.exists(p))
+
+
+def run_case(data_store, mqtt_client, db_path, messages, rate, batch_size):
+    """ Sends every message at `rate` msg/s (0 = as fast as possible) and waits for the writer to commit them. """
+    data_store.configure_db(db_path)
+    data_store.INGEST_BATCH_SIZE = batch_size
+    data_store.reset_ingest_stats()
+    size_before = db_size(db_path)
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        for i, msg in enumerate(messages):
+            if rate:
+                delay = started + i / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            mqtt_client.on_message(mqtt_client.client, None, msg)
+        sent = time.perf_counter()
+        data_store.flush_ingest(timeout=60)
+        finished = time.perf_counter()
+
+    stats = data_store.get_ingest_stats()
+    latencies = data_store.get_ingest_latencies()
+    data_store.stop_ingest_writer()
+    with sqlite3.connect(db_path) as conn:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        rows = conn.execute("SELECT COUNT(*) FROM sensor_data").fetchone()[0]
+    growth = db_size(db_path) - size_before
+
+    elapsed = finished - started
+    return {
+        'rate': rate,
+        'batch_size': batch_size,
+        'messages': len(messages),
+        'committed': stats['committed'],
+        'dropped': stats['dropped'],
+        'rows': rows,
+        'send_s': round(sent - started, 4),
+        'elapsed_s': round(elapsed, 4),
+        'messages_per_s': round(stats['committed'] / elapsed, 1) if elapsed else 0.0,
+        'p50_latency_ms': round(float(_percentile(latencies, 50)), 3),
+        'p99_latency_ms': round(float(_percentile(latencies, 99)), 3),
+        'max_latency_ms': round(float(latencies.max()), 3) if len(latencies) else 0.0,
+        'batches': stats['batches'],
+        'db_growth_bytes': growth,
+        'bytes_per_row': round(growth / rows, 1) if rows else 0.0,
+    }
+
+
+def _percentile(values, q):
+    return np.percentile(values, q) if len(values) else 0.0
+
+
+def compare(results, baseline):
+    """ Returns a list of regression messages for runs that also appear in the baseline. """
+    previous = {(run['rate'], run['batch_size']): run for run in baseline['runs']}
+    regressions = []
+    for run in results['runs']:
+        old = previous.get((run['rate'], run['batch_size']))
+        if old is None:
+            continue
+        case = f"rate={run['rate']} batch={run['batch_size']}"
+        # Throughput only means something when the sender was not the bottleneck
+        if run['rate'] == 0 and run['messages_per_s'] < old['messages_per_s'] * (1 - THROUGHPUT_TOLERANCE):
+            regressions.append(f"{case}: {run['messages_per_s']} msg/s vs {old['messages_per_s']} in the baseline")
+        if run['p99_latency_ms'] > old['p99_latency_ms'] * (1 + LATENCY_TOLERANCE) + 1:
+            regressions.append(f"{case}: p99 {run['p99_latency_ms']} ms vs {old['p99_latency_ms']} ms in the baseline")
+        if run['dropped'] > old['dropped']:
+            regressions.append(f"{case}: {run['dropped']} dropped vs {old['dropped']} in the baseline")
+    return regressions
+
+
+def print_table(runs):
+    header = f"{'rate':>6} {'batch':>6} {'msg/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'dropped':>8} {'B/row':>7}"
+    print(header)
+    print('-' * len(header))
+    for run in runs:
+        print(f"{run['rate'] or 'max':>6} {run['batch_size']:>6} {run['messages_per_s']:>9} "
+              f"{run['p50_latency_ms']:>8} {run['p99_latency_ms']:>8} {run['dropped']:>8} {run['bytes_per_row']:>7}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark MQTT -> SQLite ingestion.")
+    parser.add_argument('--rates', type=float, nargs='+', default=[0, 100, 1000],
+                        help="Messages per second to send at; 0 sends as fast as possible (default: %(default)s)")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 50, 200],
+                        help="INGEST_BATCH_SIZE values to try (default: %(default)s)")
+    parser.add_argument('--messages', type=int, default=2000, help="Readings per run (default: %(default)s)")
+    parser.add_argument('--devices', type=int, default=4, help="Boards to spread messages over (default: %(default)s)")
+    parser.add_argument('--payload', choices=('json', 'binary'), default='json',
+                        help="Sensor payload format the boards send (default: %(default)s)")
+    parser.add_argument('--per-message', type=int, default=1,
+                        help="Readings the boards batch into one message (default: %(default)s)")
+    parser.add_argument('--synchronous', choices=('OFF', 'NORMAL', 'FULL'), help="Override PRAGMA synchronous")
+    parser.add_argument('--output', help="Results file (default: benchmarks/results/ingest-<timestamp>.json)")
+    parser.add_argument('--baseline', help="Earlier results file; exit with status 1 on a regression against it")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    output = os.path.abspath(args.output or default_output('ingest'))
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    workdir = import_app('ingest-bench-')
+    from app import data_store, mqtt_client
+
+    if args.synchronous:
+        data_store.DB_PRAGMAS['synchronous'] = args.synchronous
+    messages = make_messages(args.messages, args.devices, payload_format=args.payload, per_message=args.per_message)
+    runs = []
+    for batch_size in args.batch_sizes:
+        for rate in args.rates:
+            db_path = os.path.join(workdir, f"bench-{batch_size}-{rate:g}.db")
+            runs.append(run_case(data_store, mqtt_client, db_path, messages, rate, batch_size))
+            print(f"rate={rate:g} batch={batch_size}: {runs[-1]['messages_per_s']} msg/s, "
+                  f"p99 {runs[-1]['p99_latency_ms']} ms")
+
+    results = {
+        'benchmark': 'ingest',
+        'environment': environment(),
+        'settings': {
+            'messages': args.messages,
+            'devices': args.devices,
+            'payload': args.payload,
+            'readings_per_message': args.per_message,
+            'payload_bytes_per_reading': round(sum(len(msg.payload) for msg in messages) / args.messages, 1),
+            'pragmas': dict(data_store.DB_PRAGMAS),
+            'flush_interval_s': data_store.INGEST_FLUSH_INTERVAL,
+            'queue_size': data_store.INGEST_QUEUE_SIZE,
+            'full_policy': data_store.INGEST_FULL_POLICY,
+        },
+        'runs': runs,
+    }
+    print()
+    print_table(runs)
+    write_results(output, results)
+
+    if baseline:
+        regressions = compare(results, load_results(baseline))
+        for message in regressions:
+            print(f"REGRESSION {message}")
+        if regressions:
+            return 1
+        print("No regressions against the baseline.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
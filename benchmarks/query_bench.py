@@ -0,0 +1,258 @@
+""" Storage and query scaling benchmark.
+
+Times the data_store queries, the exports, clear_year_data and the Dash callbacks (through
+Dash's HTTP endpoint, so JSON serialisation is included) against datasets made by
+generate_dataset.py, and records the peak Python memory of every operation with tracemalloc.
+
+    python benchmarks/generate_dataset.py --rows 1k 100k 1m
+    python benchmarks/query_bench.py --datasets 1k 100k 1m
+    python benchmarks/query_bench.py --compare benchmarks/results/query-A.json benchmarks/results/query-B.json
+"""
+import argparse
+import gc
+import os
+import shutil
+import statistics
+import sys
+import time
+import tracemalloc
+
+from common import default_output, environment, import_app, load_results, write_results
+from generate_dataset import DAY_MS, dataset_path
+
+CHART_WIDTH = 600  # Pixels reported by the browser, sets the chart point budget
+
+
+def measure(fn, repeat):
+    """ Runs fn `repeat` times for timing, then once more under tracemalloc for peak memory. """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        result = fn()
+        times.append((time.perf_counter() - started) * 1000)
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'median_ms': round(statistics.median(times), 3),
+        'min_ms': round(min(times), 3),
+        'peak_kb': round(peak / 1024, 1),
+        'result': _describe(result),
+    }
+
+
+def _describe(result):
+    """ A short, comparable summary of what an operation returned. """
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    if isinstance(result, dict) and 'ts_ms' in result:
+        return len(result['ts_ms'])
+    if isinstance(result, (int, float, str)) or result is None:
+        return result
+    return type(result).__name__
+
+
+class CallbackClient:
+    """ Calls the dashboard callbacks the way the browser does, through /_dash-update-component. """
+
+    def __init__(self, app):
+        self.client = app.server.test_client()
+        self.client.get('/')
+        self.chart_key = next(key for key in app.callback_map if 'sensor-chart' in key)
+
+    def post(self, body):
+        response = self.client.post('/_dash-update-component', json=body)
+        if response.status_code not in (200, 204):
+            raise RuntimeError(f"Callback failed with HTTP {response.status_code}")
+        return response.get_data()
+
+    def update_charts(self, device_id, sensors, cursor):
+        ids = [{'type': 'sensor-chart', 'device': device_id, 'sensor': sensor} for sensor in sensors]
+        cursor_id = {'type': 'chart-cursor', 'device': device_id}
+        return self.post({
+            'output': self.chart_key,
+            'outputs': [[{'id': i, 'property': 'figure'} for i in ids],
+                        [{'id': i, 'property': 'extendData'} for i in ids],
+                        {'id': cursor_id, 'property': 'data'}],
+            'inputs': [{'id': 'update-interval', 'property': 'n_intervals', 'value': 1},
+                       {'id': {'type': 'live-data', 'device': device_id}, 'property': 'data', 'value': None},
+                       {'id': 'live-reset', 'property': 'data', 'value': None},
+                       [{'id': i, 'property': 'relayoutData', 'value': None} for i in ids]],
+            'state': [{'id': cursor_id, 'property': 'data', 'value': cursor},
+                      {'id': 'chart-width', 'property': 'data', 'value': CHART_WIDTH}],
+            'changedPropIds': ['update-interval.n_intervals'],
+        })
+
+    def add_device_panels(self):
+        return self.post({
+            'output': '..device-panels.children...known-devices.data..',
+            'outputs': [{'id': 'device-panels', 'property': 'children'},
+                        {'id': 'known-devices', 'property': 'data'}],
+            'inputs': [{'id': 'update-interval', 'property': 'n_intervals', 'value': 1},
+                       {'id': 'live-devices', 'property': 'data', 'value': None}],
+            'state': [{'id': 'known-devices', 'property': 'data', 'value': []}],
+            'changedPropIds': ['update-interval.n_intervals'],
+        })
+
+
+def _drain(chunks):
+    return sum(len(chunk) for chunk in chunks)
+
+
+def benchmark_dataset(path, workdir, repeat):
+    from app import app, archive, callbacks, data_store, export
+    data_store.configure_db(path, archive_dir=os.path.join(workdir, 'archive'))
+    with data_store.get_connection() as conn:
+        rows, first_ms, last_ms, max_id = conn.execute(
+            "SELECT COUNT(*), MIN(ts_ms), MAX(ts_ms), MAX(id) FROM sensor_data").fetchone()
+    device = data_store.list_devices()[0]
+    sensors = list(data_store.SENSOR_COLUMNS)
+    budget = callbacks._point_budget(CHART_WIDTH)
+    client = CallbackClient(app)
+    version = data_store.get_data_version(device)
+
+    def fresh_devices():
+        data_store._known_devices = None
+        return data_store.list_devices()
+
+    ops = [
+        ('get_sensor_data newest 1000', lambda: data_store.get_sensor_data(limit=1000), repeat),
+        ('get_sensor_data last day', lambda: data_store.get_sensor_data(start=last_ms - DAY_MS, end=last_ms), repeat),
+        ('get_sensor_data last day, one board',
+         lambda: data_store.get_sensor_data(start=last_ms - DAY_MS, end=last_ms, device_id=device), repeat),
+        ('get_sensor_data after_id', lambda: data_store.get_sensor_data(after_id=max_id - 100), repeat),
+        ('get_sensor_columns last 30 days',
+         lambda: data_store.get_sensor_columns(start=last_ms - 30 * DAY_MS, end=last_ms), repeat),
+        ('choose_resolution all history', lambda: data_store.choose_resolution(max_points=budget), repeat),
+        ('get_sensor_series all history, one board',
+         lambda: data_store.get_sensor_series(max_points=budget, device_id=device), repeat),
+        ('get_sensor_series last week, one board',
+         lambda: data_store.get_sensor_series(start=last_ms - 7 * DAY_MS, end=last_ms, max_points=budget,
+                                              device_id=device), repeat),
+        ('list_devices (uncached)', fresh_devices, repeat),
+        ('callback update_charts redraw', lambda: client.update_charts(device, sensors, None), repeat),
+        ('callback update_charts incremental',
+         lambda: client.update_charts(device, sensors, {'version': version, 'range': None, 'appended': 0,
+                                                         'last_id': max_id - 10, 'raw': True}), repeat),
+        ('callback add_device_panels', client.add_device_panels, repeat),
+        ('export csv all', lambda: _drain(export.stream_export('csv')), 1),
+        ('export ndjson.gz all', lambda: _drain(export.stream_export('ndjson', compress=True)), 1),
+    ]
+    if archive.pa is not None:
+        ops.append(('export parquet all', lambda: _drain(export.stream_export('parquet')), 1))
+
+    results = {}
+    for name, fn, times in ops:
+        results[name] = measure(fn, times)
+        print(f"  {name}: {results[name]['median_ms']} ms, peak {results[name]['peak_kb']} KiB")
+
+    # Destructive, so it runs once on a copy of the dataset
+    scratch = os.path.join(workdir, 'clear-year.db')
+    data_store.close_connections()
+    shutil.copyfile(path, scratch)
+    data_store.configure_db(scratch)
+    year = time.gmtime(first_ms / 1000).tm_year
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    message = data_store.clear_year_data(year)
+    elapsed = round((time.perf_counter() - started) * 1000, 3)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results['clear_year_data first year'] = {'median_ms': elapsed, 'min_ms': elapsed,
+                                             'peak_kb': round(peak / 1024, 1), 'result': message}
+    print(f"  clear_year_data first year: {elapsed} ms ({message})")
+    data_store.configure_db(path)
+    os.remove(scratch)
+    return {'rows': rows, 'db_bytes': os.path.getsize(path), 'ops': results}
+
+
+def print_table(datasets):
+    sizes = list(datasets)
+    ops = list(dict.fromkeys(op for data in datasets.values() for op in data['ops']))
+    width = max(len(op) for op in ops)
+    print(f"\n{'median ms (peak MiB)':<{width}} " + " ".join(f"{size:>20}" for size in sizes))
+    for op in ops:
+        cells = []
+        for size in sizes:
+            result = datasets[size]['ops'].get(op)
+            if result is None:
+                cells.append(f"{'-':>20}")
+                continue
+            peak = f" ({result['peak_kb'] / 1024:.1f})" if result['peak_kb'] is not None else ""
+            cells.append(f"{result['median_ms']:>12.1f}{peak:>8}")
+        print(f"{op:<{width}} " + " ".join(cells))
+
+
+def compare(before, after):
+    """ Prints median time and peak memory of every operation in both runs, with the ratio. """
+    print(f"before: {before['environment']['commit']} ({before['environment']['timestamp']})")
+    print(f"after:  {after['environment']['commit']} ({after['environment']['timestamp']})")
+    for size, data in after['datasets'].items():
+        old = before['datasets'].get(size)
+        if old is None:
+            continue
+        print(f"\n{size} ({data['rows']:,} rows)")
+        width = max(len(op) for op in data['ops'])
+        print(f"{'operation':<{width}} {'before ms':>11} {'after ms':>11} {'ratio':>7} {'before MiB':>11} {'after MiB':>10}")
+        for op, result in data['ops'].items():
+            previous = old['ops'].get(op)
+            if previous is None:
+                continue
+            ratio = result['median_ms'] / previous['median_ms'] if previous['median_ms'] else float('inf')
+            mem = [f"{r['peak_kb'] / 1024:.1f}" if r['peak_kb'] is not None else '-' for r in (previous, result)]
+            print(f"{op:<{width}} {previous['median_ms']:>11.1f} {result['median_ms']:>11.1f} {ratio:>6.2f}x "
+                  f"{mem[0]:>11} {mem[1]:>10}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark data_store queries and dashboard callbacks.")
+    parser.add_argument('--datasets', nargs='+', default=['1k', '100k', '1m'],
+                        help="Sizes made by generate_dataset.py (default: %(default)s)")
+    parser.add_argument('--db', nargs='+', help="Benchmark these database files instead")
+    parser.add_argument('--repeat', type=int, default=5, help="Timed runs per query (default: %(default)s)")
+    parser.add_argument('--output', help="Results file (default: benchmarks/results/query-<timestamp>.json)")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help="Print a comparison of two results files and exit")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.compare:
+        compare(load_results(args.compare[0]), load_results(args.compare[1]))
+        return 0
+
+    targets = [(os.path.basename(path), os.path.abspath(path)) for path in args.db] if args.db else \
+        [(size, dataset_path(size)) for size in args.datasets]
+    missing = [path for _, path in targets if not os.path.exists(path)]
+    if missing:
+        sys.exit(f"Missing datasets: {', '.join(missing)} (run benchmarks/generate_dataset.py first)")
+    output = os.path.abspath(args.output or default_output('query'))
+    workdir = import_app('query-bench-')
+    from app import app, data_store
+    from app.callbacks import register_callbacks
+    from app.layout import create_layout
+
+    app.layout = create_layout
+    register_callbacks(app)
+    datasets = {}
+    for name, path in targets:
+        print(f"{name}: {path}")
+        datasets[name] = benchmark_dataset(path, workdir, args.repeat)
+
+    print_table(datasets)
+    write_results(output, {
+        'benchmark': 'query',
+        'environment': environment(),
+        'settings': {'repeat': args.repeat, 'chart_width': CHART_WIDTH, 'pragmas': dict(data_store.DB_PRAGMAS)},
+        'datasets': datasets,
+    })
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+import argparse
+
+from app import data_store
+
+
+def backfill_rollups(args):
+    data_store.backfill_rollups(args.start, args.end)
+
+
+def archive_data(args):
+    data_store.archive_old_data(args.days)
+
+
+def export_data(args):
+    from app.export import stream_export
+
+    with open(args.output, 'wb') as f:
+        for chunk in stream_export(args.format, args.start, args.end, args.gzip, args.device):
+            f.write(chunk)
+    print(f"Exported sensor data to {args.output}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Maintenance commands for the Remote IoT Lab database.")
+    parser.add_argument('--db', default=data_store.DB_PATH, help="SQLite database file (default: %(default)s)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    cmd = commands.add_parser('backfill-rollups', help="Rebuild the 1m/1h/1d rollup tables from sensor_data")
+    cmd.add_argument('--start', help="Only rebuild from this time (e.g. 2025-03-01)")
+    cmd.add_argument('--end', help="Only rebuild up to this time (exclusive)")
+    cmd.set_defaults(func=backfill_rollups)
+
+    cmd = commands.add_parser('archive', help="Move old readings into compressed Parquet files (needs pyarrow)")
+    cmd.add_argument('--days', type=float, required=True, help="Archive readings older than this many days")
+    cmd.set_defaults(func=archive_data)
+
+    cmd = commands.add_parser('export', help="Export readings to a file")
+    cmd.add_argument('output', help="Output file path")
+    cmd.add_argument('--format', choices=('csv', 'ndjson', 'json', 'parquet', 'arrow'), default='csv')
+    cmd.add_argument('--start', help="Only export from this time (e.g. 2025-03-01)")
+    cmd.add_argument('--end', help="Only export up to this time (inclusive)")
+    cmd.add_argument('--device', help="Only export readings from this board")
+    cmd.add_argument('--gzip', action='store_true', help="gzip the output (not for Parquet)")
+    cmd.set_defaults(func=export_data)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.db != data_store.DB_PATH:
+        data_store.configure_db(args.db)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()